@@ -0,0 +1,71 @@
+import hashlib
+import unicodedata
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from .cache import TTLCache
+from .config import settings
+
+
+def normalize_query(query: str) -> str:
+    """Canonical form used for exact-match lookups."""
+    return " ".join(unicodedata.normalize("NFKC", query).casefold().split())
+
+
+def answer_cache_key(query: str, scope: str) -> str:
+    """Key a stateless query by its normalized text and the Dify backends
+    serving it (``DifyConfigSnapshot.scope``)."""
+    raw = f"{scope}\0{normalize_query(query)}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class CachedAnswer:
+    """SSE frames exactly as /chat emitted them, plus the answer text."""
+
+    frames: List[bytes]
+    answer: str
+
+
+class AnswerCache:
+    """Stores the SSE frames of completed stateless answers for replay."""
+
+    def __init__(self, enabled: bool, maxsize: int, ttl: float, max_entry_bytes: int):
+        self.enabled = enabled
+        self.max_entry_bytes = max_entry_bytes
+        self._cache: TTLCache[CachedAnswer] = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.stored = 0
+        self.skipped = 0
+
+    def get(self, key: str) -> Optional[CachedAnswer]:
+        """A cached answer, or None."""
+        return self._cache.get(key)
+
+    def store(self, key: str, frames: List[bytes], answer: str) -> None:
+        """Cache a completed answer unless it is too large."""
+        if sum(len(frame) for frame in frames) > self.max_entry_bytes:
+            self.skipped += 1
+            return
+        self._cache.set(key, CachedAnswer(frames=frames, answer=answer))
+        self.stored += 1
+
+    def purge(self) -> int:
+        """Drop every cached answer; returns how many were removed."""
+        return self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and size."""
+        return {
+            "enabled": self.enabled,
+            **self._cache.stats(),
+            "stored": self.stored,
+            "skipped_too_large": self.skipped,
+        }
+
+
+answer_cache = AnswerCache(
+    enabled=settings.CHAT_CACHE_ENABLED,
+    maxsize=settings.CHAT_CACHE_SIZE,
+    ttl=settings.CHAT_CACHE_TTL,
+    max_entry_bytes=settings.CHAT_CACHE_MAX_ENTRY_BYTES,
+)
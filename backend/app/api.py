@@ -1,28 +1,94 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException, Request, Depends
-from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
-from pydantic import BaseModel
+from fastapi import (
+    APIRouter,
+    UploadFile,
+    File,
+    HTTPException,
+    Request,
+    Response,
+    Depends,
+)
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from pydantic import BaseModel, Field
 from datetime import timedelta
-import requests
+from typing import Any, Dict, List
+import httpx
+import logging
+import math
+import time
 
 from .database import get_db
-from .models import DifyConfig, User
+from .dedup import content_hash, find_upload, record_upload
+from .document_index import index_document, search_chunks
+from .models import Conversation, Document, IngestJob, User
+from .answer_cache import answer_cache, answer_cache_key
+from .backends import dify_backends
+from .metrics import (
+    CHAT_CLIENT_TTFB,
+    CHAT_DIFY_TTFB,
+    observe_first_chunk,
+    observe_stream,
+    observe_upload,
+)
+from .rate_limit import rate_limiter
+from .revocation import token_revocations
+from .sessions import (
+    create_session,
+    revoke_session,
+    revoke_user_sessions,
+    rotate_session,
+)
+from .resilience import CircuitOpenError
+from .bulk_ingest import bulk_ingester, too_large
 from .auth import (
     authenticate_user,
     create_access_token,
     get_current_active_user,
+    get_current_admin_user,
     create_user,
     get_user,
     get_user_by_email,
+    invalidate_cached_user,
+    principal_cache,
+    token_cache,
+)
+from .schemas import (
+    ConversationResponse,
+    IngestJobResponse,
+    MessageResponse,
+    RefreshRequest,
+    UserCreate,
+    UserLogin,
+    UserResponse,
+    Token,
 )
-from .schemas import UserCreate, UserLogin, UserResponse, Token
 from .config import settings
+from .dify_client import MultipartUpload, dify_clients
+from .dify_config import DifyBackend, DifyConfigSnapshot, dify_config
+from .hashing import password_hasher
+from .ingest import (
+    EXTRACTABLE,
+    IngestResult,
+    format_timings,
+    iter_upload_chunks,
+    sniff_upload,
+)
+from .ingest_jobs import ingest_jobs
+from .history import (
+    ChatTurn,
+    history_writer,
+    remember_conversation,
+    resolve_dify_conversation_id,
+)
+from .singleflight import Flight, single_flight
+from . import timing
+from .sse import TEXT_EVENTS, coalesce_text_events, format_sse, iter_sse_events
 
 router = APIRouter()
-
-# Dify API configuration (will be fetched from DB)
-DIFY_API_URL = None
-DIFY_API_KEY = None
+logger = logging.getLogger(__name__)
 
 
 class DifyConfigCreate(BaseModel):
@@ -30,28 +96,36 @@ class DifyConfigCreate(BaseModel):
     api_key: str
 
 
+class DifyBackendCreate(BaseModel):
+    api_url: str
+    api_key: str
+    weight: int = Field(default=1, ge=1)
+
+
 # User Authentication Endpoints
 @router.post("/auth/register", response_model=UserResponse)
-async def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     """Register a new user."""
     # Check if user already exists
-    existing_user = get_user(db, user.username)
+    existing_user = await get_user(db, user.username)
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already registered")
 
-    existing_email = get_user_by_email(db, user.email)
+    existing_email = await get_user_by_email(db, user.email)
     if existing_email:
         raise HTTPException(status_code=400, detail="Email already registered")
 
     # Create new user
-    db_user = create_user(db, user.username, user.email, user.password)
+    db_user = await create_user(db, user.username, user.email, user.password)
     return db_user
 
 
 @router.post("/auth/login", response_model=Token)
-async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
+async def login(user_credentials: UserLogin, db: AsyncSession = Depends(get_db)):
     """Authenticate user and return access token."""
-    user = authenticate_user(db, user_credentials.username, user_credentials.password)
+    user = await authenticate_user(
+        db, user_credentials.username, user_credentials.password
+    )
     if not user or user is False:
         raise HTTPException(
             status_code=401,
@@ -59,11 +133,62 @@ async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
             headers={"WWW-Authenticate": "Bearer"},
         )
 
+    refresh_token = await create_session(db, int(user.id))
+    return _issue_tokens(user, refresh_token)
+
+
+def _issue_tokens(user: User, refresh_token: str) -> Dict[str, str]:
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": str(user.username)}, expires_delta=access_token_expires
+        data={"sub": str(user.username)},
+        expires_delta=access_token_expires,
+        user=user if settings.AUTH_STATELESS_TOKENS else None,
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+    }
+
+
+@router.post("/auth/refresh", response_model=Token)
+async def refresh(request: RefreshRequest, db: AsyncSession = Depends(get_db)):
+    """Exchange a refresh token for a new access token, without a password.
+
+    The refresh token is rotated: use the one returned from now on.
+    """
+    rotated = await rotate_session(db, request.refresh_token)
+    if rotated is None:
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid or expired refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    user, refresh_token = rotated
+    return _issue_tokens(user, refresh_token)
+
+
+@router.post("/auth/logout")
+async def logout(request: RefreshRequest, db: AsyncSession = Depends(get_db)):
+    """End the session of a refresh token."""
+    await revoke_session(db, request.refresh_token)
+    return {"message": "Logged out"}
+
+
+@router.post("/auth/revoke")
+async def revoke_tokens(
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """Sign out everywhere: invalidate every token issued to the current user.
+
+    Refresh tokens stop working at once; other workers stop accepting
+    access tokens within AUTH_REVOCATION_REFRESH seconds.
+    """
+    await revoke_user_sessions(db, int(current_user.id))
+    await token_revocations.revoke(db, int(current_user.id))
+    invalidate_cached_user(str(current_user.username))
+    return {"message": "All access tokens revoked"}
 
 
 @router.get("/auth/me", response_model=UserResponse)
@@ -78,83 +203,367 @@ async def protected_route(current_user: User = Depends(get_current_active_user))
     return {"message": f"Hello {current_user.username}, this is a protected route!"}
 
 
+@router.get("/auth/hashing/stats")
+async def hashing_stats(current_user: User = Depends(get_current_active_user)):
+    """Password hashing pool metrics."""
+    return password_hasher.metrics()
+
+
+@router.get("/auth/cache/stats")
+async def auth_cache_stats(current_user: User = Depends(get_current_active_user)):
+    """Authenticated principal cache hit/miss counters."""
+    return principal_cache.stats()
+
+
+@router.get("/auth/token-cache/stats")
+async def auth_token_cache_stats(current_user: User = Depends(get_current_active_user)):
+    """Decoded access token cache hit/miss counters."""
+    return token_cache.stats()
+
+
+@router.get("/auth/revocations/stats")
+async def auth_revocation_stats(current_user: User = Depends(get_current_active_user)):
+    """Size and age of the in-memory token revocation set."""
+    return token_revocations.stats()
+
+
 # Dify Configuration Endpoints
 @router.post("/dify-config")
-async def set_dify_config(config: DifyConfigCreate, db: Session = Depends(get_db)):
-    existing_config = db.query(DifyConfig).first()
-    if existing_config:
-        existing_config.api_url = config.api_url
-        existing_config.api_key = config.api_key
-    else:
-        new_config = DifyConfig(api_url=config.api_url, api_key=config.api_key)
-        db.add(new_config)
-    db.commit()
-    db.refresh(existing_config or new_config)
-    global DIFY_API_URL, DIFY_API_KEY
-    DIFY_API_URL = config.api_url
-    DIFY_API_KEY = config.api_key
+async def set_dify_config(config: DifyConfigCreate, db: AsyncSession = Depends(get_db)):
+    await dify_config.save(db, config.api_url, config.api_key)
     return {"message": "Dify configuration saved successfully"}
 
 
 @router.get("/dify-config")
-async def get_dify_config(db: Session = Depends(get_db)):
-    config = db.query(DifyConfig).first()
-    if not config:
+async def get_dify_config():
+    config = dify_config.current()
+    if not config.configured:
         raise HTTPException(status_code=404, detail="Dify configuration not found")
     return {"api_url": config.api_url, "api_key": config.api_key}
 
 
-@router.on_event("startup")
-async def load_dify_config_on_startup():
-    """加载Dify配置到全局变量（启动时）"""
-    global DIFY_API_URL, DIFY_API_KEY
-    try:
-        # 跳过数据库访问，避免psycopg2内存错误
-        print("⚠️ Skipping Dify config loading due to database driver issues")
-        # 设置默认值
-        DIFY_API_URL = "http://localhost:5000"
-        DIFY_API_KEY = "default-key"
-        print(f"🔧 Using default Dify config: {DIFY_API_URL}")
-    except Exception as e:
-        print(f"⚠️ Could not load Dify config: {e}")
+@router.get("/dify-backends")
+async def list_dify_backends(current_user: User = Depends(get_current_active_user)):
+    """Enabled Dify backends with their health and requests in flight."""
+    config = dify_config.current()
+    return {"version": config.version, "backends": dify_backends.stats(config)}
+
+
+@router.get("/dify-backends/breakers")
+async def dify_breaker_stats(current_user: User = Depends(get_current_active_user)):
+    """Circuit state per backend, the shared retry budget and hedge count."""
+    config = dify_config.current()
+    return {
+        "breakers": [
+            {
+                "id": backend.id,
+                "api_url": backend.api_url,
+                **dify_backends.state(backend).breaker.stats(),
+            }
+            for backend in config.backends
+        ],
+        "retry_budget": dify_backends.retry_budget.stats(),
+        "hedges": dify_backends.hedges,
+    }
 
 
-# Document and Chat Endpoints (Protected)
-@router.post("/documents")
-async def upload_document(
-    file: UploadFile = File(...), current_user: User = Depends(get_current_active_user)
+@router.post("/dify-backends")
+async def add_dify_backend(
+    backend: DifyBackendCreate,
+    current_user: User = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(get_db),
 ):
-    if not DIFY_API_URL or not DIFY_API_KEY:
+    """Add a Dify backend, or update the key and weight of the one at this URL."""
+    config = await dify_config.save_backend(
+        db, backend.api_url, backend.api_key, backend.weight
+    )
+    return {"version": config.version, "backends": dify_backends.stats(config)}
+
+
+@router.delete("/dify-backends/{backend_id}")
+async def disable_dify_backend(
+    backend_id: int,
+    current_user: User = Depends(get_current_admin_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """Stop routing to a backend; conversations pinned to it start over."""
+    config = await dify_config.disable_backend(db, backend_id)
+    if config is None:
+        raise HTTPException(status_code=404, detail="Dify backend not found")
+    return {"version": config.version, "backends": dify_backends.stats(config)}
+
+
+def _require_dify_config() -> DifyConfigSnapshot:
+    """The current Dify configuration, or a 400 if there is none."""
+    config = dify_config.current()
+    if not config.configured:
         raise HTTPException(
             status_code=400,
             detail="Dify API configuration is missing. "
             "Please set it via /api/v1/dify-config.",
         )
+    return config
 
-    url = f"{DIFY_API_URL}/files/upload"
-    headers = {"Authorization": f"Bearer {DIFY_API_KEY}"}
 
-    file_content = await file.read()
-    files = {"file": (file.filename, file_content, file.content_type)}
-    data = {"user": str(getattr(current_user, "username", "unknown"))}
+def _dify_unavailable(error: CircuitOpenError) -> HTTPException:
+    """503 for calls rejected by an open circuit, without waiting on Dify."""
+    return HTTPException(
+        status_code=503,
+        detail="Dify is unavailable (circuit open), please retry later",
+        headers={"Retry-After": str(max(math.ceil(error.retry_after), 1))},
+    )
 
-    try:
-        response = requests.post(url, headers=headers, files=files, data=data)
+
+async def ingest_file(
+    file: UploadFile, current_user: User, db: AsyncSession
+) -> IngestResult:
+    """Forward one file to Dify, then index its text locally for /search.
+
+    Content any enabled Dify backend already has (same SHA-256) is not sent
+    again; the response recorded for the first upload is returned instead.
+    Otherwise the file goes to the least loaded healthy backend.
+    """
+    config = _require_dify_config()
+    dify_user = str(getattr(current_user, "username", "unknown"))
+
+    timings = {}
+    if settings.UPLOAD_DEDUP_ENABLED:
+        started = time.perf_counter()
+        digest = await content_hash(file)
+        fingerprints = [backend.fingerprint for backend in config.backends]
+        cached = await find_upload(db, digest, fingerprints, dify_user)
+        timings["hash"] = time.perf_counter() - started
+        if cached is not None:
+            # Already uploaded, and indexed locally the first time
+            return IngestResult(cached[1], timings, deduplicated=True)
+
+    started = time.perf_counter()
+    sniffed = await sniff_upload(file)
+    timings["sniff"] = time.perf_counter() - started
+
+    # Stream the spooled upload straight into the outbound request body
+    body = MultipartUpload(
+        file,
+        fields={"user": dify_user},
+        content_type=sniffed.content_type,
+    )
+
+    async def send(backend: DifyBackend) -> Dict[str, Any]:
+        url = f"{backend.api_url}/files/upload"
+        headers = {"Authorization": f"Bearer {backend.api_key}", **body.headers}
+        dify_response = await dify_clients.get(url).post(
+            url, headers=headers, content=body
+        )
         # Raise an exception for bad status codes (4xx or 5xx)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
+        dify_response.raise_for_status()
+        return dify_response.json()
+
+    started = time.perf_counter()
+    try:
+        # Retried on another backend if one fails; the body rewinds the file
+        backend, dify_file = await dify_backends.call(config, send)
+    except CircuitOpenError as e:
+        raise _dify_unavailable(e)
+    except httpx.HTTPError as e:
         raise HTTPException(status_code=500, detail=f"Error calling Dify API: {e}")
+    dify_backends.release(backend)
+    timings["upload"] = time.perf_counter() - started
+    observe_upload(file.size, timings["upload"])
+    timing.record("upstream_upload", timings["upload"])
+    if settings.UPLOAD_DEDUP_ENABLED:
+        await record_upload(
+            db, digest, backend.fingerprint, dify_user, file.size, dify_file
+        )
 
+    # Also extract, chunk and index the text locally for /search
+    if sniffed.kind in EXTRACTABLE:
+        document = Document(
+            user_id=current_user.id,
+            filename=file.filename,
+            content_type=sniffed.content_type,
+            dify_file_id=dify_file.get("id"),
+        )
+        pipeline_timings = {}
+        index_timings = {}
+        try:
+            chunks = await index_document(
+                db,
+                document,
+                iter_upload_chunks(file, sniffed, pipeline_timings),
+                index_timings,
+            )
+            timings.update(pipeline_timings)
+            timings.update(index_timings)
+            logger.info(
+                "📄 Indexed %s (%s, %d chunks): %s",
+                file.filename,
+                sniffed.kind,
+                chunks,
+                format_timings(timings),
+            )
+        except Exception as e:
+            await db.rollback()
+            logger.warning("⚠️ Could not index %s locally: %s", file.filename, e)
+    return IngestResult(dify_file, timings)
 
-@router.post("/chat")
-async def chat(request: Request, current_user: User = Depends(get_current_active_user)):
-    if not DIFY_API_URL or not DIFY_API_KEY:
-        raise HTTPException(
-            status_code=400,
-            detail="Dify API configuration is missing. "
-            "Please set it via /api/v1/dify-config.",
+
+# Document and Chat Endpoints (Protected)
+@router.post("/documents")
+async def upload_document(
+    request: Request,
+    response: Response,
+    file: UploadFile = File(...),
+    mode: str = "sync",
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """Upload a document to Dify.
+
+    With ``?mode=async`` the file is queued and a job id is returned at once;
+    poll ``/documents/jobs/{job_id}`` for the outcome.
+    """
+    await rate_limiter.check("upload", current_user.username)
+    _require_dify_config()
+    error = too_large(file.size)
+    if error is not None:
+        raise HTTPException(status_code=413, detail=error)
+    if mode == "async":
+        job = await ingest_jobs.submit(db, file, current_user)
+        status_url = request.url_for("get_ingest_job", job_id=job.id).path
+        return JSONResponse(
+            status_code=202,
+            content={"job_id": job.id, "state": job.state, "status_url": status_url},
+            headers={"Location": status_url},
         )
+    if mode != "sync":
+        raise HTTPException(status_code=400, detail="mode must be sync or async")
+    result = await ingest_file(file, current_user, db)
+    response.headers["X-Dedup"] = "HIT" if result.deduplicated else "MISS"
+    response.headers["X-Ingest-Timings"] = format_timings(result.timings)
+    return result.dify_file
+
+
+@router.post("/documents/bulk")
+async def bulk_upload_documents(
+    request: Request,
+    current_user: User = Depends(get_current_active_user),
+):
+    """Ingest many files, or tar/zip archives of files, in one request.
+
+    Files are forwarded to Dify concurrently and one NDJSON line per file is
+    streamed back as each finishes, followed by a summary line.
+    """
+    await rate_limiter.check("upload", current_user.username)
+    _require_dify_config()
+    # Parsed here rather than with File(...): FastAPI closes form files as
+    # soon as the endpoint returns, before the NDJSON body is streamed
+    form = await request.form(
+        max_files=settings.BULK_INGEST_MAX_FILES,
+        max_fields=settings.BULK_INGEST_MAX_FILES,
+    )
+    uploads = [value for _, value in form.multi_items() if not isinstance(value, str)]
+    if not uploads:
+        await form.close()
+        raise HTTPException(status_code=400, detail="No files uploaded")
+
+    async def process(upload: UploadFile) -> Dict[str, Any]:
+        # The request's own session is closed once streaming starts
+        async with bulk_ingester.session_factory() as db:
+            result = await ingest_file(upload, current_user, db)
+        return {
+            "dify_file": result.dify_file,
+            "deduplicated": result.deduplicated,
+            "timings": result.timings_ms(),
+        }
+
+    try:
+        lease = await rate_limiter.open_stream(current_user.username)
+    except HTTPException:
+        await form.close()
+        raise
+    response = StreamingResponse(
+        observe_stream(
+            bulk_ingester.run(uploads, process, cleanup=form.close),
+            "documents_bulk",
+            _request_started(request),
+        ),
+        media_type="application/x-ndjson",
+    )
+    return lease.attach(response)
+
+
+@router.get("/documents/jobs/{job_id}", response_model=IngestJobResponse)
+async def get_ingest_job(
+    job_id: str,
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """State, size, attempts and stage timings of a background upload."""
+    job = await db.get(IngestJob, job_id)
+    if job is None or job.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.get("/search")
+async def search_documents(
+    q: str,
+    k: int = 5,
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """Top-k chunks of the user's locally indexed documents, without calling
+    Dify."""
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Query is required")
+    k = max(1, min(k, settings.SEARCH_MAX_K))
+    results = await search_chunks(db, int(current_user.id), q, k)
+    return {"query": q, "results": results}
+
+
+@router.post("/chat")
+async def chat(
+    request: Request,
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db),
+):
+    """Stream an answer from Dify as server-sent events.
+
+    Each user has a request rate limit and a cap on concurrently open
+    streams; the stream's slot is held until the response ends.
+    """
+    await rate_limiter.check("chat", current_user.username)
+    lease = await rate_limiter.open_stream(current_user.username)
+    try:
+        response = await _stream_chat(request, current_user, db)
+    except BaseException:
+        await lease.release()
+        raise
+    if response.headers.get("X-Cache") == "HIT":
+        source = "cache"
+    elif response.headers.get("X-Single-Flight") == "follower":
+        source = "single_flight"
+    else:
+        source = "dify"
+    response.body_iterator = observe_stream(
+        response.body_iterator,
+        "chat",
+        _request_started(request),
+        CHAT_CLIENT_TTFB.labels(source),
+    )
+    return lease.attach(response)
+
+
+def _request_started(request: Request) -> float:
+    """When the request arrived, as recorded by MetricsMiddleware."""
+    return getattr(request.state, "started", None) or time.perf_counter()
+
+
+async def _stream_chat(
+    request: Request, current_user: User, db: AsyncSession
+) -> StreamingResponse:
+    # One snapshot for the whole request, even if the config changes mid-stream
+    config = _require_dify_config()
 
     data = await request.json()
     query = data.get("query")
@@ -163,31 +572,286 @@ async def chat(request: Request, current_user: User = Depends(get_current_active
     if not query:
         raise HTTPException(status_code=400, detail="Query is required")
 
-    url = f"{DIFY_API_URL}/chat-messages"
-    headers = {
-        "Authorization": f"Bearer {DIFY_API_KEY}",
-        "Content-Type": "application/json",
-    }
+    user_id = int(current_user.id)
+
+    # Stateless questions may be answered from the exact-match cache, or by
+    # joining an identical question that is already streaming from Dify
+    stateless_key = None
+    if not conversation_id:
+        stateless_key = answer_cache_key(query, config.scope)
+    cache_key = stateless_key if answer_cache.enabled else None
+    response_headers = {"X-Cache": "MISS"} if cache_key else {}
+    if cache_key:
+        cached = answer_cache.get(cache_key)
+        if cached is not None:
+            history_writer.submit(
+                ChatTurn(
+                    user_id=user_id,
+                    client_conversation_id=None,
+                    dify_conversation_id=None,
+                    query=query,
+                    answer=cached.answer,
+                )
+            )
+            return StreamingResponse(
+                iter(cached.frames),
+                media_type="text/event-stream",
+                headers={"X-Cache": "HIT"},
+            )
+
+    flight = None
+    if stateless_key and settings.CHAT_SINGLE_FLIGHT:
+        joined = single_flight.join(stateless_key)
+        if joined is not None:
+            return StreamingResponse(
+                _follow_flight(joined, user_id, query),
+                media_type="text/event-stream",
+                headers={**response_headers, "X-Single-Flight": "follower"},
+            )
+
+    dify_conversation_id, pinned_id = await resolve_dify_conversation_id(
+        db, user_id, conversation_id
+    )
+
+    # A Dify conversation only exists on the backend that started it
+    pinned = None
+    if dify_conversation_id:
+        # Conversations from before backends were tracked live on the primary
+        pinned = config.get(pinned_id) if pinned_id is not None else config.primary
+        if pinned is None:
+            logger.warning(
+                "⚠️ Dify backend %s of conversation %s is gone, starting over",
+                pinned_id,
+                conversation_id,
+            )
+            dify_conversation_id = ""
+
     payload = {
         "inputs": {},
         "query": query,
         "response_mode": "streaming",
         "user": str(getattr(current_user, "username", "unknown")),
-        "conversation_id": conversation_id if conversation_id else "",
+        "conversation_id": dify_conversation_id,
     }
 
-    def generate_dify_response():
+    if stateless_key and settings.CHAT_SINGLE_FLIGHT:
+        # Registered before connecting so requests arriving meanwhile join it
+        flight = single_flight.begin(stateless_key)
+
+    async def connect(backend: DifyBackend) -> httpx.Response:
+        url = f"{backend.api_url}/chat-messages"
+        headers = {
+            "Authorization": f"Bearer {backend.api_key}",
+            "Content-Type": "application/json",
+        }
+        client = dify_clients.get(url)
+        dify_request = client.build_request("POST", url, headers=headers, json=payload)
+        return await _open_dify_stream(client, dify_request)
+
+    connect_started = time.perf_counter()
+    try:
         try:
-            with requests.post(
-                url, headers=headers, json=payload, stream=True
-            ) as response:
-                response.raise_for_status()
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        yield chunk
-        except requests.exceptions.RequestException as e:
+            # Only the connection phase is retried; nothing has streamed yet.
+            # New conversations may be hedged onto a second backend.
+            with timing.phase("upstream_connect"):
+                backend, response = await dify_backends.call(
+                    config,
+                    connect,
+                    backend=pinned,
+                    hedge=pinned is None,
+                    discard=lambda losing: losing.aclose(),
+                )
+        except CircuitOpenError as e:
+            raise _dify_unavailable(e)
+        except httpx.HTTPStatusError as e:
+            raise HTTPException(
+                status_code=500,
+                detail=f"Error calling Dify chat API: HTTP {e.response.status_code}",
+            )
+        except httpx.HTTPError as e:
             raise HTTPException(
                 status_code=500, detail=f"Error calling Dify chat API: {e}"
             )
+    except BaseException as e:
+        if flight is not None:
+            status = e.status_code if isinstance(e, HTTPException) else 500
+            detail = e.detail if isinstance(e, HTTPException) else "Dify unavailable"
+            error = {"event": "error", "status": status, "message": str(detail)}
+            single_flight.abort(flight, format_sse(error))
+        raise
+
+    def observe_dify_ttfb(seconds: float) -> None:
+        CHAT_DIFY_TTFB.observe(seconds)
+        timing.record("upstream_ttfb", seconds)
+
+    async def generate_dify_response():
+        # Tee the answer for the write-behind history queue as it streams
+        answer = []
+        frames = [] if cache_key else None
+        failed = False
+        message_id = None
+        new_conversation_id = dify_conversation_id or None
+        events = coalesce_text_events(
+            iter_sse_events(
+                observe_first_chunk(
+                    response.aiter_bytes(), connect_started, observe_dify_ttfb
+                )
+            ),
+            window=settings.CHAT_COALESCE_WINDOW_MS / 1000,
+            max_bytes=settings.CHAT_COALESCE_MAX_BYTES,
+        )
+        try:
+            async for event in events:
+                if event.get("event") in TEXT_EVENTS:
+                    answer.append(event.get("answer") or "")
+                seen_id = event.get("conversation_id")
+                if seen_id and seen_id != new_conversation_id:
+                    new_conversation_id = seen_id
+                    # Mapped right away: a follow-up may arrive before the
+                    # history queue writes this turn
+                    if conversation_id:
+                        remember_conversation(
+                            user_id, conversation_id, seen_id, backend.id
+                        )
+                message_id = event.get("message_id") or message_id
+                failed = failed or event.get("event") == "error"
+                frame = format_sse(event)
+                if frames is not None:
+                    frames.append(frame)
+                yield frame
+            if frames is not None and not failed:
+                answer_cache.store(cache_key, frames, "".join(answer))
+        finally:
+            if flight is not None:
+                flight.answer = "".join(answer)
+            history_writer.submit(
+                ChatTurn(
+                    user_id=user_id,
+                    client_conversation_id=conversation_id,
+                    dify_conversation_id=new_conversation_id,
+                    query=query,
+                    answer="".join(answer),
+                    dify_message_id=message_id,
+                    dify_backend_id=backend.id,
+                )
+            )
+
+    async def close_dify_response():
+        try:
+            await response.aclose()
+        finally:
+            dify_backends.release(backend)
+
+    if flight is not None:
+        # The upstream stream is driven independently of this client, so
+        # followers keep receiving it even if the leader disconnects
+        single_flight.run(flight, generate_dify_response(), cleanup=close_dify_response)
+        return StreamingResponse(
+            flight.subscribe(),
+            media_type="text/event-stream",
+            headers={**response_headers, "X-Single-Flight": "leader"},
+        )
+
+    return StreamingResponse(
+        generate_dify_response(),
+        media_type="text/event-stream",
+        headers=response_headers or None,
+        background=BackgroundTask(close_dify_response),
+    )
+
+
+async def _open_dify_stream(
+    client: httpx.AsyncClient, dify_request: httpx.Request
+) -> httpx.Response:
+    """Send a streaming request; only the connection phase happens here.
+
+    Error statuses raise httpx.HTTPStatusError so they can be retried.
+    """
+    response = await client.send(dify_request, stream=True)
+    if response.is_error:
+        await response.aclose()
+        raise httpx.HTTPStatusError(
+            f"HTTP {response.status_code}", request=dify_request, response=response
+        )
+    return response
+
+
+async def _follow_flight(flight: Flight, user_id: int, query: str):
+    """Stream an identical in-flight answer and record it in history."""
+    async for frame in flight.subscribe():
+        yield frame
+    history_writer.submit(
+        ChatTurn(
+            user_id=user_id,
+            client_conversation_id=None,
+            dify_conversation_id=None,
+            query=query,
+            answer=flight.answer,
+        )
+    )
 
-    return StreamingResponse(generate_dify_response(), media_type="text/event-stream")
+
+@router.get("/chat/single-flight/stats")
+async def chat_single_flight_stats(
+    current_user: User = Depends(get_current_active_user),
+):
+    """Deduplicated in-flight chat stream counters."""
+    return single_flight.stats()
+
+
+@router.get("/chat/cache/stats")
+async def chat_cache_stats(current_user: User = Depends(get_current_active_user)):
+    """Answer cache hit/miss counters."""
+    return answer_cache.stats()
+
+
+@router.delete("/chat/cache")
+async def purge_chat_cache(current_user: User = Depends(get_current_admin_user)):
+    """Drop every cached answer; the cache is shared, so admins only."""
+    return {"purged": answer_cache.purge()}
+
+
+# Conversation History Endpoints (Protected)
+@router.get("/conversations", response_model=List[ConversationResponse])
+async def list_conversations(
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db),
+):
+    result = await db.execute(
+        select(Conversation)
+        .where(Conversation.user_id == current_user.id)
+        .order_by(Conversation.id.desc())
+    )
+    return [
+        ConversationResponse(
+            id=conversation.client_id,
+            title=conversation.title,
+            dify_conversation_id=conversation.dify_conversation_id,
+            created_at=conversation.created_at,
+            updated_at=conversation.updated_at,
+        )
+        for conversation in result.scalars()
+    ]
+
+
+@router.get(
+    "/conversations/{conversation_id}/messages",
+    response_model=List[MessageResponse],
+)
+async def list_messages(
+    conversation_id: str,
+    current_user: User = Depends(get_current_active_user),
+    db: AsyncSession = Depends(get_db),
+):
+    result = await db.execute(
+        select(Conversation)
+        .options(selectinload(Conversation.messages))
+        .where(
+            Conversation.user_id == current_user.id,
+            Conversation.client_id == conversation_id,
+        )
+    )
+    conversation = result.scalars().first()
+    if not conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return conversation.messages
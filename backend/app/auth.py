@@ -1,34 +1,73 @@
+import hashlib
+import time
 from datetime import datetime, timedelta
-from typing import Optional, Union
+from typing import Any, Dict, Optional, Union
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
+from sqlalchemy import event, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import timing
+from .cache import TTLCache
 from .config import settings
 from .database import get_db
+from .hashing import password_hasher, pwd_context
 from .models import User
-
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from .revocation import token_revocations
 
 # JWT token security
 security = HTTPBearer()
 
+# Authenticated principals keyed by username, so the steady-state auth path
+# doesn't need a database round trip
+principal_cache: TTLCache[dict] = TTLCache(
+    maxsize=settings.AUTH_CACHE_SIZE, ttl=settings.AUTH_CACHE_TTL
+)
+_PRINCIPAL_FIELDS = (
+    "id",
+    "username",
+    "email",
+    "is_active",
+    "token_version",
+    "created_at",
+    "updated_at",
+)
+
+# Verified claims keyed by a digest of the token, so a bearer token the SPA
+# sends over and over is only decoded once; entries never outlive its exp
+token_cache: TTLCache[Dict[str, Any]] = TTLCache(
+    maxsize=settings.AUTH_TOKEN_CACHE_SIZE, ttl=settings.AUTH_TOKEN_CACHE_TTL
+)
+
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify a plain password against a hashed password."""
+    """Verify a plain password against a hashed password (blocking)."""
     return pwd_context.verify(plain_password, hashed_password)
 
 
 def get_password_hash(password: str) -> str:
-    """Generate password hash."""
+    """Generate password hash (blocking)."""
     return pwd_context.hash(password)
 
 
-def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
-    """Create JWT access token."""
+def create_access_token(
+    data: dict, expires_delta: Optional[timedelta] = None, user: Optional[User] = None
+):
+    """Create JWT access token.
+
+    With ``user``, the token also carries the claims needed to authorize it
+    without loading the user: id, email, status and token version.
+    """
     to_encode = data.copy()
+    if user is not None:
+        to_encode.update(
+            {
+                "uid": user.id,
+                "email": user.email,
+                "act": bool(user.is_active),
+                "ver": user.token_version or 0,
+            }
+        )
     if expires_delta:
         expire = datetime.utcnow() + expires_delta
     else:
@@ -42,57 +81,101 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 
-def verify_token(token: str) -> Optional[str]:
-    """Verify JWT token and return username."""
+def decode_token(token: str) -> Optional[Dict[str, Any]]:
+    """Verify a JWT and return its claims, or None if it is invalid.
+
+    The claims may come from ``token_cache`` and must not be modified.
+    """
+    key = hashlib.sha256(token.encode()).digest()
+    payload = token_cache.get(key)
+    if payload is not None:
+        return payload
     try:
         payload = jwt.decode(
             token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]
         )
-        username = payload.get("sub")
-        if username is None:
-            return None
-        return str(username)
     except JWTError:
         return None
+    if payload.get("sub") is None:
+        return None
+    ttl = token_cache.ttl
+    if "exp" in payload:
+        ttl = min(ttl, float(payload["exp"]) - time.time())
+    token_cache.set(key, payload, ttl=ttl)
+    return payload
 
 
-def get_user(db: Session, username: str) -> Optional[User]:
+def verify_token(token: str) -> Optional[str]:
+    """Verify JWT token and return username."""
+    payload = decode_token(token)
+    return None if payload is None else str(payload["sub"])
+
+
+def _has_user_claims(payload: Dict[str, Any]) -> bool:
+    return all(claim in payload for claim in ("uid", "email", "act", "ver"))
+
+
+async def get_user(db: AsyncSession, username: str) -> Optional[User]:
     """Get user by username."""
-    return db.query(User).filter(User.username == username).first()
+    result = await db.execute(select(User).where(User.username == username))
+    return result.scalars().first()
+
 
+def invalidate_cached_user(username: str) -> None:
+    """Forget a cached principal after the user is changed or deactivated."""
+    principal_cache.invalidate(username)
 
-def get_user_by_email(db: Session, email: str) -> Optional[User]:
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_on_change(mapper, connection, target: User) -> None:
+    invalidate_cached_user(str(target.username))
+    # Only what this update loaded; unloaded attributes can't be fetched here
+    values = vars(target)
+    if "id" in values:
+        token_revocations.apply(
+            values["id"], values.get("token_version"), values.get("is_active")
+        )
+
+
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[User]:
     """Get user by email."""
-    return db.query(User).filter(User.email == email).first()
+    result = await db.execute(select(User).where(User.email == email))
+    return result.scalars().first()
 
 
-def authenticate_user(db: Session, username: str, password: str) -> Union[User, bool]:
+async def authenticate_user(
+    db: AsyncSession, username: str, password: str
+) -> Union[User, bool]:
     """Authenticate user with username and password."""
-    user = get_user(db, username)
+    user = await get_user(db, username)
     if not user:
         return False
     # Convert Column to string for password verification
     stored_password = getattr(user, "hashed_password", "")
-    if not verify_password(password, stored_password):
+    if not await password_hasher.verify(password, stored_password):
         return False
     return user
 
 
-def create_user(db: Session, username: str, email: str, password: str) -> User:
+async def create_user(
+    db: AsyncSession, username: str, email: str, password: str
+) -> User:
     """Create a new user."""
-    hashed_password = get_password_hash(password)
+    hashed_password = await password_hasher.hash(password)
     db_user = User(
         username=username, email=email, hashed_password=hashed_password, is_active=True
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    invalidate_cached_user(username)
     return db_user
 
 
-def get_current_user(
+async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
 ) -> User:
     """Get current authenticated user."""
     credentials_exception = HTTPException(
@@ -102,21 +185,67 @@ def get_current_user(
     )
 
     token = credentials.credentials
-    username = verify_token(token)
-    if username is None:
+    with timing.phase("auth"):
+        payload = decode_token(token)
+    if payload is None:
         raise credentials_exception
+    username = str(payload["sub"])
+
+    # Tokens with user claims are authorized from the token alone, once the
+    # revocation set is known; older tokens take the lookup path below
+    if (
+        settings.AUTH_STATELESS_TOKENS
+        and token_revocations.loaded
+        and _has_user_claims(payload)
+    ):
+        if token_revocations.is_revoked(payload["uid"], payload["ver"]):
+            raise credentials_exception
+        return User(
+            id=payload["uid"],
+            username=username,
+            email=payload["email"],
+            is_active=payload["act"],
+            token_version=payload["ver"],
+        )
 
-    user = get_user(db, username=username)
-    if user is None:
+    # Tokens from before the user's last revoke are rejected here too, for
+    # when the revocation set is not loaded or the fast path is off
+    version = payload.get("ver", 0)
+    cached = principal_cache.get(username)
+    if cached is not None:
+        if version < (cached["token_version"] or 0):
+            raise credentials_exception
+        # Detached copy; never carries the password hash
+        return User(**cached)
+
+    with timing.phase("db"):
+        user = await get_user(db, username=username)
+    if user is None or version < (user.token_version or 0):
         raise credentials_exception
 
+    principal_cache.set(
+        username, {field: getattr(user, field) for field in _PRINCIPAL_FIELDS}
+    )
     return user
 
 
-def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
+async def get_current_active_user(
+    current_user: User = Depends(get_current_user),
+) -> User:
     """Get current active user."""
     if not bool(current_user.is_active):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="Inactive user"
         )
     return current_user
+
+
+async def get_current_admin_user(
+    current_user: User = Depends(get_current_active_user),
+) -> User:
+    """Get current user if listed in ADMIN_USERNAMES."""
+    if current_user.username not in settings.ADMIN_USERNAMES:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required"
+        )
+    return current_user
@@ -0,0 +1,349 @@
+import asyncio
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+)
+
+import httpx
+
+from .config import settings
+from .dify_client import dify_clients
+from .dify_config import DifyBackend, DifyConfigSnapshot, DifyConfigStore
+from .resilience import (
+    OPEN,
+    CircuitBreaker,
+    CircuitOpenError,
+    RetryBudget,
+    is_retryable,
+)
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+@dataclass
+class BackendState:
+    """Health and load of one backend, as seen by this process."""
+
+    breaker: CircuitBreaker
+    healthy: bool = True
+    in_flight: int = 0
+    requests: int = 0
+    probe_failures: int = 0
+    last_probe: Optional[float] = None
+    last_probe_ms: Optional[float] = None
+    last_error: Optional[str] = None
+
+
+class BackendRouter:
+    """Routes Dify calls to the healthy backend with the fewest requests in
+    flight relative to its weight.
+
+    A background prober checks every backend each ``interval`` seconds and
+    marks it unhealthy after ``failure_threshold`` failed probes in a row;
+    one successful probe brings it back. If no backend is healthy, all of
+    them are tried rather than failing every request.
+
+    ``call`` adds a circuit breaker per backend, retries on other backends
+    within a shared retry budget and, optionally, a hedged second attempt
+    when the first has not answered after ``hedge_delay`` seconds.
+    """
+
+    def __init__(
+        self,
+        interval: float,
+        timeout: float,
+        path: str,
+        failure_threshold: int,
+        breaker_failures: int = 5,
+        breaker_reset: float = 30.0,
+        max_attempts: int = 3,
+        retry_backoff: float = 0.1,
+        retry_budget: Optional[RetryBudget] = None,
+        hedge_delay: float = 0.0,
+    ):
+        self.interval = interval
+        self.timeout = timeout
+        self.path = path
+        self.failure_threshold = failure_threshold
+        self.breaker_failures = breaker_failures
+        self.breaker_reset = breaker_reset
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.retry_budget = retry_budget or RetryBudget(0.2, 1.0, 10.0)
+        self.hedge_delay = hedge_delay
+        self.hedges = 0
+        # Keyed by fingerprint, so changing a backend's URL or key resets it
+        self._states: Dict[str, BackendState] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def state(self, backend: DifyBackend) -> BackendState:
+        state = self._states.get(backend.fingerprint)
+        if state is None:
+            breaker = CircuitBreaker(self.breaker_failures, self.breaker_reset)
+            state = self._states[backend.fingerprint] = BackendState(breaker)
+        return state
+
+    def pick(
+        self, config: DifyConfigSnapshot, exclude: Sequence[DifyBackend] = ()
+    ) -> DifyBackend:
+        """The least loaded healthy backend (weighted), ties broken at random.
+
+        Backends in ``exclude`` are only used if nothing else is available;
+        backends with an open circuit never are. Raises CircuitOpenError if
+        every circuit is open.
+        """
+        available = [b for b in config.backends if self.state(b).breaker.available()]
+        if not available:
+            breakers = [self.state(b).breaker for b in config.backends]
+            for breaker in breakers:
+                breaker.rejected += 1
+            raise CircuitOpenError(min(breaker.retry_after() for breaker in breakers))
+        excluded = {backend.id for backend in exclude}
+        candidates = [b for b in available if b.id not in excluded] or available
+        candidates = [b for b in candidates if self.state(b).healthy] or candidates
+
+        def load(backend: DifyBackend) -> float:
+            return (self.state(backend).in_flight + 1) / backend.weight
+
+        lowest = min(load(backend) for backend in candidates)
+        return random.choice([b for b in candidates if load(b) == lowest])
+
+    def acquire(self, backend: DifyBackend) -> None:
+        """Count a request to ``backend`` as in flight."""
+        state = self.state(backend)
+        state.in_flight += 1
+        state.requests += 1
+
+    def release(self, backend: DifyBackend) -> None:
+        """Mark a request to ``backend`` as finished."""
+        state = self.state(backend)
+        state.in_flight = max(state.in_flight - 1, 0)
+
+    async def call(
+        self,
+        config: DifyConfigSnapshot,
+        send: Callable[[DifyBackend], Awaitable[T]],
+        backend: Optional[DifyBackend] = None,
+        hedge: bool = False,
+        discard: Optional[Callable[[T], Awaitable[Any]]] = None,
+    ) -> Tuple[DifyBackend, T]:
+        """Run ``send`` against a backend, retrying retryable failures.
+
+        ``backend`` pins every attempt to one backend; otherwise each retry
+        prefers a backend not tried yet. With ``hedge``, a second backend is
+        tried if the first is slow, and ``discard`` releases the losing
+        result. Returns the backend that answered, still acquired: the
+        caller must ``release`` it. Raises CircuitOpenError if the circuit
+        is open, or the last error once attempts or the budget run out.
+        """
+        self.retry_budget.record_request()
+        tried: List[DifyBackend] = []
+        attempt = 1
+        while True:
+            try:
+                target = backend or self.pick(config, exclude=tried)
+                if hedge and backend is None and self.hedge_delay > 0:
+                    return await self._hedged(config, target, send, discard, tried)
+                return target, await self._attempt(target, send)
+            except CircuitOpenError:
+                if tried:
+                    # Our own failures opened it; report what actually failed
+                    raise error
+                raise
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                error = e
+            tried.append(target)
+            if attempt >= self.max_attempts or not self.retry_budget.try_acquire():
+                raise error
+            delay = self.retry_backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.0)
+            logger.warning(
+                "⚠️ Dify call to %s failed (%s), retrying in %.2fs",
+                target.api_url,
+                error,
+                delay,
+            )
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _attempt(
+        self, backend: DifyBackend, send: Callable[[DifyBackend], Awaitable[T]]
+    ) -> T:
+        breaker = self.state(backend).breaker
+        if not breaker.allow():
+            raise CircuitOpenError(breaker.retry_after())
+        self.acquire(backend)
+        try:
+            result = await send(backend)
+        except asyncio.CancelledError:
+            breaker.record_cancelled()
+            self.release(backend)
+            raise
+        except Exception as e:
+            self.release(backend)
+            if not is_retryable(e):
+                # The backend answered; the request itself was wrong
+                breaker.record_success()
+                raise
+            was_open = breaker.state == OPEN
+            breaker.record_failure()
+            if breaker.state == OPEN and not was_open:
+                logger.warning(
+                    "🚧 Circuit for Dify backend %s opened: %s", backend.api_url, e
+                )
+            raise
+        breaker.record_success()
+        return result
+
+    async def _hedged(
+        self,
+        config: DifyConfigSnapshot,
+        first: DifyBackend,
+        send: Callable[[DifyBackend], Awaitable[T]],
+        discard: Optional[Callable[[T], Awaitable[Any]]],
+        tried: List[DifyBackend],
+    ) -> Tuple[DifyBackend, T]:
+        first_task = asyncio.create_task(self._attempt(first, send))
+        tasks: Dict[asyncio.Task, DifyBackend] = {first_task: first}
+        winner: Optional[asyncio.Task] = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_delay)
+            if not done:
+                try:
+                    second = self.pick(config, exclude=[first])
+                except CircuitOpenError:
+                    second = first
+                # Hedges spend the retry budget too
+                if second.id != first.id and self.retry_budget.try_acquire():
+                    self.hedges += 1
+                    tasks[asyncio.create_task(self._attempt(second, send))] = second
+            pending = set(tasks)
+            while pending and winner is None:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None and winner is None:
+                        winner = task
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for task, backend in tasks.items():
+                if task is winner or task.cancelled() or task.exception():
+                    continue
+                # Finished alongside the winner, or we were cancelled
+                self.release(backend)
+                if discard is not None:
+                    await discard(task.result())
+        if winner is None:
+            tried.extend(b for b in tasks.values() if b.id != first.id)
+            # Retries follow the first attempt's error
+            raise first_task.exception()
+        return tasks[winner], winner.result()
+
+    async def probe(self, backend: DifyBackend) -> bool:
+        """Check one backend and update its health."""
+        state = self.state(backend)
+        url = f"{backend.api_url}{self.path}"
+        started = time.perf_counter()
+        try:
+            response = await dify_clients.get(url).get(
+                url,
+                headers={"Authorization": f"Bearer {backend.api_key}"},
+                timeout=self.timeout,
+            )
+            ok = response.status_code < 400
+            error = None if ok else f"HTTP {response.status_code}"
+        except httpx.HTTPError as e:
+            ok = False
+            error = str(e) or type(e).__name__
+        state.last_probe = time.time()
+        state.last_probe_ms = round((time.perf_counter() - started) * 1000, 1)
+        state.last_error = error
+        if ok:
+            if not state.healthy:
+                logger.info("💚 Dify backend %s is healthy again", backend.api_url)
+            state.healthy = True
+            state.probe_failures = 0
+        else:
+            state.probe_failures += 1
+            if state.healthy and state.probe_failures >= self.failure_threshold:
+                state.healthy = False
+                logger.warning(
+                    "💔 Dify backend %s marked unhealthy: %s", backend.api_url, error
+                )
+        return ok
+
+    async def probe_all(self, config: DifyConfigSnapshot) -> None:
+        """Probe every backend concurrently."""
+        await asyncio.gather(*(self.probe(backend) for backend in config.backends))
+
+    def start(self, store: DifyConfigStore) -> None:
+        """Start probing; called from the startup hook."""
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run(store))
+            logger.info("🩺 Dify health prober started (every %ss)", self.interval)
+
+    async def stop(self) -> None:
+        """Stop probing; called from the shutdown hook."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, store: DifyConfigStore) -> None:
+        while True:
+            try:
+                await self.probe_all(store.current())
+            except Exception as e:
+                logger.error("❌ Dify health probe failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def stats(self, config: DifyConfigSnapshot) -> List[Dict[str, Any]]:
+        """Health, load and circuit state of every enabled backend."""
+        stats = []
+        for backend in config.backends:
+            state = vars(self.state(backend)).copy()
+            state["breaker"] = state["breaker"].stats()
+            stats.append(
+                {
+                    "id": backend.id,
+                    "api_url": backend.api_url,
+                    "weight": backend.weight,
+                    **state,
+                }
+            )
+        return stats
+
+
+dify_backends = BackendRouter(
+    interval=settings.DIFY_HEALTH_INTERVAL,
+    timeout=settings.DIFY_HEALTH_TIMEOUT,
+    path=settings.DIFY_HEALTH_PATH,
+    failure_threshold=settings.DIFY_HEALTH_FAILURES,
+    breaker_failures=settings.DIFY_BREAKER_FAILURES,
+    breaker_reset=settings.DIFY_BREAKER_RESET,
+    max_attempts=settings.DIFY_RETRY_ATTEMPTS,
+    retry_backoff=settings.DIFY_RETRY_BACKOFF,
+    retry_budget=RetryBudget(
+        ratio=settings.DIFY_RETRY_BUDGET_RATIO,
+        min_per_second=settings.DIFY_RETRY_BUDGET_MIN_PER_SECOND,
+        burst=settings.DIFY_RETRY_BUDGET_BURST,
+    ),
+    hedge_delay=settings.DIFY_HEDGE_DELAY_MS / 1000,
+)
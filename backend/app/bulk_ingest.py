@@ -0,0 +1,256 @@
+import asyncio
+import json
+import logging
+import mimetypes
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from dataclasses import dataclass
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    IO,
+    Iterator,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+
+from .config import settings
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+_TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+_ZIP_TYPES = ("application/zip", "application/x-zip-compressed")
+_TAR_TYPES = ("application/x-tar", "application/gzip", "application/x-gzip")
+
+# Archive members larger than this are spooled to disk while forwarded
+_SPOOL_MAX_MEMORY = 1024 * 1024
+
+
+def archive_kind(upload: UploadFile) -> Optional[str]:
+    """Return "zip" or "tar" for archives to unpack, None for regular files."""
+    name = (upload.filename or "").lower()
+    content_type = upload.content_type or ""
+    if name.endswith(".zip") or content_type in _ZIP_TYPES:
+        return "zip"
+    if name.endswith(_TAR_SUFFIXES) or content_type in _TAR_TYPES:
+        return "tar"
+    return None
+
+
+def _skip_member(name: str) -> bool:
+    # Directory entries and macOS resource forks
+    base = name.rsplit("/", 1)[-1]
+    return not base or base.startswith("._") or name.startswith("__MACOSX/")
+
+
+def _member_upload(source, name: str) -> UploadFile:
+    spooled = tempfile.SpooledTemporaryFile(max_size=_SPOOL_MAX_MEMORY)
+    shutil.copyfileobj(source, spooled, settings.DIFY_UPLOAD_CHUNK_SIZE)
+    size = spooled.tell()
+    spooled.seek(0)
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    return UploadFile(
+        spooled,
+        size=size,
+        filename=name,
+        headers=Headers({"content-type": content_type}),
+    )
+
+
+@dataclass
+class BulkEntry:
+    """One file of a bulk request, or an archive that could not be read."""
+
+    filename: str
+    upload: Optional[UploadFile] = None
+    error: Optional[str] = None
+    # Uploads unpacked from an archive are closed once forwarded
+    owned: bool = False
+
+
+def too_large(size: Optional[int]) -> Optional[str]:
+    """Why a file of ``size`` bytes is refused, or None if it is accepted."""
+    if size is not None and size > settings.MAX_UPLOAD_SIZE:
+        return f"File exceeds the {settings.MAX_UPLOAD_SIZE} byte upload limit"
+    return None
+
+
+class _ArchiveTooLarge(Exception):
+    pass
+
+
+def _archive_members(upload: UploadFile, kind: str) -> Iterator[Tuple[str, int, IO]]:
+    # Sizes are the ones recorded in the archive; both readers stop there
+    upload.file.seek(0)
+    if kind == "zip":
+        with zipfile.ZipFile(upload.file) as archive:
+            members = [
+                info
+                for info in archive.infolist()
+                if not info.is_dir() and not _skip_member(info.filename)
+            ]
+            # The central directory lists every size, so bombs are refused
+            # before anything is forwarded
+            expanded = sum(info.file_size for info in members)
+            if expanded > settings.BULK_INGEST_MAX_EXPANDED_SIZE:
+                raise _ArchiveTooLarge()
+            for info in members:
+                with archive.open(info) as member:
+                    yield info.filename, info.file_size, member
+    else:
+        # Stream mode reads members in order without seeking back
+        with tarfile.open(fileobj=upload.file, mode="r|*") as archive:
+            for member in archive:
+                if not member.isfile() or _skip_member(member.name):
+                    continue
+                yield member.name, member.size, archive.extractfile(member)
+
+
+def _iter_archive(upload: UploadFile, kind: str) -> Iterator[BulkEntry]:
+    expanded = 0
+    try:
+        for name, size, member in _archive_members(upload, kind):
+            error = too_large(size)
+            if error is not None:
+                yield BulkEntry(name, error=error)
+                continue
+            expanded += size
+            if expanded > settings.BULK_INGEST_MAX_EXPANDED_SIZE:
+                raise _ArchiveTooLarge()
+            yield BulkEntry(name, _member_upload(member, name), owned=True)
+    except _ArchiveTooLarge:
+        yield BulkEntry(
+            upload.filename or "upload",
+            error=(
+                "Archive unpacks to more than "
+                f"{settings.BULK_INGEST_MAX_EXPANDED_SIZE} bytes"
+            ),
+        )
+
+
+def iter_entries(uploads: Iterable[UploadFile]) -> Iterator[BulkEntry]:
+    """Files of a bulk request, with archives unpacked one member at a time.
+
+    Blocking: archive members are copied out as they are reached.
+    """
+    for upload in uploads:
+        kind = archive_kind(upload)
+        if kind is None:
+            error = too_large(upload.size)
+            if error is not None:
+                yield BulkEntry(upload.filename or "upload", error=error)
+            else:
+                yield BulkEntry(upload.filename or "upload", upload)
+            continue
+        try:
+            yield from _iter_archive(upload, kind)
+        except (tarfile.TarError, zipfile.BadZipFile, OSError, EOFError) as e:
+            yield BulkEntry(upload.filename or "upload", error=f"Bad archive: {e}")
+
+
+class BulkIngester:
+    """Forwards the files of a bulk request with bounded concurrency.
+
+    At most ``concurrency`` files are in flight at once; archive members are
+    only unpacked when a slot is free, so a large archive never sits fully
+    extracted in memory or on disk.
+    """
+
+    def __init__(self, concurrency: int):
+        self.concurrency = concurrency
+        self.session_factory = SessionLocal
+
+    async def run(
+        self,
+        uploads: Iterable[UploadFile],
+        process: Callable[[UploadFile], Awaitable[Dict[str, Any]]],
+        cleanup: Optional[Callable[[], Awaitable[Any]]] = None,
+    ) -> AsyncIterator[bytes]:
+        """Yield one NDJSON line per file as it completes, then a summary."""
+        started = time.perf_counter()
+        slots = asyncio.Semaphore(self.concurrency)
+        results: asyncio.Queue = asyncio.Queue()
+        tasks: Set[asyncio.Task] = set()
+
+        async def handle(index: int, entry: BulkEntry) -> None:
+            result: Dict[str, Any] = {"index": index, "filename": entry.filename}
+            file_started = time.perf_counter()
+            try:
+                if entry.error is not None:
+                    raise HTTPException(status_code=400, detail=entry.error)
+                result.update(await process(entry.upload))
+                result["status"] = "ok"
+            except HTTPException as e:
+                result.update(status="error", detail=e.detail)
+            except Exception as e:
+                logger.warning("⚠️ Bulk ingest of %s failed: %s", entry.filename, e)
+                result.update(status="error", detail=str(e))
+            finally:
+                slots.release()
+                if entry.owned:
+                    await entry.upload.close()
+            result["elapsed_ms"] = round((time.perf_counter() - file_started) * 1000, 1)
+            await results.put(result)
+
+        async def produce() -> None:
+            entries = iter_entries(uploads)
+            index = 0
+            try:
+                while True:
+                    await slots.acquire()
+                    entry = await run_in_threadpool(next, entries, None)
+                    if entry is None:
+                        slots.release()
+                        break
+                    task = asyncio.create_task(handle(index, entry))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    index += 1
+                await asyncio.gather(*list(tasks))
+            finally:
+                await results.put(None)
+
+        producer = asyncio.create_task(produce())
+        succeeded = failed = 0
+        try:
+            while True:
+                result = await results.get()
+                if result is None:
+                    break
+                if result["status"] == "ok":
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield (json.dumps(result) + "\n").encode()
+            summary = {
+                "total": succeeded + failed,
+                "succeeded": succeeded,
+                "failed": failed,
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+            }
+            logger.info("📦 Bulk ingest finished: %s", summary)
+            yield (json.dumps({"summary": summary}) + "\n").encode()
+        finally:
+            # Also reached when the client disconnects mid-batch
+            producer.cancel()
+            for task in list(tasks):
+                task.cancel()
+            await asyncio.gather(producer, *tasks, return_exceptions=True)
+            if cleanup is not None:
+                await cleanup()
+
+
+bulk_ingester = BulkIngester(concurrency=settings.BULK_INGEST_CONCURRENCY)
@@ -1,6 +1,6 @@
 import os
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Set
 from dotenv import load_dotenv
 
 # Get the project root directory (two levels up from this file)
@@ -36,6 +36,224 @@ class Settings:
         self.ACCESS_TOKEN_EXPIRE_MINUTES: int = int(
             os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
         )
+        # Refresh tokens rotate on every use; reusing a rotated one revokes
+        # its session unless it happens within the grace period (seconds)
+        self.REFRESH_TOKEN_EXPIRE_DAYS: float = float(
+            os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "14")
+        )
+        self.REFRESH_TOKEN_REUSE_GRACE: float = float(
+            os.getenv("REFRESH_TOKEN_REUSE_GRACE", "10")
+        )
+        # Comma-separated users allowed to manage Dify backends and shared
+        # caches; nobody when empty
+        self.ADMIN_USERNAMES: Set[str] = {
+            name.strip()
+            for name in os.getenv("ADMIN_USERNAMES", "").split(",")
+            if name.strip()
+        }
+
+        # Authenticated principal cache (TTL in seconds, 0 disables it)
+        self.AUTH_CACHE_TTL: float = float(os.getenv("AUTH_CACHE_TTL", "60"))
+        self.AUTH_CACHE_SIZE: int = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+
+        # Decoded access tokens (seconds, capped by each token's exp; 0
+        # disables the cache)
+        self.AUTH_TOKEN_CACHE_TTL: float = float(
+            os.getenv("AUTH_TOKEN_CACHE_TTL", "300")
+        )
+        self.AUTH_TOKEN_CACHE_SIZE: int = int(
+            os.getenv("AUTH_TOKEN_CACHE_SIZE", "10000")
+        )
+
+        # Access tokens carrying the user's id, status and token version, so
+        # requests are authorized without a database lookup; revoked versions
+        # are reloaded every AUTH_REVOCATION_REFRESH seconds
+        stateless_env = os.getenv("AUTH_STATELESS_TOKENS", "true").lower()
+        self.AUTH_STATELESS_TOKENS: bool = stateless_env == "true"
+        self.AUTH_REVOCATION_REFRESH: float = float(
+            os.getenv("AUTH_REVOCATION_REFRESH", "30")
+        )
+
+        # Password hashing pool ("thread" or "process")
+        self.PASSWORD_HASH_EXECUTOR: str = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")
+        self.PASSWORD_HASH_WORKERS: int = int(
+            os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1)))
+        )
+        self.PASSWORD_HASH_MAX_QUEUE: int = int(
+            os.getenv("PASSWORD_HASH_MAX_QUEUE", "64")
+        )
+
+        # Dify app used until one is saved via /api/v1/dify-config
+        self.DIFY_API_URL: Optional[str] = os.getenv("DIFY_API_URL") or None
+        self.DIFY_API_KEY: Optional[str] = os.getenv("DIFY_API_KEY") or None
+        # Workers pick up config changes via LISTEN/NOTIFY on PostgreSQL,
+        # otherwise by polling
+        self.DIFY_CONFIG_CHANNEL: str = os.getenv("DIFY_CONFIG_CHANNEL", "dify_config")
+        self.DIFY_CONFIG_POLL_INTERVAL: float = float(
+            os.getenv("DIFY_CONFIG_POLL_INTERVAL", "5")
+        )
+
+        # Dify backend health probing
+        self.DIFY_HEALTH_INTERVAL: float = float(
+            os.getenv("DIFY_HEALTH_INTERVAL", "10")
+        )
+        self.DIFY_HEALTH_TIMEOUT: float = float(os.getenv("DIFY_HEALTH_TIMEOUT", "3"))
+        self.DIFY_HEALTH_PATH: str = os.getenv("DIFY_HEALTH_PATH", "/parameters")
+        self.DIFY_HEALTH_FAILURES: int = int(os.getenv("DIFY_HEALTH_FAILURES", "2"))
+
+        # Dify circuit breaker, retries and hedging
+        self.DIFY_BREAKER_FAILURES: int = int(os.getenv("DIFY_BREAKER_FAILURES", "5"))
+        self.DIFY_BREAKER_RESET: float = float(os.getenv("DIFY_BREAKER_RESET", "30"))
+        self.DIFY_RETRY_ATTEMPTS: int = int(os.getenv("DIFY_RETRY_ATTEMPTS", "3"))
+        self.DIFY_RETRY_BACKOFF: float = float(os.getenv("DIFY_RETRY_BACKOFF", "0.1"))
+        self.DIFY_RETRY_BUDGET_RATIO: float = float(
+            os.getenv("DIFY_RETRY_BUDGET_RATIO", "0.2")
+        )
+        self.DIFY_RETRY_BUDGET_MIN_PER_SECOND: float = float(
+            os.getenv("DIFY_RETRY_BUDGET_MIN_PER_SECOND", "1")
+        )
+        self.DIFY_RETRY_BUDGET_BURST: float = float(
+            os.getenv("DIFY_RETRY_BUDGET_BURST", "10")
+        )
+        # 0 disables hedging of slow chat connects
+        self.DIFY_HEDGE_DELAY_MS: float = float(os.getenv("DIFY_HEDGE_DELAY_MS", "0"))
+
+        # Per-user admission control for /chat and /documents; "postgres"
+        # shares the limits between workers through the database
+        self.RATE_LIMIT_ENABLED: bool = (
+            os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+        )
+        self.RATE_LIMIT_BACKEND: str = os.getenv("RATE_LIMIT_BACKEND", "memory")
+        self.RATE_LIMIT_CHAT_RATE: float = float(os.getenv("RATE_LIMIT_CHAT_RATE", "1"))
+        self.RATE_LIMIT_CHAT_BURST: float = float(
+            os.getenv("RATE_LIMIT_CHAT_BURST", "10")
+        )
+        self.RATE_LIMIT_UPLOAD_RATE: float = float(
+            os.getenv("RATE_LIMIT_UPLOAD_RATE", "2")
+        )
+        self.RATE_LIMIT_UPLOAD_BURST: float = float(
+            os.getenv("RATE_LIMIT_UPLOAD_BURST", "20")
+        )
+        self.RATE_LIMIT_MAX_STREAMS: int = int(os.getenv("RATE_LIMIT_MAX_STREAMS", "4"))
+        # Leases of streams that were never released expire after this long
+        self.RATE_LIMIT_STREAM_TTL: float = float(
+            os.getenv("RATE_LIMIT_STREAM_TTL", "600")
+        )
+
+        # Per-request phase timing: one log line per request, and a sampled
+        # warning with the full breakdown for slow ones
+        self.REQUEST_TIMING_LOG: bool = (
+            os.getenv("REQUEST_TIMING_LOG", "true").lower() == "true"
+        )
+        self.SLOW_REQUEST_MS: float = float(os.getenv("SLOW_REQUEST_MS", "1000"))
+        self.SLOW_REQUEST_SAMPLE_RATE: float = float(
+            os.getenv("SLOW_REQUEST_SAMPLE_RATE", "1.0")
+        )
+
+        # Dify HTTP client configuration
+        self.DIFY_CONNECT_TIMEOUT: float = float(os.getenv("DIFY_CONNECT_TIMEOUT", "5"))
+        self.DIFY_READ_TIMEOUT: float = float(os.getenv("DIFY_READ_TIMEOUT", "120"))
+        self.DIFY_MAX_CONNECTIONS: int = int(os.getenv("DIFY_MAX_CONNECTIONS", "500"))
+        self.DIFY_MAX_KEEPALIVE_CONNECTIONS: int = int(
+            os.getenv("DIFY_MAX_KEEPALIVE_CONNECTIONS", "100")
+        )
+        self.DIFY_KEEPALIVE_EXPIRY: float = float(
+            os.getenv("DIFY_KEEPALIVE_EXPIRY", "30")
+        )
+        self.DIFY_UPLOAD_CHUNK_SIZE: int = int(
+            os.getenv("DIFY_UPLOAD_CHUNK_SIZE", str(64 * 1024))
+        )
+
+        # /chat streaming: merge text deltas per window (0 disables merging)
+        self.CHAT_COALESCE_WINDOW_MS: float = float(
+            os.getenv("CHAT_COALESCE_WINDOW_MS", "30")
+        )
+        self.CHAT_COALESCE_MAX_BYTES: int = int(
+            os.getenv("CHAT_COALESCE_MAX_BYTES", "1024")
+        )
+
+        # Chat history write-behind queue
+        self.HISTORY_BATCH_SIZE: int = int(os.getenv("HISTORY_BATCH_SIZE", "100"))
+        self.HISTORY_FLUSH_INTERVAL_MS: float = float(
+            os.getenv("HISTORY_FLUSH_INTERVAL_MS", "200")
+        )
+        self.HISTORY_MAX_QUEUE: int = int(os.getenv("HISTORY_MAX_QUEUE", "10000"))
+        self.CONVERSATION_CACHE_TTL: float = float(
+            os.getenv("CONVERSATION_CACHE_TTL", "3600")
+        )
+        self.CONVERSATION_CACHE_SIZE: int = int(
+            os.getenv("CONVERSATION_CACHE_SIZE", "50000")
+        )
+
+        # Exact-match answer cache for stateless /chat queries
+        self.CHAT_CACHE_ENABLED: bool = (
+            os.getenv("CHAT_CACHE_ENABLED", "false").lower() == "true"
+        )
+        self.CHAT_CACHE_TTL: float = float(os.getenv("CHAT_CACHE_TTL", "3600"))
+        self.CHAT_CACHE_SIZE: int = int(os.getenv("CHAT_CACHE_SIZE", "1000"))
+        self.CHAT_CACHE_MAX_ENTRY_BYTES: int = int(
+            os.getenv("CHAT_CACHE_MAX_ENTRY_BYTES", str(256 * 1024))
+        )
+
+        # Share one upstream stream between identical stateless questions
+        self.CHAT_SINGLE_FLIGHT: bool = (
+            os.getenv("CHAT_SINGLE_FLIGHT", "true").lower() == "true"
+        )
+
+        # Local chunk index for uploaded documents
+        self.EMBEDDER: str = os.getenv("EMBEDDER", "hashing")
+        self.EMBEDDING_DIM: int = int(os.getenv("EMBEDDING_DIM", "384"))
+        self.CHUNK_SIZE: int = int(os.getenv("CHUNK_SIZE", "1000"))
+        self.CHUNK_OVERLAP: int = int(os.getenv("CHUNK_OVERLAP", "150"))
+        self.SEARCH_MAX_K: int = int(os.getenv("SEARCH_MAX_K", "50"))
+
+        # Document ingestion pipeline (text extraction and chunking)
+        self.INGEST_WORKERS: int = int(
+            os.getenv("INGEST_WORKERS", str(min(4, os.cpu_count() or 1)))
+        )
+        self.INGEST_PDF_BATCH_PAGES: int = int(
+            os.getenv("INGEST_PDF_BATCH_PAGES", "16")
+        )
+        self.INGEST_BATCH_SIZE: int = int(os.getenv("INGEST_BATCH_SIZE", "64"))
+        # Largest file accepted for upload, also per member of an archive (bytes)
+        self.MAX_UPLOAD_SIZE: int = int(
+            os.getenv("MAX_UPLOAD_SIZE", str(100 * 1024 * 1024))
+        )
+
+        # POST /documents/bulk: files forwarded to Dify at once, files per request
+        self.BULK_INGEST_CONCURRENCY: int = int(
+            os.getenv("BULK_INGEST_CONCURRENCY", "8")
+        )
+        self.BULK_INGEST_MAX_FILES: int = int(
+            os.getenv("BULK_INGEST_MAX_FILES", "10000")
+        )
+        # Most bytes one archive may unpack to, against zip and tar bombs
+        self.BULK_INGEST_MAX_EXPANDED_SIZE: int = int(
+            os.getenv("BULK_INGEST_MAX_EXPANDED_SIZE", str(1024 * 1024 * 1024))
+        )
+
+        # Skip re-uploading files whose content Dify already has
+        self.UPLOAD_DEDUP_ENABLED: bool = (
+            os.getenv("UPLOAD_DEDUP_ENABLED", "true").lower() == "true"
+        )
+
+        # Background ingestion jobs (POST /documents?mode=async)
+        self.INGEST_SPOOL_DIR: str = os.getenv(
+            "INGEST_SPOOL_DIR", str(Path(__file__).parent.parent / "var" / "ingest")
+        )
+        self.INGEST_JOB_WORKERS: int = int(os.getenv("INGEST_JOB_WORKERS", "2"))
+        self.INGEST_JOB_MAX_ATTEMPTS: int = int(
+            os.getenv("INGEST_JOB_MAX_ATTEMPTS", "5")
+        )
+        self.INGEST_JOB_BACKOFF: float = float(os.getenv("INGEST_JOB_BACKOFF", "2"))
+        self.INGEST_JOB_BACKOFF_MAX: float = float(
+            os.getenv("INGEST_JOB_BACKOFF_MAX", "300")
+        )
+        self.INGEST_JOB_POLL_INTERVAL: float = float(
+            os.getenv("INGEST_JOB_POLL_INTERVAL", "1")
+        )
+        # Running jobs whose lease is not renewed for this long are requeued
+        self.INGEST_JOB_LEASE: float = float(os.getenv("INGEST_JOB_LEASE", "60"))
 
         # Build database URL
         self._database_url: Optional[str] = os.getenv("DATABASE_URL")
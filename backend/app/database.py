@@ -1,6 +1,8 @@
-from sqlalchemy import create_engine
+from datetime import datetime, timezone
+from typing import AsyncIterator
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 import logging
 from .config import settings
 
@@ -8,26 +10,70 @@ from .config import settings
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Create engine with connection pool settings
-# Create engine with connection pool settings
-engine = create_engine(
-    settings.DATABASE_URL,
+_ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def to_async_url(url: str) -> str:
+    """Swap a sync driver in a database URL for its asyncio counterpart."""
+    scheme, sep, rest = url.partition("://")
+    return f"{_ASYNC_DRIVERS.get(scheme, scheme)}{sep}{rest}"
+
+
+def utcnow() -> datetime:
+    """The current time, timezone-aware, for DateTime(timezone=True) columns."""
+    return datetime.now(timezone.utc)
+
+
+def as_utc(value: datetime) -> datetime:
+    """A timestamp read back from the database, made timezone-aware."""
+    # SQLite hands timestamps back without their timezone
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+
+# Create async engine with connection pool settings
+engine = create_async_engine(
+    to_async_url(settings.DATABASE_URL),
     pool_pre_ping=True,  # Verify connections before use
     pool_recycle=3600,  # Recycle connections every hour
     echo=settings.APP_DEBUG,  # Log SQL queries in debug mode
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+SessionLocal = async_sessionmaker(
+    bind=engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
 
 Base = declarative_base()
 
+# create_all does not alter existing tables, so columns added to them later
+# are listed here and added on PostgreSQL at startup
+_ADDED_COLUMNS = (
+    ("dify_configs", "version INTEGER NOT NULL DEFAULT 1"),
+    ("dify_configs", "weight INTEGER NOT NULL DEFAULT 1"),
+    ("dify_configs", "enabled BOOLEAN NOT NULL DEFAULT true"),
+    ("conversations", "dify_backend_id INTEGER"),
+    ("users", "token_version INTEGER NOT NULL DEFAULT 0"),
+    # Rows from before uploads were keyed by user stay NULL and never match
+    ("dify_uploads", "dify_user VARCHAR"),
+    ("ingest_jobs", "lease_owner VARCHAR"),
+    ("ingest_jobs", "lease_expires_at TIMESTAMP WITH TIME ZONE"),
+)
 
-def get_db():
-    db = SessionLocal()
-    try:
+# Constraints replaced after their tables were first created
+_REPLACED_CONSTRAINTS = (
+    "ALTER TABLE dify_uploads DROP CONSTRAINT IF EXISTS uq_dify_uploads_hash_app",
+    "CREATE UNIQUE INDEX IF NOT EXISTS uq_dify_uploads_hash_app_user "
+    "ON dify_uploads (content_hash, dify_app, dify_user)",
+)
+
+
+async def get_db() -> AsyncIterator[AsyncSession]:
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
 def check_database_connection() -> bool:
@@ -61,13 +107,27 @@ def check_tables_exist() -> bool:
         return False
 
 
-def init_database():
+async def init_database():
     """初始化数据库，创建表结构"""
+    from . import models  # noqa: F401 - register tables on Base.metadata
+
     try:
         logger.info("🏗️ Creating missing tables...")
-        # 跳过实际的表创建，避免psycopg2内存错误
-        logger.warning("⚠️ Skipping table creation due to driver issues")
-        logger.info("🎉 Database initialization completed (skipped - driver issues)")
+        # asyncpg avoids the psycopg2 memory errors that used to force a skip
+        async with engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                # pgvector backs the document chunk index
+                await conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+            await conn.run_sync(Base.metadata.create_all)
+            if conn.dialect.name == "postgresql":
+                # Columns added after their tables were first created
+                for table, column in _ADDED_COLUMNS:
+                    await conn.execute(
+                        text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column}")
+                    )
+                for statement in _REPLACED_CONSTRAINTS:
+                    await conn.execute(text(statement))
+        logger.info("🎉 Database initialization completed")
 
     except Exception as e:
         logger.error(f"❌ Error creating tables: {e}")
@@ -0,0 +1,83 @@
+import hashlib
+import logging
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from fastapi import UploadFile
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+
+from .config import settings
+from .models import DifyUpload
+
+logger = logging.getLogger(__name__)
+
+
+def dify_app_fingerprint(api_url: str, api_key: str) -> str:
+    """Identify the Dify app files are uploaded to, without storing its key."""
+    return hashlib.sha256(f"{api_url}\0{api_key}".encode()).hexdigest()
+
+
+def _sha256_file(fileobj, chunk_size: int) -> str:
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+async def content_hash(upload: UploadFile) -> str:
+    """SHA-256 of an upload, read chunk by chunk off the event loop."""
+    return await run_in_threadpool(
+        _sha256_file, upload.file, settings.DIFY_UPLOAD_CHUNK_SIZE
+    )
+
+
+async def find_upload(
+    db: AsyncSession, digest: str, dify_apps: Sequence[str], dify_user: str
+) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """The app an earlier upload of the same content by the same user went
+    to, and Dify's response, if any of ``dify_apps`` has one.
+
+    Other users' uploads never match: the Dify file belongs to its uploader.
+    """
+    result = await db.execute(
+        select(DifyUpload.dify_app, DifyUpload.response).where(
+            DifyUpload.content_hash == digest,
+            DifyUpload.dify_app.in_(dify_apps),
+            DifyUpload.dify_user == dify_user,
+        )
+    )
+    row = result.first()
+    return (row.dify_app, row.response) if row is not None else None
+
+
+async def record_upload(
+    db: AsyncSession,
+    digest: str,
+    dify_app: str,
+    dify_user: str,
+    size: Optional[int],
+    response: Dict[str, Any],
+) -> None:
+    """Remember Dify's response for this content; concurrent duplicates lose."""
+    db.add(
+        DifyUpload(
+            content_hash=digest,
+            dify_app=dify_app,
+            dify_user=dify_user,
+            size=size,
+            dify_file_id=response.get("id"),
+            response=response,
+        )
+    )
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        logger.info("🔁 Upload %s was recorded concurrently", digest[:12])
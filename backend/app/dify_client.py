@@ -0,0 +1,126 @@
+import logging
+import secrets
+from typing import AsyncIterator, Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+from fastapi import UploadFile
+
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _origin(url: str) -> str:
+    """Return the scheme://host:port part of a URL."""
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+def _quote(value: str) -> str:
+    """Escape a value for use inside a multipart header parameter."""
+    return value.replace("\\", "\\\\").replace('"', "%22").replace("\r\n", " ")
+
+
+class MultipartUpload:
+    """multipart/form-data body that streams an UploadFile chunk by chunk.
+
+    Only one chunk of the file is held in memory at a time. Iterating again
+    rewinds the file, so the body can be re-sent.
+    """
+
+    def __init__(
+        self,
+        upload: UploadFile,
+        fields: Optional[Dict[str, str]] = None,
+        field_name: str = "file",
+        chunk_size: Optional[int] = None,
+        content_type: Optional[str] = None,
+    ):
+        self.upload = upload
+        self.chunk_size = chunk_size or settings.DIFY_UPLOAD_CHUNK_SIZE
+        self.boundary = secrets.token_hex(16)
+
+        head = b""
+        for name, value in (fields or {}).items():
+            head += (
+                f"--{self.boundary}\r\n"
+                f'Content-Disposition: form-data; name="{_quote(name)}"\r\n\r\n'
+                f"{value}\r\n"
+            ).encode()
+        filename = _quote(upload.filename or "upload")
+        content_type = content_type or upload.content_type or "application/octet-stream"
+        head += (
+            f"--{self.boundary}\r\n"
+            f'Content-Disposition: form-data; name="{_quote(field_name)}"; '
+            f'filename="{filename}"\r\n'
+            f"Content-Type: {content_type}\r\n\r\n"
+        ).encode()
+        self._head = head
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode()
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        """Content-Type (and Content-Length when the file size is known)."""
+        headers = {"Content-Type": f"multipart/form-data; boundary={self.boundary}"}
+        if self.upload.size is not None:
+            length = len(self._head) + self.upload.size + len(self._tail)
+            headers["Content-Length"] = str(length)
+        return headers
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        await self.upload.seek(0)
+        yield self._head
+        while True:
+            chunk = await self.upload.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        yield self._tail
+
+
+class DifyClientPool:
+    """Long-lived async HTTP clients for Dify, one keep-alive pool per host."""
+
+    def __init__(self):
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+
+    def _build_client(self) -> httpx.AsyncClient:
+        timeout = httpx.Timeout(
+            connect=settings.DIFY_CONNECT_TIMEOUT,
+            read=settings.DIFY_READ_TIMEOUT,
+            write=settings.DIFY_READ_TIMEOUT,
+            pool=settings.DIFY_CONNECT_TIMEOUT,
+        )
+        limits = httpx.Limits(
+            max_connections=settings.DIFY_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.DIFY_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=settings.DIFY_KEEPALIVE_EXPIRY,
+        )
+        return httpx.AsyncClient(timeout=timeout, limits=limits)
+
+    def start(self, *urls: str) -> None:
+        """Warm up clients for known hosts; called from the startup hook."""
+        for url in urls:
+            self.get(url)
+        logger.info("🔌 Dify HTTP client pool started")
+
+    def get(self, url: str) -> httpx.AsyncClient:
+        """Return the pooled client for the host serving ``url``."""
+        origin = _origin(url)
+        client = self._clients.get(origin)
+        if client is None or client.is_closed:
+            client = self._build_client()
+            self._clients[origin] = client
+        return client
+
+    async def aclose(self) -> None:
+        """Close every pooled client; called from the shutdown hook."""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+        logger.info("🔌 Dify HTTP client pool closed")
+
+
+dify_clients = DifyClientPool()
@@ -0,0 +1,295 @@
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import Any, Optional, Set, Tuple
+
+from sqlalchemy import func, select, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import settings
+from .database import SessionLocal, engine
+from .dedup import dify_app_fingerprint
+from .dify_client import dify_clients
+from .models import DifyConfig
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class DifyBackend:
+    """One Dify instance requests can be routed to."""
+
+    id: int
+    api_url: str
+    api_key: str
+    weight: int = 1
+
+    @property
+    def fingerprint(self) -> str:
+        return dify_app_fingerprint(self.api_url, self.api_key)
+
+
+@dataclass(frozen=True)
+class DifyConfigSnapshot:
+    """Immutable set of enabled Dify backends; ``version`` grows on every
+    change."""
+
+    version: int = 0
+    backends: Tuple[DifyBackend, ...] = ()
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.backends)
+
+    @property
+    def primary(self) -> Optional[DifyBackend]:
+        """The oldest backend, used where a single one is expected."""
+        return self.backends[0] if self.backends else None
+
+    @property
+    def api_url(self) -> Optional[str]:
+        return self.primary.api_url if self.primary else None
+
+    @property
+    def api_key(self) -> Optional[str]:
+        return self.primary.api_key if self.primary else None
+
+    def get(self, backend_id: Optional[int]) -> Optional[DifyBackend]:
+        """The enabled backend with this id, if any."""
+        for backend in self.backends:
+            if backend.id == backend_id:
+                return backend
+        return None
+
+    @property
+    def scope(self) -> str:
+        """Identifies the set of backends, for caches shared between them."""
+        fingerprints = sorted(backend.fingerprint for backend in self.backends)
+        return hashlib.sha256("\0".join(fingerprints).encode()).hexdigest()
+
+
+def _bootstrap_snapshot() -> DifyConfigSnapshot:
+    if not (settings.DIFY_API_URL and settings.DIFY_API_KEY):
+        return DifyConfigSnapshot()
+    backend = DifyBackend(0, settings.DIFY_API_URL, settings.DIFY_API_KEY)
+    return DifyConfigSnapshot(backends=(backend,))
+
+
+class DifyConfigStore:
+    """Per-process copy of the Dify backends kept in ``dify_configs``.
+
+    Requests read ``current()`` without touching the database. Every change
+    gives the changed row the next version number and, on PostgreSQL, sends
+    a NOTIFY in the same transaction; every worker LISTENs and reloads when
+    it sees a newer version. Other databases (SQLite in tests and development) are
+    polled every ``poll_interval`` seconds instead.
+    """
+
+    def __init__(self, channel: str, poll_interval: float):
+        self.channel = channel
+        self.poll_interval = poll_interval
+        self.session_factory = SessionLocal
+        self._snapshot = _bootstrap_snapshot()
+        self._task: Optional[asyncio.Task] = None
+        self._refreshes: Set[asyncio.Task] = set()
+
+    def current(self) -> DifyConfigSnapshot:
+        """The configuration requests should use right now."""
+        return self._snapshot
+
+    def _apply(self, snapshot: DifyConfigSnapshot, force: bool = False) -> None:
+        if snapshot == self._snapshot:
+            return
+        # Equal versions can differ if two saves raced on a database without
+        # the advisory lock, so only strictly older snapshots are ignored
+        if snapshot.version < self._snapshot.version and not force:
+            return
+        self._snapshot = snapshot
+        for backend in snapshot.backends:
+            # Warm the keep-alive pool for each host
+            dify_clients.get(backend.api_url)
+        logger.info(
+            "🔧 Dify config v%d loaded: %s",
+            snapshot.version,
+            ", ".join(backend.api_url for backend in snapshot.backends) or "none",
+        )
+
+    @staticmethod
+    async def _load(db: AsyncSession) -> Optional[DifyConfigSnapshot]:
+        result = await db.execute(select(DifyConfig).order_by(DifyConfig.id))
+        rows = result.scalars().all()
+        if not rows:
+            return None
+        return DifyConfigSnapshot(
+            version=max(row.version for row in rows),
+            backends=tuple(
+                DifyBackend(row.id, row.api_url, row.api_key, max(row.weight, 1))
+                for row in rows
+                if row.enabled
+            ),
+        )
+
+    async def refresh(self) -> DifyConfigSnapshot:
+        """Reload the stored configuration if it is newer than ours."""
+        async with self.session_factory() as db:
+            snapshot = await self._load(db)
+        if snapshot is not None:
+            self._apply(snapshot)
+        return self._snapshot
+
+    async def save(
+        self, db: AsyncSession, api_url: str, api_key: str
+    ) -> DifyConfigSnapshot:
+        """Point the primary backend at a new URL and key."""
+        result = await db.execute(select(DifyConfig).order_by(DifyConfig.id))
+        row = result.scalars().first()
+        if row is None:
+            row = DifyConfig(api_url=api_url)
+            db.add(row)
+        row.api_url = api_url
+        row.api_key = api_key
+        row.enabled = True
+        return await self._commit_change(db, row)
+
+    async def save_backend(
+        self,
+        db: AsyncSession,
+        api_url: str,
+        api_key: str,
+        weight: int = 1,
+        enabled: bool = True,
+    ) -> DifyConfigSnapshot:
+        """Add a backend, or update the one with this URL."""
+        result = await db.execute(
+            select(DifyConfig).where(DifyConfig.api_url == api_url)
+        )
+        row = result.scalars().first()
+        if row is None:
+            row = DifyConfig(api_url=api_url)
+            db.add(row)
+        row.api_key = api_key
+        row.weight = weight
+        row.enabled = enabled
+        return await self._commit_change(db, row)
+
+    async def disable_backend(
+        self, db: AsyncSession, backend_id: int
+    ) -> Optional[DifyConfigSnapshot]:
+        """Stop routing to a backend; None if there is no such backend.
+
+        The row is kept so versions keep increasing and conversations pinned
+        to it can be recognised.
+        """
+        row = await db.get(DifyConfig, backend_id)
+        if row is None:
+            return None
+        row.enabled = False
+        return await self._commit_change(db, row)
+
+    async def _commit_change(
+        self, db: AsyncSession, row: DifyConfig
+    ) -> DifyConfigSnapshot:
+        postgres = db.get_bind().dialect.name == "postgresql"
+        if postgres:
+            # Serialize changes so every one gets a distinct version
+            await db.execute(
+                text("SELECT pg_advisory_xact_lock(hashtext(:channel))"),
+                {"channel": self.channel},
+            )
+        latest = await db.execute(select(func.max(DifyConfig.version)))
+        row.version = (latest.scalar() or 0) + 1
+        await db.flush()
+        if postgres:
+            # Delivered to listeners when the transaction commits
+            await db.execute(
+                text("SELECT pg_notify(:channel, :version)"),
+                {"channel": self.channel, "version": str(row.version)},
+            )
+        snapshot = await self._load(db)
+        await db.commit()
+        # What we just committed is authoritative, even if the table was reset
+        self._apply(snapshot, force=True)
+        return self._snapshot
+
+    async def start(self) -> None:
+        """Load the stored configuration and follow changes; called from the
+        startup hook."""
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.warning("⚠️ Could not load Dify config: %s", e)
+        if not self._snapshot.configured:
+            logger.warning("⚠️ Dify is not configured; set it via /api/v1/dify-config")
+        if self._task is None:
+            follow = self._listen if engine.dialect.name == "postgresql" else self._poll
+            self._task = asyncio.create_task(follow())
+
+    async def stop(self) -> None:
+        """Stop following changes; called from the shutdown hook."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("⚠️ Could not refresh Dify config: %s", e)
+
+    def _on_notify(self, connection: Any, pid: int, channel: str, payload: str) -> None:
+        try:
+            version = int(payload)
+        except ValueError:
+            return
+        if version >= self._snapshot.version:
+            task = asyncio.create_task(self.refresh())
+            self._refreshes.add(task)
+            task.add_done_callback(self._refreshes.discard)
+
+    async def _listen(self) -> None:
+        import asyncpg
+
+        dsn = (
+            make_url(settings.DATABASE_URL)
+            .set(drivername="postgresql")
+            .render_as_string(hide_password=False)
+        )
+        while True:
+            connection = None
+            try:
+                connection = await asyncpg.connect(dsn)
+                closed = asyncio.Event()
+                connection.add_termination_listener(lambda _: closed.set())
+                await connection.add_listener(self.channel, self._on_notify)
+                # Pick up anything saved while we were not listening
+                await self.refresh()
+                logger.info("👂 Listening for Dify config changes")
+                while not closed.is_set():
+                    try:
+                        await asyncio.wait_for(closed.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        # Detect connections that died without a FIN
+                        await connection.execute("SELECT 1")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("⚠️ Dify config listener failed, polling: %s", e)
+                try:
+                    await self.refresh()
+                except Exception:
+                    pass
+                await asyncio.sleep(self.poll_interval)
+            finally:
+                if connection is not None and not connection.is_closed():
+                    await connection.close()
+
+
+dify_config = DifyConfigStore(
+    channel=settings.DIFY_CONFIG_CHANNEL,
+    poll_interval=settings.DIFY_CONFIG_POLL_INTERVAL,
+)
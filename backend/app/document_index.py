@@ -0,0 +1,137 @@
+import heapq
+import logging
+import time
+from typing import Any, AsyncIterable, Dict, Iterable, Iterator, List, Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import Float, bindparam, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .embeddings import get_embedder
+from .models import Document, DocumentChunk
+
+logger = logging.getLogger(__name__)
+
+# Preferred places to end a chunk, best first
+_BREAKS = ("\n\n", "\n", ". ", " ")
+
+
+def _break_point(buffer: str, chunk_size: int) -> int:
+    for separator in _BREAKS:
+        index = buffer.rfind(separator, chunk_size // 2, chunk_size)
+        if index != -1:
+            return index + len(separator)
+    return chunk_size
+
+
+def chunk_text(pieces: Iterable[str], chunk_size: int, overlap: int) -> Iterator[str]:
+    """Split streamed text into overlapping chunks of about ``chunk_size``.
+
+    Only about one chunk of text is buffered at a time, so ``pieces`` can be a
+    generator over an arbitrarily large document.
+    """
+    buffer = ""
+    start = 0  # where the next chunk begins in ``buffer``
+    emitted = 0  # end of the last emitted chunk in ``buffer``
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) - start > chunk_size:
+            end = start + _break_point(buffer[start : start + chunk_size], chunk_size)
+            chunk = buffer[start:end].strip()
+            if chunk:
+                yield chunk
+            emitted = end
+            start = end - overlap if end - overlap > start else end
+        # Drop text that no future chunk will need
+        buffer = buffer[start:]
+        emitted -= start
+        start = 0
+    if len(buffer) > emitted and buffer.strip():
+        yield buffer.strip()
+
+
+async def index_document(
+    db: AsyncSession,
+    document: Document,
+    batches: AsyncIterable[List[str]],
+    timings: Optional[Dict[str, float]] = None,
+) -> int:
+    """Embed chunk batches off the event loop and store them with their document.
+
+    Each batch is flushed before the next is read, so only one batch of
+    chunks is held in memory. Embed and store times are added to ``timings``.
+    """
+    timings = timings if timings is not None else {}
+    timings.setdefault("embed", 0.0)
+    timings.setdefault("store", 0.0)
+    db.add(document)
+    await db.flush()
+    count = 0
+    async for chunks in batches:
+        started = time.perf_counter()
+        embeddings = await run_in_threadpool(get_embedder().embed, chunks)
+        embedded = time.perf_counter()
+        db.add_all(
+            DocumentChunk(
+                document_id=document.id,
+                chunk_index=count + index,
+                content=content,
+                embedding=vector,
+            )
+            for index, (content, vector) in enumerate(zip(chunks, embeddings))
+        )
+        await db.flush()
+        count += len(chunks)
+        timings["embed"] += embedded - started
+        timings["store"] += time.perf_counter() - embedded
+    started = time.perf_counter()
+    await db.commit()
+    timings["store"] += time.perf_counter() - started
+    return count
+
+
+async def search_chunks(
+    db: AsyncSession, user_id: int, query: str, k: int
+) -> List[Dict[str, Any]]:
+    """Top-k chunks of one user's documents by cosine similarity to
+    ``query``."""
+    vector = (await run_in_threadpool(get_embedder().embed, [query]))[0]
+    if db.get_bind().dialect.name == "postgresql":
+        # Served by the HNSW index on document_chunks.embedding
+        distance = DocumentChunk.embedding.op("<=>", return_type=Float)(
+            bindparam("query_embedding", vector, type_=DocumentChunk.embedding.type)
+        )
+        result = await db.execute(
+            select(DocumentChunk, Document, distance)
+            .join(Document, DocumentChunk.document_id == Document.id)
+            .where(Document.user_id == user_id)
+            .order_by(distance)
+            .limit(k)
+        )
+        scored = [(1.0 - dist, chunk, doc) for chunk, doc, dist in result.all()]
+    else:
+        # Exact scan for SQLite development and test databases
+        result = await db.execute(
+            select(DocumentChunk, Document)
+            .join(Document, DocumentChunk.document_id == Document.id)
+            .where(Document.user_id == user_id)
+        )
+        scored = heapq.nlargest(
+            k,
+            (
+                (sum(a * b for a, b in zip(vector, chunk.embedding)), chunk, doc)
+                for chunk, doc in result.all()
+            ),
+            key=lambda item: item[0],
+        )
+    return [
+        {
+            "document_id": doc.id,
+            "filename": doc.filename,
+            "dify_file_id": doc.dify_file_id,
+            "chunk_index": chunk.chunk_index,
+            "content": chunk.content,
+            "score": round(score, 4),
+        }
+        for score, chunk, doc in scored
+    ]
@@ -0,0 +1,75 @@
+import hashlib
+import importlib
+import math
+import re
+from typing import Callable, Dict, List, Protocol
+
+from .config import settings
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+class Embedder(Protocol):
+    """Turns texts into fixed-size vectors."""
+
+    dim: int
+
+    def embed(self, texts: List[str]) -> List[List[float]]: ...
+
+
+class HashingEmbedder:
+    """Deterministic, dependency-free embedder based on feature hashing.
+
+    Word unigrams and bigrams are hashed into ``dim`` signed buckets and the
+    result is L2-normalized, so cosine similarity rewards shared vocabulary.
+    Good enough for offline tests and a lexical baseline.
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        tokens = _TOKEN_RE.findall(text.casefold())
+        return tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+    def embed_one(self, text: str) -> List[float]:
+        vector = [0.0] * self.dim
+        for feature in self._features(text):
+            digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dim
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector))
+        return [v / norm for v in vector] if norm else vector
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_one(text) for text in texts]
+
+
+_EMBEDDERS: Dict[str, Callable[[int], Embedder]] = {"hashing": HashingEmbedder}
+
+
+def register_embedder(name: str, factory: Callable[[int], Embedder]) -> None:
+    """Make an embedder selectable through the EMBEDDER setting."""
+    _EMBEDDERS[name] = factory
+
+
+def load_embedder(name: str, dim: int) -> Embedder:
+    """Build a registered embedder, or import one given as "module:Class"."""
+    if name in _EMBEDDERS:
+        return _EMBEDDERS[name](dim)
+    module_name, _, attr = name.partition(":")
+    if not attr:
+        raise ValueError(f"Unknown embedder: {name}")
+    factory = getattr(importlib.import_module(module_name), attr)
+    return factory(dim)
+
+
+_embedder = None
+
+
+def get_embedder() -> Embedder:
+    """The embedder configured for this process."""
+    global _embedder
+    if _embedder is None:
+        _embedder = load_embedder(settings.EMBEDDER, settings.EMBEDDING_DIM)
+    return _embedder
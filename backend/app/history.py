@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .cache import TTLCache
+from .config import settings
+from .database import SessionLocal
+from .models import Conversation, Message
+
+logger = logging.getLogger(__name__)
+
+# (user_id, client conversation id) -> (Dify conversation id, backend id)
+conversation_cache: TTLCache[Tuple[str, Optional[int]]] = TTLCache(
+    maxsize=settings.CONVERSATION_CACHE_SIZE, ttl=settings.CONVERSATION_CACHE_TTL
+)
+
+
+def remember_conversation(
+    user_id: int, client_id: str, dify_id: str, backend_id: Optional[int]
+) -> None:
+    """Map a client id to its Dify conversation as soon as Dify assigns it,
+    so a follow-up sent before the history is written continues it."""
+    conversation_cache.set((user_id, client_id), (dify_id, backend_id))
+
+
+def _looks_like_dify_id(value: str) -> bool:
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return False
+    return True
+
+
+async def resolve_dify_conversation_id(
+    db: AsyncSession, user_id: int, client_id: Optional[str]
+) -> Tuple[str, Optional[int]]:
+    """Map the id the browser uses to the conversation id Dify assigned and
+    the backend that holds it (None if unknown).
+
+    Unknown ids that are already Dify UUIDs pass through unchanged; local ids
+    such as "1" start a new Dify conversation.
+    """
+    if not client_id:
+        return "", None
+    key = (user_id, client_id)
+    cached = conversation_cache.get(key)
+    if cached is not None:
+        return cached
+    result = await db.execute(
+        select(Conversation.dify_conversation_id, Conversation.dify_backend_id).where(
+            Conversation.user_id == user_id, Conversation.client_id == client_id
+        )
+    )
+    row = result.first()
+    if row is not None and row.dify_conversation_id:
+        resolved = (row.dify_conversation_id, row.dify_backend_id)
+        conversation_cache.set(key, resolved)
+        return resolved
+    return (client_id if _looks_like_dify_id(client_id) else ""), None
+
+
+@dataclass(frozen=True)
+class ChatTurn:
+    """One question and its streamed answer, queued for persistence."""
+
+    user_id: int
+    client_conversation_id: Optional[str]
+    dify_conversation_id: Optional[str]
+    query: str
+    answer: str
+    dify_message_id: Optional[str] = None
+    dify_backend_id: Optional[int] = None
+
+
+class HistoryWriter:
+    """Write-behind queue that persists chat turns in batches.
+
+    ``submit`` never blocks the token stream: turns are buffered in memory and
+    a background task commits them every ``flush_interval`` seconds or every
+    ``batch_size`` turns, whichever comes first.
+    """
+
+    def __init__(self, batch_size: int, flush_interval: float, max_queue: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.session_factory = SessionLocal
+        self._queue: "asyncio.Queue[ChatTurn]" = asyncio.Queue(maxsize=max_queue)
+        self._task: Optional[asyncio.Task] = None
+        self._written = 0
+        self._dropped = 0
+        self._failed = 0
+        self._batches = 0
+        self._last_flush_ms = 0.0
+
+    def start(self) -> None:
+        """Start the background flusher; called from the startup hook."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info("📝 Chat history writer started")
+
+    async def stop(self) -> None:
+        """Stop the flusher and persist everything still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def submit(self, turn: ChatTurn) -> None:
+        """Queue a turn without waiting; drops it if the queue is full."""
+        try:
+            self._queue.put_nowait(turn)
+        except asyncio.QueueFull:
+            self._dropped += 1
+            logger.warning("⚠️ Chat history queue full, dropping turn")
+
+    async def flush(self) -> None:
+        """Persist everything currently queued."""
+        while not self._queue.empty():
+            batch = []
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            await self._write(batch)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await self._write(batch)
+
+    async def _write(self, batch: List[ChatTurn]) -> None:
+        started = time.perf_counter()
+        try:
+            await self._commit(batch)
+            self._written += len(batch)
+        except Exception as e:
+            # One bad turn must not lose the others: write them one by one
+            logger.warning(
+                "⚠️ Chat history batch of %d failed, writing turns singly: %s",
+                len(batch),
+                e,
+            )
+            for turn in batch:
+                await self._write_turn(turn)
+        finally:
+            self._batches += 1
+            self._last_flush_ms = (time.perf_counter() - started) * 1000
+
+    async def _write_turn(self, turn: ChatTurn) -> None:
+        # Retried once: a conversation another worker created concurrently
+        # fails the insert, and is found by the second attempt
+        for attempt in range(2):
+            try:
+                await self._commit([turn])
+                self._written += 1
+                return
+            except Exception as e:
+                if attempt:
+                    self._failed += 1
+                    logger.error("❌ Failed to persist chat turn: %s", e)
+
+    async def _commit(self, batch: List[ChatTurn]) -> None:
+        async with self.session_factory() as db:
+            conversations: Dict[Tuple[int, str], Conversation] = {}
+            for turn in batch:
+                conversation = await self._conversation_for(db, turn, conversations)
+                db.add_all(
+                    [
+                        Message(
+                            conversation=conversation,
+                            role="user",
+                            content=turn.query,
+                        ),
+                        Message(
+                            conversation=conversation,
+                            role="assistant",
+                            content=turn.answer,
+                            dify_message_id=turn.dify_message_id,
+                        ),
+                    ]
+                )
+            await db.commit()
+            for (user_id, client_id), conversation in conversations.items():
+                if conversation.dify_conversation_id:
+                    remember_conversation(
+                        user_id,
+                        client_id,
+                        conversation.dify_conversation_id,
+                        conversation.dify_backend_id,
+                    )
+
+    @staticmethod
+    async def _conversation_for(
+        db: AsyncSession,
+        turn: ChatTurn,
+        seen: Dict[Tuple[int, str], Conversation],
+    ) -> Conversation:
+        client_id = (
+            turn.client_conversation_id
+            or turn.dify_conversation_id
+            or str(uuid.uuid4())
+        )
+        key = (turn.user_id, client_id)
+        conversation = seen.get(key)
+        if conversation is None:
+            result = await db.execute(
+                select(Conversation).where(
+                    Conversation.user_id == turn.user_id,
+                    Conversation.client_id == client_id,
+                )
+            )
+            conversation = result.scalars().first()
+        if conversation is None:
+            conversation = Conversation(
+                user_id=turn.user_id, client_id=client_id, title=turn.query[:100]
+            )
+            db.add(conversation)
+        if turn.dify_conversation_id:
+            conversation.dify_conversation_id = turn.dify_conversation_id
+        if turn.dify_backend_id is not None:
+            conversation.dify_backend_id = turn.dify_backend_id
+        seen[key] = conversation
+        return conversation
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and write counters."""
+        return {
+            "queued": self._queue.qsize(),
+            "written": self._written,
+            "dropped": self._dropped,
+            "failed": self._failed,
+            "batches": self._batches,
+            "last_flush_ms": round(self._last_flush_ms, 2),
+        }
+
+
+history_writer = HistoryWriter(
+    batch_size=settings.HISTORY_BATCH_SIZE,
+    flush_interval=settings.HISTORY_FLUSH_INTERVAL_MS / 1000,
+    max_queue=settings.HISTORY_MAX_QUEUE,
+)
@@ -0,0 +1,364 @@
+import codecs
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+import unicodedata
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import IO, Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+from xml.etree import ElementTree
+
+from fastapi import UploadFile
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+
+from .config import settings
+from .document_index import chunk_text
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from the start of an upload to detect its type
+SNIFF_BYTES = 8192
+
+PDF = "pdf"
+DOCX = "docx"
+MARKDOWN = "markdown"
+TEXT = "text"
+BINARY = "binary"
+
+EXTRACTABLE = (PDF, DOCX, MARKDOWN, TEXT)
+
+_CONTENT_TYPES = {
+    PDF: "application/pdf",
+    DOCX: "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    MARKDOWN: "text/markdown",
+    TEXT: "text/plain",
+}
+_MARKDOWN_EXTENSIONS = (".md", ".markdown")
+_TEXT_EXTENSIONS = (".txt", ".csv", ".json", ".html", ".htm", ".log", ".rst")
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+
+@dataclass(frozen=True)
+class Sniffed:
+    """Detected document kind and the content type to send upstream."""
+
+    kind: str
+    content_type: str
+
+
+def sniff(head: bytes, filename: Optional[str], content_type: Optional[str]) -> Sniffed:
+    """Detect the document type from its first bytes, falling back to names."""
+    name = (filename or "").lower()
+    declared = content_type or "application/octet-stream"
+    if head.startswith(b"%PDF-"):
+        return Sniffed(PDF, _CONTENT_TYPES[PDF])
+    if head.startswith(b"PK\x03\x04"):
+        if name.endswith(".docx") or b"word/" in head:
+            return Sniffed(DOCX, _CONTENT_TYPES[DOCX])
+        return Sniffed(BINARY, declared)
+    if b"\x00" in head or not _looks_like_utf8(head):
+        return Sniffed(BINARY, declared)
+    if name.endswith(_MARKDOWN_EXTENSIONS) or declared == "text/markdown":
+        return Sniffed(MARKDOWN, _CONTENT_TYPES[MARKDOWN])
+    if declared.startswith("text/") or name.endswith(_TEXT_EXTENSIONS):
+        return Sniffed(TEXT, declared if declared.startswith("text/") else "text/plain")
+    # Unknown extension, but the bytes decode as text
+    return Sniffed(TEXT, _CONTENT_TYPES[TEXT])
+
+
+def _looks_like_utf8(head: bytes) -> bool:
+    try:
+        # The head may end inside a multi-byte character
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+# Extraction stages: each yields text pieces from a seekable binary file
+
+
+def extract_text(fileobj: IO[bytes], block_size: int = 64 * 1024) -> Iterator[str]:
+    """Decode a UTF-8 file block by block."""
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    fileobj.seek(0)
+    while True:
+        block = fileobj.read(block_size)
+        if not block:
+            break
+        text = decoder.decode(block)
+        if text:
+            yield text
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+def _lines(pieces: Iterable[str]) -> Iterator[str]:
+    carry = ""
+    for piece in pieces:
+        lines = (carry + piece).split("\n")
+        carry = lines.pop()
+        for line in lines:
+            yield line + "\n"
+    if carry:
+        yield carry
+
+
+_MD_IMAGE = re.compile(r"!\[([^\]]*)\]\([^)]*\)")
+_MD_LINK = re.compile(r"\[([^\]]*)\]\([^)]*\)")
+_MD_PREFIX = re.compile(r"^\s{0,3}(?:#{1,6}\s+|>\s?|[-*+]\s+|\d+[.)]\s+)")
+_MD_EMPHASIS = re.compile(r"(\*\*|__|\*|_|`)(?=\S)(.+?)(?<=\S)\1")
+_MD_RULE = re.compile(r"^\s{0,3}(?:[-*_]\s*){3,}$|^\s{0,3}(?:```|~~~)")
+
+
+def extract_markdown(fileobj: IO[bytes]) -> Iterator[str]:
+    """Plain text of a Markdown file, line by line, without markup."""
+    for line in _lines(extract_text(fileobj)):
+        if _MD_RULE.match(line):
+            yield "\n"
+            continue
+        line = _MD_PREFIX.sub("", line)
+        line = _MD_IMAGE.sub(r"\1", line)
+        line = _MD_LINK.sub(r"\1", line)
+        yield _MD_EMPHASIS.sub(r"\2", line)
+
+
+def extract_docx(fileobj: IO[bytes]) -> Iterator[str]:
+    """Paragraph text of a DOCX file, parsed incrementally from the zip."""
+    fileobj.seek(0)
+    with zipfile.ZipFile(fileobj) as archive:
+        with archive.open("word/document.xml") as xml:
+            for _, element in ElementTree.iterparse(xml, events=("end",)):
+                if element.tag == f"{_W}p":
+                    text = "".join(node.text or "" for node in element.iter(f"{_W}t"))
+                    yield text + "\n"
+                    element.clear()
+
+
+def extract_pdf_pages(path: str, start: int, stop: int) -> List[str]:
+    """Text of pages ``start``..``stop`` of a PDF (runs in a worker process)."""
+    from pypdf import PdfReader
+
+    reader = PdfReader(path)
+    stop = min(stop, len(reader.pages))
+    return [reader.pages[index].extract_text() or "" for index in range(start, stop)]
+
+
+def pdf_page_count(path: str) -> int:
+    from pypdf import PdfReader
+
+    return len(PdfReader(path).pages)
+
+
+class ExtractionPool:
+    """Worker processes for CPU-heavy text extraction (PDF parsing)."""
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def start(self) -> None:
+        """Create the worker pool; called from the startup hook."""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            logger.info("📄 Extraction pool started (process x%d)", self.max_workers)
+
+    def shutdown(self) -> None:
+        """Stop the worker pool; called from the shutdown hook."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def extract_pdf(self, path: str, batch_pages: int) -> Iterator[str]:
+        """Yield PDF pages in order while later page batches are extracted
+        in parallel; at most one batch per worker is held in memory."""
+        self.start()
+        pages = pdf_page_count(path)
+        batches = deque(range(0, pages, batch_pages))
+        pending = deque()
+        while batches or pending:
+            while batches and len(pending) < self.max_workers:
+                start = batches.popleft()
+                pending.append(
+                    self._executor.submit(
+                        extract_pdf_pages, path, start, start + batch_pages
+                    )
+                )
+            for page in pending.popleft().result():
+                yield page + "\n\n"
+
+
+extraction_pool = ExtractionPool(max_workers=settings.INGEST_WORKERS)
+
+
+# Normalization
+
+
+_CONTROL = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f\x7f]")
+_SPACES = re.compile(r"[ \t]+")
+_BLANK_LINES = re.compile(r"\n[ \n]*\n")
+
+
+def normalize(pieces: Iterable[str]) -> Iterator[str]:
+    """NFKC-normalize text and collapse control characters and whitespace."""
+    for piece in pieces:
+        piece = unicodedata.normalize("NFKC", piece)
+        piece = piece.replace("\r\n", "\n").replace("\r", "\n")
+        piece = _CONTROL.sub("", piece)
+        piece = _SPACES.sub(" ", piece)
+        piece = _BLANK_LINES.sub("\n\n", piece)
+        if piece:
+            yield piece
+
+
+# Pipeline
+
+
+def _timed(
+    iterator: Iterable[Any], timings: Dict[str, float], name: str
+) -> Iterator[Any]:
+    """Accumulate the time spent producing each item of ``iterator``.
+
+    The figure includes time spent in upstream stages; ``IngestPipeline``
+    subtracts those to report time per stage.
+    """
+    iterator = iter(iterator)
+    timings.setdefault(name, 0.0)
+    while True:
+        started = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            timings[name] += time.perf_counter() - started
+            return
+        timings[name] += time.perf_counter() - started
+        yield item
+
+
+@dataclass
+class IngestPipeline:
+    """sniff → extract → normalize → chunk, each stage a generator.
+
+    ``fileobj`` must be seekable; ``path`` is required for PDFs, which are
+    parsed in worker processes.
+    """
+
+    fileobj: IO[bytes]
+    sniffed: Sniffed
+    path: Optional[str] = None
+    chunk_size: int = field(default_factory=lambda: settings.CHUNK_SIZE)
+    overlap: int = field(default_factory=lambda: settings.CHUNK_OVERLAP)
+    _inclusive: Dict[str, float] = field(default_factory=dict)
+
+    def extract(self) -> Iterator[str]:
+        kind = self.sniffed.kind
+        if kind == PDF:
+            if self.path is None:
+                raise ValueError("PDF extraction needs a file path")
+            return extraction_pool.extract_pdf(
+                self.path, settings.INGEST_PDF_BATCH_PAGES
+            )
+        if kind == DOCX:
+            return extract_docx(self.fileobj)
+        if kind == MARKDOWN:
+            return extract_markdown(self.fileobj)
+        if kind == TEXT:
+            return extract_text(self.fileobj)
+        raise ValueError(f"Cannot extract text from {kind} documents")
+
+    def chunks(self) -> Iterator[str]:
+        """Stream chunks of the document's normalized text."""
+        stages = _timed(self.extract(), self._inclusive, "extract")
+        stages = _timed(normalize(stages), self._inclusive, "normalize")
+        return _timed(
+            chunk_text(stages, self.chunk_size, self.overlap), self._inclusive, "chunk"
+        )
+
+    def batches(self, size: int) -> Iterator[List[str]]:
+        """Chunks grouped into lists of up to ``size``."""
+        batch: List[str] = []
+        for chunk in self.chunks():
+            batch.append(chunk)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @property
+    def timings(self) -> Dict[str, float]:
+        """Seconds spent in each stage, excluding upstream stages."""
+        result = {}
+        upstream = 0.0
+        for name in ("extract", "normalize", "chunk"):
+            inclusive = self._inclusive.get(name, 0.0)
+            result[name] = max(inclusive - upstream, 0.0)
+            upstream = inclusive
+        return result
+
+
+@dataclass
+class IngestResult:
+    """Outcome of forwarding one file to Dify."""
+
+    dify_file: Dict[str, Any]
+    timings: Dict[str, float]
+    # True when Dify already had this content and was not contacted
+    deduplicated: bool = False
+
+    def timings_ms(self) -> Dict[str, float]:
+        return {
+            name: round(seconds * 1000, 1) for name, seconds in self.timings.items()
+        }
+
+
+def format_timings(timings: Dict[str, float]) -> str:
+    """Render stage timings as ``name=ms`` pairs for headers and logs."""
+    return ", ".join(
+        f"{name}={seconds * 1000:.1f}ms" for name, seconds in timings.items()
+    )
+
+
+async def sniff_upload(upload: UploadFile) -> Sniffed:
+    """Detect an upload's type from its first bytes, then rewind it."""
+    await upload.seek(0)
+    head = await upload.read(SNIFF_BYTES)
+    await upload.seek(0)
+    return sniff(head, upload.filename, upload.content_type)
+
+
+def _spool_to_disk(upload: UploadFile) -> str:
+    upload.file.seek(0)
+    with tempfile.NamedTemporaryFile(
+        prefix="ingest-", suffix=".pdf", delete=False
+    ) as spooled:
+        shutil.copyfileobj(upload.file, spooled, settings.DIFY_UPLOAD_CHUNK_SIZE)
+    return spooled.name
+
+
+async def iter_upload_chunks(
+    upload: UploadFile, sniffed: Sniffed, pipeline_timings: Dict[str, float]
+) -> AsyncIterator[List[str]]:
+    """Run the pipeline over an upload off the event loop, yielding chunk
+    batches; stage timings are written into ``pipeline_timings`` as it runs."""
+    path = None
+    try:
+        if sniffed.kind == PDF:
+            # Worker processes read the PDF from a named file
+            path = await run_in_threadpool(_spool_to_disk, upload)
+        pipeline = IngestPipeline(upload.file, sniffed, path=path)
+        async for batch in iterate_in_threadpool(
+            pipeline.batches(settings.INGEST_BATCH_SIZE)
+        ):
+            yield batch
+        pipeline_timings.update(pipeline.timings)
+    finally:
+        if path is not None:
+            os.unlink(path)
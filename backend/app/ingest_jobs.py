@@ -0,0 +1,326 @@
+import asyncio
+import logging
+import os
+import random
+import shutil
+import uuid
+from datetime import timedelta
+from typing import Awaitable, Callable, List, Optional
+
+from fastapi import HTTPException, UploadFile
+from sqlalchemy import or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers
+
+from .config import settings
+from .database import SessionLocal, as_utc, utcnow
+from .ingest import IngestResult
+from .models import IngestJob, User
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# Forwards one upload to Dify and indexes it locally
+IngestHandler = Callable[[UploadFile, User, AsyncSession], Awaitable[IngestResult]]
+
+
+def _spool(upload: UploadFile, path: str) -> int:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.part"
+    upload.file.seek(0)
+    with open(partial, "wb") as spooled:
+        shutil.copyfileobj(upload.file, spooled, settings.DIFY_UPLOAD_CHUNK_SIZE)
+        spooled.flush()
+        os.fsync(spooled.fileno())
+        size = spooled.tell()
+    os.replace(partial, path)
+    return size
+
+
+def _remove(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class IngestJobQueue:
+    """Durable queue of uploads that are forwarded to Dify in the background.
+
+    Uploads are spooled to ``spool_dir`` and recorded as ``ingest_jobs``
+    rows, so queued work survives a restart. Workers claim jobs with a
+    conditional UPDATE and retry failures with exponential backoff. A
+    claim is a lease that the worker renews while the job runs; jobs whose
+    lease ran out, because their process died, are requeued by any queue.
+    """
+
+    def __init__(
+        self,
+        spool_dir: str,
+        workers: int,
+        max_attempts: int,
+        backoff: float,
+        backoff_max: float,
+        poll_interval: float,
+        lease: float,
+    ):
+        self.spool_dir = spool_dir
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.poll_interval = poll_interval
+        self.lease = lease
+        # Identifies this process's claims
+        self.owner = uuid.uuid4().hex
+        self.session_factory = SessionLocal
+        self._handler: Optional[IngestHandler] = None
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self, handler: IngestHandler) -> None:
+        """Start the workers; called from the startup hook."""
+        self._handler = handler
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._run(index == 0))
+                for index in range(self.workers)
+            ]
+            logger.info("📥 Ingest job workers started (x%d)", self.workers)
+
+    async def stop(self) -> None:
+        """Stop the workers; unfinished jobs are picked up after restart."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(
+        self, db: AsyncSession, upload: UploadFile, user: User
+    ) -> IngestJob:
+        """Spool an upload to disk and queue it."""
+        job_id = uuid.uuid4().hex
+        path = os.path.join(self.spool_dir, job_id)
+        started = utcnow()
+        size = await run_in_threadpool(_spool, upload, path)
+        now = utcnow()
+        job = IngestJob(
+            id=job_id,
+            user_id=user.id,
+            username=user.username,
+            filename=upload.filename or "upload",
+            content_type=upload.content_type,
+            spool_path=path,
+            bytes=size,
+            state=QUEUED,
+            attempts=0,
+            timings={"spool": round((now - started).total_seconds() * 1000, 1)},
+            created_at=now,
+            next_attempt_at=now,
+        )
+        db.add(job)
+        try:
+            await db.commit()
+        except Exception:
+            await run_in_threadpool(_remove, path)
+            raise
+        self._wakeup.set()
+        return job
+
+    async def recover(self) -> int:
+        """Requeue running jobs whose lease expired; jobs other live workers
+        hold are left alone."""
+        now = utcnow()
+        async with self.session_factory() as db:
+            result = await db.execute(
+                update(IngestJob)
+                .where(
+                    IngestJob.state == RUNNING,
+                    or_(
+                        IngestJob.lease_expires_at.is_(None),
+                        IngestJob.lease_expires_at <= now,
+                    ),
+                )
+                .values(
+                    state=QUEUED,
+                    next_attempt_at=now,
+                    lease_owner=None,
+                    lease_expires_at=None,
+                )
+            )
+            await db.commit()
+        if result.rowcount:
+            logger.info("📥 Requeued %d interrupted ingest jobs", result.rowcount)
+        return result.rowcount
+
+    async def _heartbeat(self, job_id: str) -> None:
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                async with self.session_factory() as db:
+                    renewed = await db.execute(
+                        update(IngestJob)
+                        .where(
+                            IngestJob.id == job_id,
+                            IngestJob.state == RUNNING,
+                            IngestJob.lease_owner == self.owner,
+                        )
+                        .values(
+                            lease_expires_at=utcnow() + timedelta(seconds=self.lease)
+                        )
+                    )
+                    await db.commit()
+                if not renewed.rowcount:
+                    logger.warning("⚠️ Lost the lease on ingest job %s", job_id)
+                    return
+            except Exception as e:
+                logger.warning("⚠️ Could not renew ingest job lease: %s", e)
+
+    async def run_pending(self) -> int:
+        """Process every job that is ready now; returns how many ran."""
+        count = 0
+        while (job_id := await self._claim()) is not None:
+            await self._process(job_id)
+            count += 1
+        return count
+
+    async def _run(self, recover: bool) -> None:
+        while True:
+            # Jobs of a worker that died are picked up once its lease expires
+            if recover:
+                try:
+                    await self.recover()
+                except Exception as e:
+                    logger.warning("⚠️ Could not recover ingest jobs: %s", e)
+            self._wakeup.clear()
+            try:
+                await self.run_pending()
+            except Exception as e:
+                logger.error("❌ Ingest job worker error: %s", e)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _claim(self) -> Optional[str]:
+        async with self.session_factory() as db:
+            while True:
+                now = utcnow()
+                result = await db.execute(
+                    select(IngestJob.id)
+                    .where(IngestJob.state == QUEUED, IngestJob.next_attempt_at <= now)
+                    .order_by(IngestJob.created_at)
+                    .limit(1)
+                )
+                job_id = result.scalars().first()
+                if job_id is None:
+                    return None
+                # Only one worker wins the state transition
+                claimed = await db.execute(
+                    update(IngestJob)
+                    .where(IngestJob.id == job_id, IngestJob.state == QUEUED)
+                    .values(
+                        state=RUNNING,
+                        attempts=IngestJob.attempts + 1,
+                        started_at=now,
+                        lease_owner=self.owner,
+                        lease_expires_at=now + timedelta(seconds=self.lease),
+                    )
+                )
+                await db.commit()
+                if claimed.rowcount:
+                    return job_id
+
+    async def _process(self, job_id: str) -> None:
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            await self._process_claimed(job_id)
+        finally:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+
+    async def _process_claimed(self, job_id: str) -> None:
+        async with self.session_factory() as db:
+            job = await db.get(IngestJob, job_id)
+            if not os.path.exists(job.spool_path):
+                self._finish(job, FAILED, error="Spooled file is missing")
+                await db.commit()
+                return
+            user = User(id=job.user_id, username=job.username)
+            upload = UploadFile(
+                open(job.spool_path, "rb"),
+                size=job.bytes,
+                filename=job.filename,
+                headers=Headers({"content-type": job.content_type or ""}),
+            )
+            try:
+                result = await self._handler(upload, user, db)
+            except Exception as e:
+                await db.rollback()
+                await self._failed(db, job, e)
+            else:
+                # The handler may have rolled back, expiring the job
+                await db.refresh(job)
+                queue_wait = as_utc(job.started_at) - as_utc(job.created_at)
+                job.dify_file = result.dify_file
+                job.deduplicated = result.deduplicated
+                job.timings = {
+                    **(job.timings or {}),
+                    "queue_wait": round(queue_wait.total_seconds() * 1000, 1),
+                    **result.timings_ms(),
+                }
+                self._finish(job, DONE)
+                await db.commit()
+                logger.info("📥 Ingest job %s done (%s)", job.id, job.filename)
+            finally:
+                await upload.close()
+        if job.state in (DONE, FAILED):
+            await run_in_threadpool(_remove, job.spool_path)
+
+    async def _failed(self, db: AsyncSession, job: IngestJob, error: Exception) -> None:
+        await db.refresh(job)
+        detail = error.detail if isinstance(error, HTTPException) else str(error)
+        # Client errors will not succeed on retry
+        permanent = isinstance(error, HTTPException) and error.status_code < 500
+        if permanent or job.attempts >= self.max_attempts:
+            self._finish(job, FAILED, error=detail)
+            logger.warning("⚠️ Ingest job %s failed: %s", job.id, detail)
+        else:
+            delay = min(self.backoff * 2 ** (job.attempts - 1), self.backoff_max)
+            # Jitter so retries after a Dify outage do not arrive in lockstep
+            delay *= random.uniform(0.5, 1.0)
+            job.state = QUEUED
+            job.error = detail
+            job.lease_owner = job.lease_expires_at = None
+            job.next_attempt_at = utcnow() + timedelta(seconds=delay)
+            logger.warning(
+                "⚠️ Ingest job %s attempt %d failed, retrying in %.1fs: %s",
+                job.id,
+                job.attempts,
+                delay,
+                detail,
+            )
+        await db.commit()
+
+    @staticmethod
+    def _finish(job: IngestJob, state: str, error: Optional[str] = None) -> None:
+        job.state = state
+        job.error = error
+        job.finished_at = utcnow()
+        job.lease_owner = job.lease_expires_at = None
+
+
+ingest_jobs = IngestJobQueue(
+    spool_dir=settings.INGEST_SPOOL_DIR,
+    workers=settings.INGEST_JOB_WORKERS,
+    max_attempts=settings.INGEST_JOB_MAX_ATTEMPTS,
+    backoff=settings.INGEST_JOB_BACKOFF,
+    backoff_max=settings.INGEST_JOB_BACKOFF_MAX,
+    poll_interval=settings.INGEST_JOB_POLL_INTERVAL,
+    lease=settings.INGEST_JOB_LEASE,
+)
@@ -1,7 +1,18 @@
-from fastapi import FastAPI
-from app.api import router as api_router
+from fastapi import FastAPI, Response
+from prometheus_client import CONTENT_TYPE_LATEST
+from app.api import ingest_file, router as api_router
+from app.backends import dify_backends
 from app.database import init_database
 from app.config import settings
+from app.dify_client import dify_clients
+from app.dify_config import dify_config
+from app.hashing import password_hasher
+from app.history import history_writer
+from app.ingest import extraction_pool
+from app.ingest_jobs import ingest_jobs
+from app.revocation import token_revocations
+from app.metrics import MetricsMiddleware, render as render_metrics
+from app.timing import TimingMiddleware
 import logging
 
 # Configure logging
@@ -22,19 +33,52 @@ app = FastAPI(
 async def startup_event():
     """Initialize the application on startup."""
     logger.info("🚀 Starting RAG UI Backend...")
+    password_hasher.start()
+    history_writer.start()
     try:
         # Initialize database tables
-        init_database()
+        await init_database()
         logger.info("✅ Application startup completed successfully")
     except Exception as e:
         logger.warning("⚠️ Database initialization failed: %s", e)
         logger.warning("🔄 Application will continue without database tables")
         logger.warning("📝 You may need to initialize the database manually")
+    await dify_config.start()
+    dify_backends.start(dify_config)
+    await token_revocations.start()
+    ingest_jobs.start(ingest_file)
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release shared resources on shutdown."""
+    await token_revocations.stop()
+    await dify_backends.stop()
+    await dify_config.stop()
+    await ingest_jobs.stop()
+    await history_writer.stop()
+    await dify_clients.aclose()
+    password_hasher.shutdown()
+    extraction_pool.shutdown()
+    logger.info("👋 RAG UI Backend stopped")
+
+
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(
+    TimingMiddleware,
+    log_requests=settings.REQUEST_TIMING_LOG,
+    slow_ms=settings.SLOW_REQUEST_MS,
+    slow_sample_rate=settings.SLOW_REQUEST_SAMPLE_RATE,
+)
 app.include_router(api_router, prefix="/api/v1")
 
 
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Prometheus scrape endpoint."""
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
@@ -0,0 +1,237 @@
+import time
+from typing import Any, AsyncIterator, Callable, Iterator, Optional
+
+from anyio import to_thread
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+from sqlalchemy import event
+
+from .database import engine
+from .hashing import password_hasher
+from .history import history_writer
+from .rate_limit import rate_limiter
+
+# Seconds, from fast cache hits up to long answers
+_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+_SIZE_BUCKETS = tuple(2**n for n in range(6, 27, 2))
+_COUNT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+_THROUGHPUT_BUCKETS = tuple(2**n for n in range(14, 31, 2))
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time from receiving a request to sending the last byte of its response",
+    ["method", "route", "status"],
+    buckets=_LATENCY_BUCKETS,
+)
+CHAT_DIFY_TTFB = Histogram(
+    "chat_dify_ttfb_seconds",
+    "Time from sending a chat request to Dify to its first byte of answer",
+    buckets=_LATENCY_BUCKETS,
+)
+CHAT_CLIENT_TTFB = Histogram(
+    "chat_client_ttfb_seconds",
+    "Time from receiving /chat to sending its first byte, by answer source",
+    ["source"],
+    buckets=_LATENCY_BUCKETS,
+)
+STREAM_BYTES = Histogram(
+    "stream_bytes", "Bytes sent per streamed response", ["route"], buckets=_SIZE_BUCKETS
+)
+STREAM_EVENTS = Histogram(
+    "stream_events",
+    "Events (SSE frames or NDJSON lines) sent per streamed response",
+    ["route"],
+    buckets=_COUNT_BUCKETS,
+)
+ACTIVE_STREAMS = Gauge("active_streams", "Responses currently streaming", ["route"])
+UPLOAD_BYTES = Counter("dify_upload_bytes_total", "Bytes uploaded to Dify")
+UPLOAD_THROUGHPUT = Histogram(
+    "dify_upload_throughput_bytes_per_second",
+    "Throughput of each file upload to Dify",
+    buckets=_THROUGHPUT_BUCKETS,
+)
+DB_POOL_CHECKOUTS = Counter(
+    "db_pool_checkouts_total", "Connections checked out of the SQLAlchemy pool"
+)
+
+
+@event.listens_for(engine.sync_engine, "checkout")
+def _count_checkout(*args: Any) -> None:
+    DB_POOL_CHECKOUTS.inc()
+
+
+class MetricsMiddleware:
+    """Times every HTTP request and labels it with its route template.
+
+    Plain ASGI rather than BaseHTTPMiddleware, so streamed responses pass
+    through untouched and are timed until their last byte.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        # Read back as request.state.started
+        scope.setdefault("state", {})["started"] = started
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # Templates such as /api/v1/documents/jobs/{job_id} keep the
+            # number of label values bounded
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_LATENCY.labels(scope["method"], route, str(status)).observe(
+                time.perf_counter() - started
+            )
+
+
+async def observe_stream(
+    body: AsyncIterator[Any],
+    route: str,
+    started: float,
+    first_byte: Optional[Histogram] = None,
+) -> AsyncIterator[Any]:
+    """Count the bytes and events of a streamed response body, and time its
+    first byte from ``started`` (a ``time.perf_counter()`` value)."""
+    active = ACTIVE_STREAMS.labels(route)
+    active.inc()
+    size = events = 0
+    try:
+        async for chunk in body:
+            if not events and first_byte is not None:
+                first_byte.observe(time.perf_counter() - started)
+            events += 1
+            size += len(chunk)
+            yield chunk
+    finally:
+        active.dec()
+        STREAM_BYTES.labels(route).observe(size)
+        STREAM_EVENTS.labels(route).observe(events)
+
+
+async def observe_first_chunk(
+    chunks: AsyncIterator[bytes], started: float, observe: Callable[[float], Any]
+) -> AsyncIterator[bytes]:
+    """Pass ``chunks`` through, calling ``observe`` with the seconds from
+    ``started`` to the first one."""
+    first = True
+    async for chunk in chunks:
+        if first:
+            observe(time.perf_counter() - started)
+            first = False
+        yield chunk
+
+
+def observe_upload(size: Optional[int], seconds: float) -> None:
+    """Record one file forwarded to Dify."""
+    if size:
+        UPLOAD_BYTES.inc(size)
+        if seconds > 0:
+            UPLOAD_THROUGHPUT.observe(size / seconds)
+
+
+class _PoolCollector(Collector):
+    """Connection pool, worker pool and queue metrics, read when scraped."""
+
+    def collect(self) -> Iterator[Any]:
+        pool = engine.pool
+        # Only QueuePool (PostgreSQL) has a fixed size and overflow
+        for name, doc, method in (
+            ("db_pool_size", "Connections the pool keeps open", "size"),
+            ("db_pool_checked_out", "Connections in use", "checkedout"),
+            ("db_pool_overflow", "Connections open beyond the pool size", "overflow"),
+        ):
+            if hasattr(pool, method):
+                yield GaugeMetricFamily(name, doc, value=getattr(pool, method)())
+
+        try:
+            # Threads behind run_in_threadpool; needs the running event loop
+            limiter = to_thread.current_default_thread_limiter()
+        except Exception:
+            limiter = None
+        if limiter is not None:
+            yield GaugeMetricFamily(
+                "threadpool_threads_limit",
+                "Maximum threads for run_in_threadpool",
+                value=limiter.total_tokens,
+            )
+            yield GaugeMetricFamily(
+                "threadpool_threads_in_use",
+                "Threads busy with run_in_threadpool calls",
+                value=limiter.borrowed_tokens,
+            )
+            yield GaugeMetricFamily(
+                "threadpool_tasks_waiting",
+                "Calls waiting for a free thread",
+                value=limiter.statistics().tasks_waiting,
+            )
+
+        hashing = password_hasher.metrics()
+        yield GaugeMetricFamily(
+            "password_hash_in_flight",
+            "Hashes being computed",
+            value=hashing["in_flight"],
+        )
+        yield GaugeMetricFamily(
+            "password_hash_queued",
+            "Hashes waiting for a worker",
+            value=hashing["queued"],
+        )
+
+        history = history_writer.stats()
+        yield GaugeMetricFamily(
+            "chat_history_queued",
+            "Chat turns waiting to be written",
+            value=history["queued"],
+        )
+        turns = CounterMetricFamily(
+            "chat_history_turns",
+            "Chat turns handed to the history writer, by outcome",
+            labels=["outcome"],
+        )
+        for outcome in ("written", "dropped", "failed"):
+            turns.add_metric([outcome], history[outcome])
+        yield turns
+        yield CounterMetricFamily(
+            "chat_history_batches", "History write batches", value=history["batches"]
+        )
+        yield GaugeMetricFamily(
+            "chat_history_last_flush_seconds",
+            "Duration of the latest history write",
+            value=history["last_flush_ms"] / 1000,
+        )
+
+        limits = rate_limiter.stats()
+        yield CounterMetricFamily(
+            "rate_limit_admitted",
+            "Requests admitted by the rate limiter",
+            value=limits["admitted"],
+        )
+        limited = CounterMetricFamily(
+            "rate_limit_rejected",
+            "Requests rejected with 429, by limit",
+            labels=["limit"],
+        )
+        for limit, count in limits["limited"].items():
+            limited.add_metric([limit], count)
+        yield limited
+
+
+REGISTRY.register(_PoolCollector())
+
+
+def render() -> bytes:
+    """Every metric in the Prometheus text format."""
+    return generate_latest(REGISTRY)
@@ -1,8 +1,45 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean
+from sqlalchemy import (
+    JSON,
+    BigInteger,
+    Column,
+    Integer,
+    String,
+    DateTime,
+    Boolean,
+    Float,
+    ForeignKey,
+    Index,
+    Text,
+    TypeDecorator,
+    UniqueConstraint,
+)
+from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
+from .config import settings
 from .database import Base
 
 
+class EmbeddingVector(TypeDecorator):
+    """pgvector ``vector(dim)`` on PostgreSQL, a JSON list elsewhere (tests)."""
+
+    impl = JSON
+    cache_ok = True
+
+    def __init__(self, dim: int):
+        super().__init__()
+        self.dim = dim
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            from pgvector.sqlalchemy import Vector
+
+            return dialect.type_descriptor(Vector(self.dim))
+        return dialect.type_descriptor(JSON())
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else [float(v) for v in value]
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -11,6 +48,8 @@ class User(Base):
     email = Column(String, unique=True, index=True, nullable=False)
     hashed_password = Column(String, nullable=False)
     is_active = Column(Boolean, default=True)
+    # Bumped to revoke every access token issued so far
+    token_version = Column(Integer, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
 
@@ -21,3 +60,182 @@ class DifyConfig(Base):
     id = Column(Integer, primary_key=True, index=True)
     api_url = Column(String, unique=True, index=True)
     api_key = Column(String)
+    # Share of traffic relative to the other backends
+    weight = Column(Integer, nullable=False, default=1, server_default="1")
+    enabled = Column(Boolean, nullable=False, default=True, server_default="true")
+    # Bumped on every change so workers can tell stale snapshots apart
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+
+class Conversation(Base):
+    __tablename__ = "conversations"
+    __table_args__ = (
+        UniqueConstraint("user_id", "client_id", name="uq_conversations_user_client"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=False)
+    # Id the browser uses for the conversation
+    client_id = Column(String, nullable=False)
+    # Real conversation id assigned by Dify on the first answer
+    dify_conversation_id = Column(String, index=True)
+    # dify_configs row of the backend that owns that conversation
+    dify_backend_id = Column(Integer)
+    title = Column(String)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+    messages = relationship(
+        "Message", back_populates="conversation", order_by="Message.id"
+    )
+
+
+class Message(Base):
+    __tablename__ = "messages"
+
+    id = Column(Integer, primary_key=True, index=True)
+    conversation_id = Column(
+        Integer, ForeignKey("conversations.id"), index=True, nullable=False
+    )
+    role = Column(String, nullable=False)  # "user" or "assistant"
+    content = Column(Text, nullable=False)
+    dify_message_id = Column(String)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    conversation = relationship("Conversation", back_populates="messages")
+
+
+class Document(Base):
+    __tablename__ = "documents"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    filename = Column(String, nullable=False)
+    content_type = Column(String)
+    dify_file_id = Column(String, index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    chunks = relationship(
+        "DocumentChunk", back_populates="document", order_by="DocumentChunk.chunk_index"
+    )
+
+
+class DocumentChunk(Base):
+    __tablename__ = "document_chunks"
+    __table_args__ = (
+        # Approximate nearest-neighbour index for cosine distance
+        Index(
+            "ix_document_chunks_embedding_hnsw",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_with={"m": 16, "ef_construction": 64},
+            postgresql_ops={"embedding": "vector_cosine_ops"},
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    document_id = Column(
+        Integer, ForeignKey("documents.id", ondelete="CASCADE"), index=True
+    )
+    chunk_index = Column(Integer, nullable=False)
+    content = Column(Text, nullable=False)
+    embedding = Column(EmbeddingVector(settings.EMBEDDING_DIM), nullable=False)
+
+    document = relationship("Document", back_populates="chunks")
+
+
+class DifyUpload(Base):
+    """Dify's response to a file upload, keyed by the file's SHA-256 and the
+    end user it was uploaded for."""
+
+    __tablename__ = "dify_uploads"
+    __table_args__ = (
+        UniqueConstraint(
+            "content_hash",
+            "dify_app",
+            "dify_user",
+            name="uq_dify_uploads_hash_app_user",
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    content_hash = Column(String(64), nullable=False)
+    # Fingerprint of the Dify URL and API key the file was uploaded with
+    dify_app = Column(String(64), nullable=False)
+    # The "user" the file was uploaded as; Dify files belong to that user
+    dify_user = Column(String, nullable=False)
+    size = Column(BigInteger)
+    dify_file_id = Column(String, index=True)
+    response = Column(JSON, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class IngestJob(Base):
+    """A document upload spooled to disk, waiting to be forwarded to Dify."""
+
+    __tablename__ = "ingest_jobs"
+    __table_args__ = (
+        Index("ix_ingest_jobs_state_next_attempt", "state", "next_attempt_at"),
+    )
+
+    id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=False)
+    username = Column(String, nullable=False)
+    filename = Column(String, nullable=False)
+    content_type = Column(String)
+    spool_path = Column(String, nullable=False)
+    bytes = Column(BigInteger, nullable=False)
+    # "queued", "running", "done" or "failed"
+    state = Column(String, nullable=False, default="queued")
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+    dify_file = Column(JSON)
+    deduplicated = Column(Boolean, nullable=False, default=False)
+    timings = Column(JSON)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False)
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+    # Which queue holds a running job, and until when it is assumed alive
+    lease_owner = Column(String)
+    lease_expires_at = Column(DateTime(timezone=True))
+
+
+class RateLimitBucket(Base):
+    """Token bucket of one user and scope, for the shared rate limiter."""
+
+    __tablename__ = "rate_limit_buckets"
+
+    key = Column(String, primary_key=True)
+    tokens = Column(Float, nullable=False)
+    # Seconds since the epoch, by the database clock
+    updated_at = Column(Float, nullable=False)
+
+
+class RateLimitLease(Base):
+    """An open stream counted against its user's concurrency limit."""
+
+    __tablename__ = "rate_limit_leases"
+
+    id = Column(String, primary_key=True)
+    key = Column(String, index=True, nullable=False)
+    expires_at = Column(Float, nullable=False)
+
+
+class AuthSession(Base):
+    """A refresh token; only its SHA-256 is stored.
+
+    Each refresh rotates the token: the new hash replaces the old one, which
+    is kept as ``previous_hash`` so a replayed token can be recognised.
+    """
+
+    __tablename__ = "auth_sessions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=False)
+    token_hash = Column(String(64), unique=True, index=True, nullable=False)
+    previous_hash = Column(String(64), index=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    last_used_at = Column(DateTime(timezone=True), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+    revoked_at = Column(DateTime(timezone=True))
@@ -0,0 +1,277 @@
+import abc
+import logging
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+import anyio
+from fastapi import HTTPException
+from sqlalchemy import text
+from starlette.responses import StreamingResponse
+
+from .cache import TTLCache
+from .config import settings
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitBackend(abc.ABC):
+    """Where token buckets and open-stream leases are kept."""
+
+    @abc.abstractmethod
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        """Take one token; returns 0 if admitted, else seconds until one
+        is available."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def acquire(self, key: str, limit: int, ttl: float) -> Optional[str]:
+        """Open a lease if fewer than ``limit`` are open; None otherwise.
+
+        Leases expire after ``ttl`` seconds in case one is never released.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def release(self, key: str, lease: str) -> None:
+        raise NotImplementedError
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """Per-process limits; with several workers each enforces its own."""
+
+    def __init__(self, maxsize: int = 100_000):
+        # A bucket that dropped out of the cache would have been full anyway
+        self._buckets: TTLCache[Tuple[float, float]] = TTLCache(maxsize, ttl=60)
+        self._leases: Dict[str, Dict[str, float]] = {}
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        now = time.monotonic()
+        tokens, updated = self._buckets.get(key) or (burst, now)
+        tokens = min(burst, tokens + (now - updated) * rate)
+        if tokens < 1:
+            self._buckets.set(key, (tokens, now), ttl=burst / rate)
+            return (1 - tokens) / rate
+        self._buckets.set(key, (tokens - 1, now), ttl=burst / rate)
+        return 0.0
+
+    async def acquire(self, key: str, limit: int, ttl: float) -> Optional[str]:
+        now = time.monotonic()
+        leases = {
+            lease: expires
+            for lease, expires in self._leases.get(key, {}).items()
+            if expires > now
+        }
+        if len(leases) >= limit:
+            self._leases[key] = leases
+            return None
+        lease = uuid.uuid4().hex
+        leases[lease] = now + ttl
+        self._leases[key] = leases
+        return lease
+
+    async def release(self, key: str, lease: str) -> None:
+        leases = self._leases.get(key)
+        if leases is not None:
+            leases.pop(lease, None)
+            if not leases:
+                del self._leases[key]
+
+
+# Tokens in bucket row "b" once refilled up to the database's current time
+_REFILLED = (
+    "LEAST(CAST(:burst AS float8), b.tokens + "
+    "(extract(epoch FROM now()) - b.updated_at) * CAST(:rate AS float8))"
+)
+# Takes a token only if one is available; returns no row otherwise
+_TAKE_TOKEN = text(
+    "INSERT INTO rate_limit_buckets AS b (key, tokens, updated_at) "
+    "VALUES (:key, CAST(:burst AS float8) - 1, extract(epoch FROM now())) "
+    f"ON CONFLICT (key) DO UPDATE SET tokens = {_REFILLED} - 1, "
+    "updated_at = extract(epoch FROM now()) "
+    f"WHERE {_REFILLED} >= 1 RETURNING b.tokens"
+)
+_PEEK_TOKENS = text(f"SELECT {_REFILLED} FROM rate_limit_buckets AS b WHERE key = :key")
+
+
+class PostgresRateLimitBackend(RateLimitBackend):
+    """Limits shared by every worker, kept in the application database.
+
+    Costs one or two round trips per admitted request; buckets are updated
+    with a single conditional upsert and leases are counted under a
+    transaction-scoped advisory lock, both using the database clock.
+    """
+
+    def __init__(self):
+        self.session_factory = SessionLocal
+
+    async def take(self, key: str, rate: float, burst: float) -> float:
+        params = {"key": key, "rate": rate, "burst": burst}
+        async with self.session_factory() as db:
+            result = await db.execute(_TAKE_TOKEN, params)
+            admitted = result.first() is not None
+            if not admitted:
+                result = await db.execute(_PEEK_TOKENS, params)
+                tokens = result.scalar() or 0.0
+            await db.commit()
+        return 0.0 if admitted else max((1 - tokens) / rate, 0.0)
+
+    async def acquire(self, key: str, limit: int, ttl: float) -> Optional[str]:
+        async with self.session_factory() as db:
+            await db.execute(
+                text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": key}
+            )
+            await db.execute(
+                text(
+                    "DELETE FROM rate_limit_leases "
+                    "WHERE key = :key AND expires_at < extract(epoch FROM now())"
+                ),
+                {"key": key},
+            )
+            result = await db.execute(
+                text("SELECT count(*) FROM rate_limit_leases WHERE key = :key"),
+                {"key": key},
+            )
+            if result.scalar() >= limit:
+                await db.commit()
+                return None
+            lease = uuid.uuid4().hex
+            await db.execute(
+                text(
+                    "INSERT INTO rate_limit_leases (id, key, expires_at) VALUES "
+                    "(:id, :key, extract(epoch FROM now()) + CAST(:ttl AS float8))"
+                ),
+                {"id": lease, "key": key, "ttl": ttl},
+            )
+            await db.commit()
+        return lease
+
+    async def release(self, key: str, lease: str) -> None:
+        async with self.session_factory() as db:
+            await db.execute(
+                text("DELETE FROM rate_limit_leases WHERE id = :id"), {"id": lease}
+            )
+            await db.commit()
+
+
+class StreamLease:
+    """One of a user's open streams; released when the response ends."""
+
+    def __init__(self, limiter: "RateLimiter", key: str, lease: Optional[str]):
+        self._limiter = limiter
+        self._key = key
+        self._lease = lease
+
+    async def release(self) -> None:
+        """Give the slot back; safe to call more than once."""
+        lease, self._lease = self._lease, None
+        if lease is not None:
+            try:
+                await self._limiter.backend.release(self._key, lease)
+            except Exception as e:
+                # The lease expires on its own
+                logger.warning("⚠️ Could not release stream lease: %s", e)
+
+    def attach(self, response: StreamingResponse) -> StreamingResponse:
+        """Hold the lease until ``response`` has finished streaming."""
+        response.body_iterator = self._hold(response.body_iterator)
+        return response
+
+    async def _hold(self, body: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            # A client disconnect cancels the stream's task group; without the
+            # shield a release that awaits would be cancelled too
+            with anyio.CancelScope(shield=True):
+                await self.release()
+
+
+class RateLimiter:
+    """Per-user admission control for /chat and /documents.
+
+    Each scope has a token bucket (``rate`` requests per second, bursts of
+    up to ``burst``), and streaming responses additionally need one of the
+    user's ``max_streams`` slots. Requests over either limit get a 429 with
+    Retry-After.
+    """
+
+    def __init__(
+        self,
+        enabled: bool,
+        backend: RateLimitBackend,
+        limits: Dict[str, Tuple[float, float]],
+        max_streams: int,
+        stream_ttl: float,
+    ):
+        self.enabled = enabled
+        self.backend = backend
+        self.limits = limits
+        self.max_streams = max_streams
+        self.stream_ttl = stream_ttl
+        self.admitted = 0
+        self.limited: Dict[str, int] = {"rate": 0, "streams": 0}
+
+    @staticmethod
+    def _reject(detail: str, retry_after: float) -> HTTPException:
+        return HTTPException(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(max(int(retry_after + 0.999), 1))},
+        )
+
+    async def check(self, scope: str, username: str) -> None:
+        """Take a token from the user's bucket for ``scope``, or raise 429."""
+        if not self.enabled:
+            return
+        rate, burst = self.limits[scope]
+        wait = await self.backend.take(f"{scope}:{username}", rate, burst)
+        if wait > 0:
+            self.limited["rate"] += 1
+            logger.info("🚦 Rate limited %s on %s", username, scope)
+            raise self._reject("Too many requests, please slow down", wait)
+        self.admitted += 1
+
+    async def open_stream(self, username: str) -> StreamLease:
+        """Claim one of the user's concurrent stream slots, or raise 429."""
+        key = f"streams:{username}"
+        if not self.enabled:
+            return StreamLease(self, key, None)
+        lease = await self.backend.acquire(key, self.max_streams, self.stream_ttl)
+        if lease is None:
+            self.limited["streams"] += 1
+            logger.info("🚦 %s has too many open streams", username)
+            raise self._reject(
+                f"Too many concurrent streams (limit {self.max_streams})", 1
+            )
+        return StreamLease(self, key, lease)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "admitted": self.admitted,
+            "limited": dict(self.limited),
+        }
+
+
+def _build_backend(name: str) -> RateLimitBackend:
+    if name == "postgres":
+        return PostgresRateLimitBackend()
+    if name != "memory":
+        logger.warning("⚠️ Unknown RATE_LIMIT_BACKEND %r, using memory", name)
+    return MemoryRateLimitBackend()
+
+
+rate_limiter = RateLimiter(
+    enabled=settings.RATE_LIMIT_ENABLED,
+    backend=_build_backend(settings.RATE_LIMIT_BACKEND),
+    limits={
+        "chat": (settings.RATE_LIMIT_CHAT_RATE, settings.RATE_LIMIT_CHAT_BURST),
+        "upload": (settings.RATE_LIMIT_UPLOAD_RATE, settings.RATE_LIMIT_UPLOAD_BURST),
+    },
+    max_streams=settings.RATE_LIMIT_MAX_STREAMS,
+    stream_ttl=settings.RATE_LIMIT_STREAM_TTL,
+)
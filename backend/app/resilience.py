@@ -0,0 +1,149 @@
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a backend whose circuit is open."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Circuit open, retry in {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a failed call may succeed on retry, and counts against the
+    backend's circuit: connection errors, timeouts, 429 and 5xx."""
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        return status >= 500 or status == 429
+    return isinstance(error, httpx.TransportError)
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker for one backend.
+
+    Closed, calls go through until ``failure_threshold`` fail in a row.
+    Open, calls are rejected for ``reset_timeout`` seconds. Half-open, a
+    single trial call is let through: success closes the circuit, failure
+    opens it again.
+    """
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self.rejected = 0
+        self._trial = False
+
+    def retry_after(self) -> float:
+        """Seconds until an open circuit lets a trial call through."""
+        if self.state != OPEN:
+            return 0.0
+        return max(self.opened_at + self.reset_timeout - time.monotonic(), 0.0)
+
+    def available(self) -> bool:
+        """Whether a call would be allowed, without claiming it."""
+        if self.state == OPEN:
+            return self.retry_after() <= 0
+        if self.state == HALF_OPEN:
+            return not self._trial
+        return True
+
+    def allow(self) -> bool:
+        """Claim a call; False if the circuit rejects it."""
+        if not self.available():
+            self.rejected += 1
+            return False
+        if self.state == OPEN:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            self._trial = True
+        return True
+
+    def record_success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self._trial = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._trial = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.opens += 1
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+
+    def record_cancelled(self) -> None:
+        """The call was abandoned without an outcome (e.g. a lost hedge)."""
+        self._trial = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "opens": self.opens,
+            "rejected": self.rejected,
+            "retry_after": round(self.retry_after(), 1),
+        }
+
+
+class RetryBudget:
+    """Limits retries to a fraction of recent traffic.
+
+    Every request deposits ``ratio`` of a token and every retry (or hedge)
+    spends one; ``min_per_second`` tokens trickle in regardless so that low
+    traffic can still retry. At most ``burst`` tokens are kept. When Dify is
+    failing everywhere this caps the extra load at about ``ratio`` instead
+    of multiplying it by the number of attempts.
+    """
+
+    def __init__(self, ratio: float, min_per_second: float, burst: float):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.burst = burst
+        self.tokens = burst
+        self.requests = 0
+        self.retries = 0
+        self.exhausted = 0
+        self._refilled_at: Optional[float] = None
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if self._refilled_at is not None:
+            elapsed = now - self._refilled_at
+            self.tokens = min(self.tokens + elapsed * self.min_per_second, self.burst)
+        self._refilled_at = now
+
+    def record_request(self) -> None:
+        self._refill()
+        self.requests += 1
+        self.tokens = min(self.tokens + self.ratio, self.burst)
+
+    def try_acquire(self) -> bool:
+        """Spend a token for one retry; False if the budget is used up."""
+        self._refill()
+        if self.tokens < 1:
+            self.exhausted += 1
+            return False
+        self.tokens -= 1
+        self.retries += 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        self._refill()
+        return {
+            "tokens": round(self.tokens, 2),
+            "requests": self.requests,
+            "retries": self.retries,
+            "exhausted": self.exhausted,
+        }
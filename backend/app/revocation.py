@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import time
+from typing import Any, Dict, Optional, Set
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import settings
+from .database import SessionLocal
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+
+class TokenRevocations:
+    """Which stateless access tokens are no longer valid, kept in memory.
+
+    Tokens carry the user's ``token_version`` at issue time. Revoking bumps
+    the version in the database, so only users who ever revoked (or were
+    deactivated) need an entry here; the set is reloaded every ``interval``
+    seconds to pick up changes made by other workers.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.session_factory = SessionLocal
+        # user id -> oldest token version still accepted
+        self._min_versions: Dict[int, int] = {}
+        self._inactive: Set[int] = set()
+        self._refreshed_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def loaded(self) -> bool:
+        """Whether the set has been read from the database at least once."""
+        return self._refreshed_at is not None
+
+    def is_revoked(self, user_id: int, version: int) -> bool:
+        if user_id in self._inactive:
+            return True
+        return version < self._min_versions.get(user_id, 0)
+
+    def apply(
+        self,
+        user_id: int,
+        version: Optional[int] = None,
+        is_active: Optional[bool] = None,
+    ) -> None:
+        """Record a change to a user ahead of the next refresh."""
+        if version:
+            current = self._min_versions.get(user_id, 0)
+            self._min_versions[user_id] = max(version, current)
+        if is_active is True:
+            self._inactive.discard(user_id)
+        elif is_active is False:
+            self._inactive.add(user_id)
+
+    async def refresh(self) -> None:
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(User.id, User.token_version, User.is_active).where(
+                    or_(User.token_version > 0, User.is_active.is_(False))
+                )
+            )
+            rows = result.all()
+        # Versions only grow, so a revoke applied locally while this query
+        # ran is not undone by it
+        self._min_versions = {
+            row.id: max(row.token_version, self._min_versions.get(row.id, 0))
+            for row in rows
+        }
+        self._inactive = {row.id for row in rows if not row.is_active}
+        self._refreshed_at = time.monotonic()
+
+    async def revoke(self, db: AsyncSession, user_id: int) -> int:
+        """Invalidate every token issued to a user so far; returns the new
+        token version."""
+        result = await db.execute(
+            update(User)
+            .where(User.id == user_id)
+            .values(token_version=User.token_version + 1)
+            .returning(User.token_version, User.is_active)
+        )
+        version, is_active = result.one()
+        await db.commit()
+        self.apply(user_id, version, is_active)
+        return version
+
+    async def start(self) -> None:
+        """Load the set and keep it fresh; called from the startup hook."""
+        try:
+            await self.refresh()
+        except Exception as e:
+            # Until loaded, every request falls back to the database
+            logger.warning("⚠️ Could not load token revocations: %s", e)
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop refreshing; called from the shutdown hook."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.warning("⚠️ Could not refresh token revocations: %s", e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "loaded": self.loaded,
+            "revoked_users": len(self._min_versions),
+            "inactive_users": len(self._inactive),
+            "age_seconds": (
+                round(time.monotonic() - self._refreshed_at, 1)
+                if self._refreshed_at is not None
+                else None
+            ),
+        }
+
+
+token_revocations = TokenRevocations(interval=settings.AUTH_REVOCATION_REFRESH)
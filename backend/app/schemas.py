@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Any, Dict, Optional
 from pydantic import BaseModel
 from datetime import datetime
 
@@ -30,7 +30,49 @@ class UserResponse(UserBase):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 
 class TokenData(BaseModel):
     username: Optional[str] = None
+
+
+class ConversationResponse(BaseModel):
+    id: str
+    title: Optional[str] = None
+    dify_conversation_id: Optional[str] = None
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+
+class MessageResponse(BaseModel):
+    role: str
+    content: str
+    created_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
+class IngestJobResponse(BaseModel):
+    id: str
+    state: str
+    filename: str
+    content_type: Optional[str] = None
+    bytes: int
+    attempts: int
+    error: Optional[str] = None
+    dify_file: Optional[Dict[str, Any]] = None
+    deduplicated: bool = False
+    timings: Optional[Dict[str, float]] = None
+    created_at: datetime
+    next_attempt_at: Optional[datetime] = None
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
@@ -0,0 +1,132 @@
+import hashlib
+import logging
+import secrets
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .config import settings
+from .database import as_utc, utcnow
+from .models import AuthSession, User
+
+logger = logging.getLogger(__name__)
+
+
+def hash_refresh_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+async def create_session(db: AsyncSession, user_id: int) -> str:
+    """Start a session for a user who just logged in; returns its refresh
+    token."""
+    now = utcnow()
+    # The user's expired sessions are dropped while we're here
+    await db.execute(
+        delete(AuthSession).where(
+            AuthSession.user_id == user_id, AuthSession.expires_at <= now
+        )
+    )
+    token = secrets.token_urlsafe(32)
+    db.add(
+        AuthSession(
+            user_id=user_id,
+            token_hash=hash_refresh_token(token),
+            created_at=now,
+            last_used_at=now,
+            expires_at=now + timedelta(days=settings.REFRESH_TOKEN_EXPIRE_DAYS),
+        )
+    )
+    await db.commit()
+    return token
+
+
+async def rotate_session(db: AsyncSession, token: str) -> Optional[Tuple[User, str]]:
+    """Exchange a refresh token for a new one; returns the session's user and
+    the new token, or None if the token is not valid.
+
+    Costs one indexed lookup and one update by primary key. Replaying a
+    token that was already rotated revokes its session, since the token or
+    its successor has leaked.
+    """
+    token_hash = hash_refresh_token(token)
+    now = utcnow()
+    result = await db.execute(
+        select(AuthSession, User)
+        .join(User, User.id == AuthSession.user_id)
+        .where(AuthSession.token_hash == token_hash)
+    )
+    row = result.first()
+    if row is None:
+        await _revoke_replayed(db, token_hash, now)
+        return None
+    session, user = row
+    if (
+        session.revoked_at is not None
+        or as_utc(session.expires_at) <= now
+        or not user.is_active
+    ):
+        return None
+
+    new_token = secrets.token_urlsafe(32)
+    # Only one of several concurrent refreshes with the same token wins
+    result = await db.execute(
+        update(AuthSession)
+        .where(AuthSession.id == session.id, AuthSession.token_hash == token_hash)
+        .values(
+            token_hash=hash_refresh_token(new_token),
+            previous_hash=token_hash,
+            last_used_at=now,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        await db.rollback()
+        return None
+    await db.commit()
+    return user, new_token
+
+
+async def _revoke_replayed(db: AsyncSession, token_hash: str, now: datetime) -> None:
+    result = await db.execute(
+        select(AuthSession).where(AuthSession.previous_hash == token_hash)
+    )
+    session = result.scalars().first()
+    if session is None or session.revoked_at is not None:
+        return
+    # Two tabs refreshing at once look like a replay; let that pass
+    grace = timedelta(seconds=settings.REFRESH_TOKEN_REUSE_GRACE)
+    if now - as_utc(session.last_used_at) < grace:
+        return
+    session.revoked_at = now
+    await db.commit()
+    logger.warning(
+        "🚨 Rotated refresh token of session %s was reused; session revoked",
+        session.id,
+    )
+
+
+async def revoke_session(db: AsyncSession, token: str) -> bool:
+    """End the session of a refresh token; False if there was none."""
+    result = await db.execute(
+        update(AuthSession)
+        .where(
+            AuthSession.token_hash == hash_refresh_token(token),
+            AuthSession.revoked_at.is_(None),
+        )
+        .values(revoked_at=utcnow())
+    )
+    await db.commit()
+    return result.rowcount > 0
+
+
+async def revoke_user_sessions(db: AsyncSession, user_id: int) -> int:
+    """End every session of a user; returns how many were open."""
+    result = await db.execute(
+        update(AuthSession)
+        .where(AuthSession.user_id == user_id, AuthSession.revoked_at.is_(None))
+        .values(revoked_at=utcnow())
+    )
+    await db.commit()
+    return result.rowcount
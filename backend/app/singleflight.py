@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+class Flight:
+    """One upstream stream fanned out to any number of subscribers.
+
+    Every subscriber first receives the frames already emitted, then the live
+    tail. ``answer`` is filled in by the producer once the stream completes.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.frames: List[bytes] = []
+        self.answer = ""
+        self.done = False
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+
+    def publish(self, frame: bytes) -> None:
+        self.frames.append(frame)
+        self._notify()
+
+    def finish(self) -> None:
+        self.done = True
+        self._notify()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self) -> AsyncIterator[bytes]:
+        """Replay emitted frames, then follow the stream until it ends."""
+        self.subscribers += 1
+        position = 0
+        while True:
+            while position < len(self.frames):
+                yield self.frames[position]
+                position += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+
+class SingleFlight:
+    """Deduplicates identical in-flight upstream streams by key."""
+
+    def __init__(self):
+        self._flights: Dict[str, Flight] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self.leaders = 0
+        self.followers = 0
+
+    def join(self, key: str) -> Optional[Flight]:
+        """Return the in-flight stream for ``key``, if there is one."""
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.followers += 1
+        return flight
+
+    def begin(self, key: str) -> Flight:
+        """Register a new flight before the upstream request is sent, so
+        identical requests arriving during the connect phase can join it."""
+        flight = Flight(key)
+        self._flights[key] = flight
+        self.leaders += 1
+        return flight
+
+    def run(
+        self,
+        flight: Flight,
+        frames: AsyncIterator[bytes],
+        cleanup: Optional[Callable[[], Awaitable[Any]]] = None,
+    ) -> None:
+        """Drive ``frames`` in a background task, independent of any one
+        client, publishing each frame to the flight's subscribers."""
+        task = asyncio.create_task(self._drive(flight, frames, cleanup))
+        # Keep a strong reference until the task finishes
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def abort(self, flight: Flight, frame: Optional[bytes] = None) -> None:
+        """End a flight whose upstream could not be started."""
+        if frame is not None:
+            flight.publish(frame)
+        self._end(flight)
+
+    async def _drive(
+        self,
+        flight: Flight,
+        frames: AsyncIterator[bytes],
+        cleanup: Optional[Callable[[], Awaitable[Any]]],
+    ) -> None:
+        try:
+            async for frame in frames:
+                flight.publish(frame)
+        except Exception as e:
+            logger.error("❌ Upstream stream for single-flight failed: %s", e)
+        finally:
+            self._end(flight)
+            if cleanup is not None:
+                await cleanup()
+
+    def _end(self, flight: Flight) -> None:
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+        flight.finish()
+
+    def stats(self) -> Dict[str, Any]:
+        """In-flight count and leader/follower counters."""
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "followers": self.followers,
+        }
+
+
+single_flight = SingleFlight()
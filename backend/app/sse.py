@@ -0,0 +1,179 @@
+import asyncio
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Streamed answer deltas that may be merged into a single frame
+TEXT_EVENTS = frozenset({"text_chunk", "message", "agent_message"})
+
+# Fields the chat UI actually reads; everything else is dropped on the wire
+CLIENT_FIELDS = frozenset(
+    {"event", "answer", "retriever_results", "status", "code", "message"}
+)
+
+_END = object()
+
+
+class SSEParser:
+    """Incremental parser for a text/event-stream body.
+
+    Bytes may be fed in arbitrary pieces; an event split across two chunks is
+    only emitted once its terminating blank line has arrived.
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        # A trailing "\r" held back in case its "\n" is in the next chunk
+        self._cr = False
+
+    def feed(self, chunk: bytes) -> List[Dict[str, Any]]:
+        """Consume bytes and return every event completed by them."""
+        if self._cr:
+            chunk = b"\r" + chunk
+        self._cr = chunk.endswith(b"\r")
+        if self._cr:
+            chunk = chunk[:-1]
+        self._buffer += chunk.replace(b"\r\n", b"\n")
+        events = []
+        while True:
+            block, sep, rest = self._buffer.partition(b"\n\n")
+            if not sep:
+                break
+            self._buffer = rest
+            event = self._parse_block(block)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """Parse whatever is left once the stream has ended."""
+        block, self._buffer = self._buffer, b""
+        self._cr = False
+        event = self._parse_block(block)
+        return [event] if event is not None else []
+
+    @staticmethod
+    def _parse_block(block: bytes) -> Optional[Dict[str, Any]]:
+        data = [
+            line[5:].lstrip(b" ")
+            for line in block.split(b"\n")
+            if line.startswith(b"data:")
+        ]
+        if not data:
+            # Comments and bare "event: ping" keep-alives carry no payload
+            return None
+        try:
+            event = json.loads(b"\n".join(data))
+        except ValueError:
+            logger.warning("⚠️ Dropping unparsable SSE event: %r", block[:200])
+            return None
+        return event if isinstance(event, dict) else None
+
+
+async def iter_sse_events(
+    chunks: AsyncIterator[bytes],
+) -> AsyncIterator[Dict[str, Any]]:
+    """Turn a stream of raw bytes into parsed SSE JSON events."""
+    parser = SSEParser()
+    async for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.flush():
+        yield event
+
+
+def format_sse(event: Dict[str, Any]) -> bytes:
+    """Serialize an event as one compact SSE frame with client fields only."""
+    slim = {key: value for key, value in event.items() if key in CLIENT_FIELDS}
+    payload = json.dumps(slim, ensure_ascii=False, separators=(",", ":"))
+    return f"data: {payload}\n\n".encode()
+
+
+async def coalesce_text_events(
+    events: AsyncIterator[Dict[str, Any]], window: float, max_bytes: int
+) -> AsyncIterator[Dict[str, Any]]:
+    """Merge consecutive text deltas into one event per ``window`` seconds.
+
+    The first delta is emitted immediately so time-to-first-token is
+    unchanged. A merged event is flushed when its window elapses, when it
+    reaches ``max_bytes`` of answer text, or as soon as any other event
+    (retriever results, end events, errors) arrives. ``window <= 0`` disables
+    merging.
+    """
+    if window <= 0:
+        async for event in events:
+            yield event
+        return
+
+    # A pump task feeds a queue so waiting for the window never cancels the
+    # upstream iterator mid-read
+    queue: asyncio.Queue = asyncio.Queue(maxsize=256)
+
+    async def pump():
+        try:
+            async for event in events:
+                await queue.put(event)
+        except Exception as e:  # surfaced to the consumer below
+            await queue.put(e)
+        await queue.put(_END)
+
+    loop = asyncio.get_running_loop()
+    pump_task = asyncio.create_task(pump())
+    pending: Optional[Dict[str, Any]] = None
+    pending_bytes = 0
+    deadline = 0.0
+    first_text_sent = False
+    try:
+        while True:
+            if pending is None:
+                item = await queue.get()
+            else:
+                try:
+                    item = await asyncio.wait_for(
+                        queue.get(), max(0.0, deadline - loop.time())
+                    )
+                except asyncio.TimeoutError:
+                    yield pending
+                    pending = None
+                    continue
+
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                if pending is not None:
+                    yield pending
+                    pending = None
+                raise item
+
+            if item.get("event") not in TEXT_EVENTS:
+                if pending is not None:
+                    yield pending
+                    pending = None
+                yield item
+                continue
+
+            if not first_text_sent:
+                first_text_sent = True
+                yield item
+                continue
+
+            answer = item.get("answer") or ""
+            if pending is not None and pending.get("event") == item.get("event"):
+                pending["answer"] = (pending.get("answer") or "") + answer
+                pending_bytes += len(answer.encode())
+            else:
+                if pending is not None:
+                    yield pending
+                pending = dict(item)
+                pending_bytes = len(answer.encode())
+                deadline = loop.time() + window
+            if pending_bytes >= max_bytes:
+                yield pending
+                pending = None
+
+        if pending is not None:
+            yield pending
+    finally:
+        pump_task.cancel()
@@ -0,0 +1,114 @@
+import contextvars
+import json
+import logging
+import random
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Phase name -> seconds, for the request being handled. The dict itself is
+# shared with tasks and threads spawned by the request, which copy the
+# context, so their phases land in the same place.
+_phases: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar(
+    "request_phases", default=None
+)
+
+
+def record(name: str, seconds: float) -> None:
+    """Add ``seconds`` to a phase of the current request, if there is one."""
+    phases = _phases.get()
+    if phases is not None:
+        phases[name] = phases.get(name, 0.0) + seconds
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Time the enclosed block as a phase of the current request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+def server_timing(phases: Dict[str, float]) -> str:
+    """Render phases as a Server-Timing header value."""
+    return ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" for name, seconds in phases.items()
+    )
+
+
+class TimingMiddleware:
+    """Collects named phases per request and reports them.
+
+    Phases recorded before the response starts are sent in a Server-Timing
+    header; phases of a streamed body (upstream_ttfb, stream_total) are only
+    known afterwards and go to the log line alone. Every request gets one
+    ``request_timing`` log line, and requests slower than ``slow_ms`` are
+    logged with a warning for a ``slow_sample_rate`` share of them.
+    """
+
+    def __init__(
+        self,
+        app,
+        log_requests: bool = True,
+        slow_ms: float = 1000.0,
+        slow_sample_rate: float = 1.0,
+    ):
+        self.app = app
+        self.log_requests = log_requests
+        self.slow_ms = slow_ms
+        self.slow_sample_rate = slow_sample_rate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        phases: Dict[str, float] = {}
+        token = _phases.set(phases)
+        started = time.perf_counter()
+        status = 500
+        response_started: Optional[float] = None
+        body_messages = 0
+
+        async def send_with_timing(message):
+            nonlocal status, response_started, body_messages
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                response_started = time.perf_counter()
+                phases["app"] = response_started - started
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(phases).encode()))
+                message = {**message, "headers": headers}
+            elif message["type"] == "http.response.body":
+                body_messages += 1
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _phases.reset(token)
+            finished = time.perf_counter()
+            if response_started is not None and body_messages > 1:
+                phases["stream_total"] = finished - response_started
+            self._log(scope, status, (finished - started) * 1000, phases)
+
+    def _log(
+        self, scope, status: int, total_ms: float, phases: Dict[str, float]
+    ) -> None:
+        slow = total_ms >= self.slow_ms
+        if not (self.log_requests or slow):
+            return
+        entry = {
+            "method": scope["method"],
+            "path": getattr(scope.get("route"), "path", scope["path"]),
+            "status": status,
+            "total_ms": round(total_ms, 1),
+            "phases_ms": {name: round(s * 1000, 1) for name, s in phases.items()},
+        }
+        if slow and random.random() < self.slow_sample_rate:
+            logger.warning("🐢 slow_request %s", json.dumps(entry))
+        elif self.log_requests:
+            logger.info("⏱️ request_timing %s", json.dumps(entry))
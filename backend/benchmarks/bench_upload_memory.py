@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Peak memory benchmark for POST /api/v1/documents.
+
+Each upload size runs in a fresh child process that streams a synthetic file
+through the real FastAPI app into a fake Dify endpoint which discards the
+body. The child reports its peak RSS before and after the upload, so the
+growth can be compared against the upload size.
+
+Usage:
+    python benchmarks/bench_upload_memory.py --sizes 10 50 100 --max-growth 16
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+# Add the backend directory to the Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+MB = 1024 * 1024
+CHUNK = 256 * 1024
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KB on Linux and bytes on macOS
+    return peak / (MB if sys.platform == "darwin" else 1024)
+
+
+async def run_upload(size_mb: int) -> dict:
+    import httpx
+    from app import api
+    from app.auth import get_current_active_user
+    from app.database import init_database
+    from app.main import app
+    from app.models import User
+
+    # Dify config and upload dedup records live in a throwaway SQLite file
+    await init_database()
+
+    received = {"bytes": 0}
+
+    class FakeDify(httpx.AsyncBaseTransport):
+        """Consumes the request body chunk by chunk and discards it.
+
+        httpx.MockTransport reads the whole body up front, which would hide
+        the behaviour being measured.
+        """
+
+        async def handle_async_request(self, request):
+            async for chunk in request.stream:
+                received["bytes"] += len(chunk)
+            return httpx.Response(200, json={"id": "bench-file"})
+
+    dify_client = httpx.AsyncClient(transport=FakeDify())
+    api.dify_clients.get = lambda url: dify_client
+    app.dependency_overrides[get_current_active_user] = lambda: User(
+        id=1, username="bench", email="bench@example.com", is_active=True
+    )
+
+    boundary = "benchboundary"
+    head = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="file"; filename="bench.bin"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    async def body():
+        yield head
+        remaining = size_mb * MB
+        # Binary content, so the upload is forwarded but not text-indexed
+        block = bytes(range(256)) * (CHUNK // 256)
+        while remaining > 0:
+            yield block[: min(CHUNK, remaining)]
+            remaining -= CHUNK
+        yield tail
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://app") as c:
+        await c.post(
+            "/api/v1/dify-config",
+            json={"api_url": "http://fake-dify/v1", "api_key": "bench-key"},
+        )
+        rss_before = peak_rss_mb()
+        response = await c.post(
+            "/api/v1/documents",
+            content=body(),
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"},
+        )
+        rss_after = peak_rss_mb()
+
+    return {
+        "size_mb": size_mb,
+        "status": response.status_code,
+        "forwarded_mb": round(received["bytes"] / MB, 2),
+        "peak_rss_before_mb": round(rss_before, 1),
+        "peak_rss_after_mb": round(rss_after, 1),
+        "peak_rss_growth_mb": round(rss_after - rss_before, 1),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 100])
+    parser.add_argument(
+        "--max-growth",
+        type=float,
+        default=16.0,
+        help="fail if peak RSS grows by more than this many MB for any size",
+    )
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(asyncio.run(run_upload(args.child))))
+        return 0
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            database_url = f"sqlite:///{tmp}/bench-{size}.db"
+            out = subprocess.run(
+                [sys.executable, __file__, "--child", str(size)],
+                check=True,
+                capture_output=True,
+                text=True,
+                env={**os.environ, "APP_DEBUG": "false", "DATABASE_URL": database_url},
+            )
+            results.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    ok = all(
+        r["status"] == 200 and r["peak_rss_growth_mb"] <= args.max_growth
+        for r in results
+    )
+    print(json.dumps({"max_growth_mb": args.max_growth, "ok": ok, "runs": results}))
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the Dify API, for load tests.
+
+Serves the endpoints the backend calls: streamed answers from
+/v1/chat-messages, /v1/files/upload and the /v1/parameters health probe.
+Answers are streamed one token at a time at a configurable rate after a
+configurable time to first token, both with random jitter, and a share of
+requests can be made to fail.
+
+Usage:
+    python benchmarks/fake_dify.py --port 5001 --tokens-per-second 50 \\
+        --ttft-ms 300 --jitter-ms 20 --error-rate 0.01
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import uuid
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+def add_options(parser: argparse.ArgumentParser) -> None:
+    """Stub behaviour options, shared with the load test driver."""
+    parser.add_argument("--tokens", type=int, default=100, help="tokens per answer")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--ttft-ms", type=float, default=300.0)
+    parser.add_argument(
+        "--jitter-ms",
+        type=float,
+        default=0.0,
+        help="random +/- added to the time to first token and every token gap",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="share of chat requests and uploads answered with HTTP 500",
+    )
+    parser.add_argument(
+        "--stream-error-rate",
+        type=float,
+        default=0.0,
+        help="share of answers that end half way with an error event",
+    )
+    parser.add_argument("--upload-latency-ms", type=float, default=50.0)
+
+
+def _delay(ms: float, jitter_ms: float) -> float:
+    return max(ms + random.uniform(-jitter_ms, jitter_ms), 0.0) / 1000
+
+
+def _sse(event: dict) -> bytes:
+    return f"data: {json.dumps(event)}\n\n".encode()
+
+
+def create_app(options: argparse.Namespace) -> Starlette:
+    """The stub app, behaving as described by parsed ``add_options``."""
+    token_ms = 1000 / options.tokens_per_second
+
+    def failing() -> bool:
+        return random.random() < options.error_rate
+
+    async def chat_messages(request: Request):
+        payload = await request.json()
+        if failing():
+            return JSONResponse({"message": "injected failure"}, status_code=500)
+        conversation_id = payload.get("conversation_id") or str(uuid.uuid4())
+        message_id = str(uuid.uuid4())
+        ids = {"conversation_id": conversation_id, "message_id": message_id}
+        cut_at = (
+            options.tokens // 2 if random.random() < options.stream_error_rate else None
+        )
+
+        async def answer():
+            await asyncio.sleep(_delay(options.ttft_ms, options.jitter_ms))
+            for n in range(options.tokens):
+                if n == cut_at:
+                    yield _sse({"event": "error", "status": 500, "message": "injected"})
+                    return
+                if n:
+                    await asyncio.sleep(_delay(token_ms, options.jitter_ms))
+                yield _sse({"event": "message", "answer": f"tok{n} ", **ids})
+            yield _sse({"event": "message_end", **ids})
+
+        return StreamingResponse(answer(), media_type="text/event-stream")
+
+    async def files_upload(request: Request):
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+        await asyncio.sleep(_delay(options.upload_latency_ms, options.jitter_ms))
+        if failing():
+            return JSONResponse({"message": "injected failure"}, status_code=500)
+        return JSONResponse(
+            {"id": str(uuid.uuid4()), "name": "upload", "size": size}, status_code=201
+        )
+
+    async def parameters(request: Request):
+        return JSONResponse({"opening_statement": ""})
+
+    return Starlette(
+        routes=[
+            Route("/v1/chat-messages", chat_messages, methods=["POST"]),
+            Route("/v1/files/upload", files_upload, methods=["POST"]),
+            Route("/v1/parameters", parameters, methods=["GET"]),
+        ]
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5001)
+    add_options(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,474 @@
+#!/usr/bin/env python3
+"""
+Load test for /api/v1/chat and /api/v1/documents.
+
+Starts the fake Dify server (benchmarks/fake_dify.py) and the real app under
+uvicorn with the given number of workers, registers test users, then keeps
+N authenticated chat streams and M uploads in flight until the requested
+number of each has completed. While it runs, the CPU time and RSS of every
+app worker are sampled from /proc (Linux only).
+
+The result is a single JSON document on stdout: throughput, TTFB and
+inter-chunk gap percentiles for chat, latency and throughput for uploads,
+errors by status, and per-process CPU and RSS.
+
+Usage:
+    python benchmarks/load_test.py --workers 2 --chat-concurrency 50 \\
+        --chat-requests 500 --upload-concurrency 5 --upload-requests 50
+
+Pass --app-url to test an app that is already running (its Dify config must
+point at a reachable Dify or fake); --app-pid then names the process whose
+workers are sampled.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+BACKEND_DIR = Path(__file__).parent.parent
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fake_dify import add_options  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    """Nearest-rank p50/p90/p99 and max, in milliseconds."""
+    if not values:
+        return {"count": 0, "p50_ms": None, "p90_ms": None, "p99_ms": None}
+    ordered = sorted(values)
+
+    def rank(p: float) -> float:
+        index = max(int(p / 100 * len(ordered) + 0.999999) - 1, 0)
+        return round(ordered[index] * 1000, 2)
+
+    return {
+        "count": len(ordered),
+        "p50_ms": rank(50),
+        "p90_ms": rank(90),
+        "p99_ms": rank(99),
+        "max_ms": round(ordered[-1] * 1000, 2),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ProcessSampler:
+    """Samples CPU time and RSS of a process and its descendants."""
+
+    def __init__(self, pid: Optional[int], interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self._first: Dict[int, float] = {}
+        self._last: Dict[int, float] = {}
+        self._peak_rss: Dict[int, int] = {}
+        self._names: Dict[int, str] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._started = self._stopped = 0.0
+
+    @staticmethod
+    def _stat(pid: int) -> Optional[List[str]]:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                data = f.read()
+        except OSError:
+            return None
+        # The command name may contain spaces; it is wrapped in parentheses
+        name_end = data.rindex(")")
+        return [data[data.index("(") + 1 : name_end]] + data[name_end + 2 :].split()
+
+    def _tree(self) -> List[int]:
+        children: Dict[int, List[int]] = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                stat = self._stat(int(entry))
+                if stat is not None:
+                    children.setdefault(int(stat[2]), []).append(int(entry))
+        pids, queue = [], [self.pid]
+        while queue:
+            pid = queue.pop()
+            pids.append(pid)
+            queue.extend(children.get(pid, []))
+        return pids
+
+    def sample(self) -> None:
+        for pid in self._tree():
+            stat = self._stat(pid)
+            if stat is None:
+                continue
+            # utime and stime, then rss in pages (fields 14, 15 and 24)
+            cpu = (int(stat[12]) + int(stat[13])) / os.sysconf("SC_CLK_TCK")
+            rss = int(stat[22]) * os.sysconf("SC_PAGE_SIZE")
+            self._names[pid] = stat[0]
+            self._first.setdefault(pid, cpu)
+            self._last[pid] = cpu
+            self._peak_rss[pid] = max(self._peak_rss.get(pid, 0), rss)
+
+    async def _run(self) -> None:
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self.pid is None or not os.path.isdir("/proc"):
+            return
+        self._started = time.perf_counter()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> Optional[List[Dict[str, Any]]]:
+        if self._task is None:
+            return None
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self.sample()
+        self._stopped = time.perf_counter()
+        elapsed = self._stopped - self._started
+        return [
+            {
+                "pid": pid,
+                "name": self._names[pid],
+                "cpu_seconds": round(self._last[pid] - self._first[pid], 3),
+                "cpu_percent": round(
+                    (self._last[pid] - self._first[pid]) / elapsed * 100, 1
+                ),
+                "peak_rss_mb": round(self._peak_rss[pid] / MB, 1),
+            }
+            for pid in sorted(self._first)
+        ]
+
+
+class Results:
+    """Raw measurements of one kind of request."""
+
+    def __init__(self):
+        self.ok = 0
+        self.errors: Dict[str, int] = {}
+        self.latency: List[float] = []
+        self.ttfb: List[float] = []
+        self.gaps: List[float] = []
+        self.events = 0
+        self.bytes = 0
+
+    def error(self, kind: str) -> None:
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def report(self, elapsed: float) -> Dict[str, Any]:
+        report = {
+            "completed": self.ok,
+            "errors": self.errors,
+            "requests_per_second": round(self.ok / elapsed, 2) if elapsed else None,
+            "latency": percentiles(self.latency),
+        }
+        if self.ttfb:
+            report["ttfb"] = percentiles(self.ttfb)
+            report["inter_chunk_gap"] = percentiles(self.gaps)
+            report["events"] = self.events
+            report["events_per_second"] = round(self.events / elapsed, 1)
+        if self.bytes and not self.ttfb:
+            report["bytes"] = self.bytes
+            report["mb_per_second"] = round(self.bytes / MB / elapsed, 2)
+        return report
+
+
+async def chat_once(
+    client: httpx.AsyncClient, token: str, query: str, results: Results
+) -> None:
+    started = time.perf_counter()
+    try:
+        async with client.stream(
+            "POST",
+            "/api/v1/chat",
+            json={"query": query},
+            headers={"Authorization": f"Bearer {token}"},
+        ) as response:
+            if response.status_code != 200:
+                await response.aread()
+                results.error(str(response.status_code))
+                return
+            last = None
+            failed = False
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                now = time.perf_counter()
+                if last is None:
+                    results.ttfb.append(now - started)
+                else:
+                    results.gaps.append(now - last)
+                last = now
+                results.events += 1
+                event = json.loads(line[5:])
+                failed = failed or event.get("event") == "error"
+    except httpx.HTTPError as e:
+        results.error(type(e).__name__)
+        return
+    if failed:
+        results.error("stream_error")
+        return
+    results.ok += 1
+    results.latency.append(time.perf_counter() - started)
+
+
+async def upload_once(
+    client: httpx.AsyncClient, token: str, size: int, results: Results
+) -> None:
+    # Random binary content: never deduplicated and not text-indexed
+    content = os.urandom(size)
+    started = time.perf_counter()
+    try:
+        response = await client.post(
+            "/api/v1/documents",
+            files={"file": (f"{uuid.uuid4().hex}.bin", content)},
+            headers={"Authorization": f"Bearer {token}"},
+        )
+    except httpx.HTTPError as e:
+        results.error(type(e).__name__)
+        return
+    if response.status_code != 200:
+        results.error(str(response.status_code))
+        return
+    results.ok += 1
+    results.bytes += size
+    results.latency.append(time.perf_counter() - started)
+
+
+async def run_pool(concurrency: int, total: int, request) -> None:
+    """Run ``request(n)`` for n in range(total), ``concurrency`` at a time."""
+    counter = iter(range(total))
+
+    async def worker():
+        for n in counter:
+            await request(n)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+
+async def login_users(client: httpx.AsyncClient, count: int) -> List[str]:
+    """Register ``count`` fresh users and return their access tokens."""
+    run = uuid.uuid4().hex[:8]
+
+    async def login(n: int) -> str:
+        user = {"username": f"load-{run}-{n}", "password": "load-test-password"}
+        response = await client.post(
+            "/api/v1/auth/register",
+            json={**user, "email": f"load-{run}-{n}@example.com"},
+        )
+        response.raise_for_status()
+        response = await client.post("/api/v1/auth/login", json=user)
+        response.raise_for_status()
+        return response.json()["access_token"]
+
+    return list(await asyncio.gather(*(login(n) for n in range(count))))
+
+
+async def load(args: argparse.Namespace, app_url: str, pid: Optional[int]) -> dict:
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    timeout = httpx.Timeout(args.timeout)
+    async with httpx.AsyncClient(
+        base_url=app_url, limits=limits, timeout=timeout
+    ) as client:
+        tokens = await login_users(client, args.users)
+        chat, uploads = Results(), Results()
+        run = uuid.uuid4().hex[:8]
+
+        def query(n: int) -> str:
+            # Distinct questions miss the answer cache and single-flight
+            if args.distinct_queries:
+                n %= args.distinct_queries
+            return f"load test {run} question {n}"
+
+        sampler = ProcessSampler(pid)
+        sampler.start()
+        started = time.perf_counter()
+        await asyncio.gather(
+            run_pool(
+                args.chat_concurrency,
+                args.chat_requests,
+                lambda n: chat_once(client, tokens[n % len(tokens)], query(n), chat),
+            ),
+            run_pool(
+                args.upload_concurrency,
+                args.upload_requests,
+                lambda n: upload_once(
+                    client, tokens[n % len(tokens)], args.upload_kb * 1024, uploads
+                ),
+            ),
+        )
+        elapsed = time.perf_counter() - started
+        processes = await sampler.stop()
+
+    return {
+        "elapsed_seconds": round(elapsed, 2),
+        "chat": chat.report(elapsed),
+        "uploads": uploads.report(elapsed),
+        "processes": processes,
+    }
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args[2]} exited with {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def spawn(args: argparse.Namespace, tmp: str) -> Tuple[List[subprocess.Popen], str]:
+    """Start the fake Dify and the app; returns both processes and the
+    app's URL."""
+    log = open(args.app_log, "ab") if args.app_log else subprocess.DEVNULL
+    fake_port, app_port = free_port(), free_port()
+    stub_options = [
+        f"--tokens={args.tokens}",
+        f"--tokens-per-second={args.tokens_per_second}",
+        f"--ttft-ms={args.ttft_ms}",
+        f"--jitter-ms={args.jitter_ms}",
+        f"--error-rate={args.error_rate}",
+        f"--stream-error-rate={args.stream_error_rate}",
+        f"--upload-latency-ms={args.upload_latency_ms}",
+    ]
+    fake = subprocess.Popen(
+        [sys.executable, str(Path(__file__).parent / "fake_dify.py")]
+        + [f"--port={fake_port}"]
+        + stub_options,
+        stdout=log,
+        stderr=log,
+    )
+    env = {
+        **os.environ,
+        "APP_DEBUG": "false",
+        "DATABASE_URL": args.database_url or f"sqlite:///{tmp}/load.db",
+        "INGEST_SPOOL_DIR": f"{tmp}/ingest",
+        "RATE_LIMIT_ENABLED": "false",
+        "REQUEST_TIMING_LOG": "false",
+    }
+    # Create the tables once, rather than racing in every worker
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import asyncio; from app.database import init_database; "
+            "asyncio.run(init_database())",
+        ],
+        cwd=BACKEND_DIR,
+        env=env,
+        check=True,
+        stdout=log,
+        stderr=log,
+    )
+    app = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app"]
+        + [f"--port={app_port}", f"--workers={args.workers}"]
+        + ["--log-level=warning", "--no-access-log"],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=log,
+        stderr=log,
+    )
+    try:
+        wait_until_up(f"http://127.0.0.1:{fake_port}/v1/parameters", fake)
+        wait_until_up(f"http://127.0.0.1:{app_port}/", app)
+        httpx.post(
+            f"http://127.0.0.1:{app_port}/api/v1/dify-config",
+            json={"api_url": f"http://127.0.0.1:{fake_port}/v1", "api_key": "load"},
+        ).raise_for_status()
+        # Let every worker pick up the new config
+        time.sleep(args.config_settle)
+    except BaseException:
+        stop([fake, app])
+        raise
+    return [fake, app], f"http://127.0.0.1:{app_port}"
+
+
+def stop(processes: List[subprocess.Popen]) -> None:
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--app-url", help="test a running app instead of starting one")
+    parser.add_argument("--app-pid", type=int, help="process to sample with --app-url")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument(
+        "--database-url", help="database for the started app (default: SQLite)"
+    )
+    parser.add_argument("--app-log", help="append app and fake Dify output here")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--chat-concurrency", type=int, default=20)
+    parser.add_argument("--chat-requests", type=int, default=200)
+    parser.add_argument(
+        "--distinct-queries",
+        type=int,
+        default=0,
+        help="cycle through this many questions (default: all distinct)",
+    )
+    parser.add_argument("--upload-concurrency", type=int, default=2)
+    parser.add_argument("--upload-requests", type=int, default=20)
+    parser.add_argument("--upload-kb", type=int, default=512)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument(
+        "--config-settle",
+        type=float,
+        default=2.0,
+        help="seconds to wait for workers to load the Dify config",
+    )
+    parser.add_argument("--output", help="also write the JSON result to this file")
+    add_options(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        processes = []
+        if args.app_url:
+            app_url, pid = args.app_url, args.app_pid
+        else:
+            processes, app_url = spawn(args, tmp)
+            pid = processes[1].pid
+        try:
+            result = asyncio.run(load(args, app_url, pid))
+        finally:
+            stop(processes)
+
+    result["config"] = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ("output", "app_log")
+    }
+    output = json.dumps(result, indent=2)
+    print(output)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -5,6 +5,7 @@ This script can be run independently to initialize the database.
 """
 
 import sys
+import asyncio
 import logging
 from pathlib import Path
 
@@ -33,7 +34,7 @@ def main():
     )
 
     try:
-        init_database()
+        asyncio.run(init_database())
         logger.info("🎉 Database initialization completed successfully!")
         return 0
     except Exception as e:
@@ -1,44 +1,94 @@
 from fastapi.testclient import TestClient
 from app.main import app
+from app.answer_cache import answer_cache
+from app.backends import dify_backends
+from app.bulk_ingest import bulk_ingester
+from app.config import settings
+from app.auth import get_current_active_user, principal_cache
+from app.hashing import password_hasher
 from app.database import Base, get_db
-from app.models import DifyConfig
-from sqlalchemy import create_engine
+from app.dify_config import DifyConfigSnapshot, dify_config
+from app.history import ChatTurn, conversation_cache, history_writer
+from app.ingest_jobs import ingest_jobs
+from app.rate_limit import MemoryRateLimitBackend, rate_limiter
+from app.revocation import TokenRevocations
+from app.timing import TimingMiddleware, phase
+from app.models import Conversation, DifyConfig, DifyUpload, Document, IngestJob, User
+from app import api as api_module
+from app import auth as auth_module
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import NullPool
+import asyncio
+from datetime import datetime, timedelta, timezone
+import httpx
+import io
+import json
 import pytest
 import os
+import tarfile
+import tempfile
+import zipfile
 
 # Override environment variables for testing
 os.environ["DB_HOST"] = "test"
 os.environ["DB_NAME"] = "test_db"
 os.environ["APP_DEBUG"] = "true"
 
-# Setup a test database
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+# Setup a test database file shared by the app (aiosqlite) and assertions
+_fd, TEST_DB_PATH = tempfile.mkstemp(suffix=".db")
+os.close(_fd)
 
 test_engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
+    f"sqlite:///{TEST_DB_PATH}", connect_args={"check_same_thread": False}
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=test_engine)
 
+# NullPool: TestClient runs each request on a fresh event loop
+async_test_engine = create_async_engine(
+    f"sqlite+aiosqlite:///{TEST_DB_PATH}", poolclass=NullPool
+)
+AsyncTestingSessionLocal = async_sessionmaker(
+    bind=async_test_engine, autoflush=False, expire_on_commit=False
+)
+
 Base.metadata.create_all(bind=test_engine)
 
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+async def override_get_db():
+    async with AsyncTestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-app.dependency_overrides[get_db] = override_get_db
+def override_current_user():
+    return User(id=1, username="test-user", email="test@example.com", is_active=True)
+
 
 client = TestClient(app)
 
 
+@pytest.fixture(autouse=True)
+def dependency_overrides():
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_current_active_user] = override_current_user
+    yield
+    app.dependency_overrides.clear()
+
+
+@pytest.fixture(autouse=True)
+def fresh_dify_backends(mocker):
+    # Health, load and circuit state would otherwise leak between tests
+    mocker.patch.object(dify_backends, "_states", {})
+    mocker.patch.object(rate_limiter, "backend", MemoryRateLimitBackend())
+
+
+def mock_dify(mocker, handler):
+    """Route the shared Dify client through an in-process transport."""
+    dify_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return mocker.patch("app.api.dify_clients.get", return_value=dify_client)
+
+
 @pytest.fixture(name="db_session")
 def db_session_fixture():
     Base.metadata.create_all(bind=test_engine)
@@ -76,10 +126,203 @@ def test_get_dify_config(db_session):
     }
 
 
+def test_register_and_login(db_session):
+    response = client.post(
+        "/api/v1/auth/register",
+        json={"username": "alice", "email": "alice@example.com", "password": "s3cret"},
+    )
+    assert response.status_code == 200
+    assert response.json()["username"] == "alice"
+
+    response = client.post(
+        "/api/v1/auth/login", json={"username": "alice", "password": "s3cret"}
+    )
+    assert response.status_code == 200
+    assert response.json()["token_type"] == "bearer"
+
+    response = client.post(
+        "/api/v1/auth/login", json={"username": "alice", "password": "wrong"}
+    )
+    assert response.status_code == 401
+
+
+def test_login_rejected_when_hashing_queue_full(mocker, db_session):
+    client.post(
+        "/api/v1/auth/register",
+        json={"username": "bob", "email": "bob@example.com", "password": "s3cret"},
+    )
+    mocker.patch.object(password_hasher, "max_queue", 0)
+    response = client.post(
+        "/api/v1/auth/login", json={"username": "bob", "password": "s3cret"}
+    )
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_current_user_is_cached_and_invalidated(db_session):
+    # Exercise the real auth dependency instead of the test override
+    app.dependency_overrides.pop(get_current_active_user)
+    principal_cache.clear()
+    client.post(
+        "/api/v1/auth/register",
+        json={"username": "carol", "email": "carol@example.com", "password": "pw"},
+    )
+    token = client.post(
+        "/api/v1/auth/login", json={"username": "carol", "password": "pw"}
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    hits = principal_cache.hits
+    assert client.get("/api/v1/auth/me", headers=headers).status_code == 200
+    response = client.get("/api/v1/auth/me", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["username"] == "carol"
+    assert principal_cache.hits == hits + 1
+
+    # Deactivating the user drops the cached principal
+    user = db_session.query(User).filter(User.username == "carol").first()
+    user.is_active = False
+    db_session.commit()
+    assert client.get("/api/v1/auth/me", headers=headers).status_code == 400
+
+
+def test_revoked_tokens_are_rejected_without_the_revocation_set(mocker, db_session):
+    app.dependency_overrides.pop(get_current_active_user)
+    principal_cache.clear()
+    # Never loaded, e.g. the database was down at startup
+    revocations = TokenRevocations(interval=0)
+    mocker.patch.object(auth_module, "token_revocations", revocations)
+    mocker.patch.object(api_module, "token_revocations", revocations)
+    client.post(
+        "/api/v1/auth/register",
+        json={"username": "hank", "email": "hank@example.com", "password": "pw"},
+    )
+
+    def login():
+        token = client.post(
+            "/api/v1/auth/login", json={"username": "hank", "password": "pw"}
+        ).json()["access_token"]
+        return {"Authorization": f"Bearer {token}"}
+
+    old = login()
+    assert client.post("/api/v1/auth/revoke", headers=old).status_code == 200
+
+    # Checked against the user's token version when loaded from the database
+    assert client.get("/api/v1/auth/me", headers=old).status_code == 401
+    # ...and against the cached principal, once a newer token has cached it
+    assert client.get("/api/v1/auth/me", headers=login()).status_code == 200
+    assert client.get("/api/v1/auth/me", headers=old).status_code == 401
+
+
+def test_refresh_tokens_rotate_without_a_password(mocker, db_session):
+    app.dependency_overrides.pop(get_current_active_user)
+    principal_cache.clear()
+    client.post(
+        "/api/v1/auth/register",
+        json={"username": "gina", "email": "gina@example.com", "password": "pw"},
+    )
+    login = client.post(
+        "/api/v1/auth/login", json={"username": "gina", "password": "pw"}
+    ).json()
+    verify = mocker.spy(password_hasher, "verify")
+
+    def refresh(token):
+        return client.post("/api/v1/auth/refresh", json={"refresh_token": token})
+
+    response = refresh(login["refresh_token"])
+    assert response.status_code == 200
+    rotated = response.json()
+    assert rotated["refresh_token"] != login["refresh_token"]
+    headers = {"Authorization": f"Bearer {rotated['access_token']}"}
+    assert client.get("/api/v1/auth/me", headers=headers).json()["username"] == "gina"
+    assert verify.call_count == 0
+
+    # A rotated token replayed right away (another tab) is only refused...
+    assert refresh(login["refresh_token"]).status_code == 401
+    second = refresh(rotated["refresh_token"]).json()
+    # ...but after the grace period it revokes the whole session
+    mocker.patch.object(api_module.settings, "REFRESH_TOKEN_REUSE_GRACE", 0)
+    assert refresh(rotated["refresh_token"]).status_code == 401
+    assert refresh(second["refresh_token"]).status_code == 401
+
+    # Logging out ends one session, revoking ends them all
+    one = client.post(
+        "/api/v1/auth/login", json={"username": "gina", "password": "pw"}
+    ).json()
+    two = client.post(
+        "/api/v1/auth/login", json={"username": "gina", "password": "pw"}
+    ).json()
+    client.post("/api/v1/auth/logout", json={"refresh_token": one["refresh_token"]})
+    assert refresh(one["refresh_token"]).status_code == 401
+    headers = {"Authorization": f"Bearer {two['access_token']}"}
+    assert client.post("/api/v1/auth/revoke", headers=headers).status_code == 200
+    assert refresh(two["refresh_token"]).status_code == 401
+
+
+def test_decoded_tokens_are_cached_until_they_expire(mocker):
+    auth_module.token_cache.clear()
+    clock = mocker.patch("app.cache.time.monotonic", return_value=1000.0)
+    decode = mocker.spy(auth_module.jwt, "decode")
+    token = auth_module.create_access_token(
+        {"sub": "frank"}, expires_delta=timedelta(seconds=30)
+    )
+
+    assert auth_module.verify_token(token) == "frank"
+    assert auth_module.verify_token(token) == "frank"
+    assert decode.call_count == 1
+    assert auth_module.token_cache.stats()["hits"] >= 1
+    assert auth_module.verify_token("not-a-token") is None
+
+    # Past the token's own exp the entry is gone and the JWT is checked
+    # again (jose's real clock still considers it valid here)
+    clock.return_value = 1031.0
+    auth_module.verify_token(token)
+    assert decode.call_count == 3
+
+
+def test_stateless_tokens_skip_the_database_until_revoked(mocker, db_session):
+    app.dependency_overrides.pop(get_current_active_user)
+    principal_cache.clear()
+    revocations = TokenRevocations(interval=0)
+    revocations.session_factory = AsyncTestingSessionLocal
+    mocker.patch.object(auth_module, "token_revocations", revocations)
+    mocker.patch.object(api_module, "token_revocations", revocations)
+    client.post(
+        "/api/v1/auth/register",
+        json={"username": "erin", "email": "erin@example.com", "password": "pw"},
+    )
+
+    def login():
+        token = client.post(
+            "/api/v1/auth/login", json={"username": "erin", "password": "pw"}
+        ).json()["access_token"]
+        return {"Authorization": f"Bearer {token}"}
+
+    headers = login()
+    asyncio.run(revocations.refresh())
+    lookup = mocker.spy(auth_module, "get_user")
+    response = client.get("/api/v1/auth/me", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["email"] == "erin@example.com"
+    assert lookup.call_count == 0
+
+    assert client.post("/api/v1/auth/revoke", headers=headers).status_code == 200
+    assert client.get("/api/v1/auth/me", headers=headers).status_code == 401
+    # Tokens issued afterwards carry the new version
+    headers = login()
+    assert client.get("/api/v1/auth/me", headers=headers).status_code == 200
+
+    # Deactivated by another worker: picked up on the next refresh
+    db_session.execute(text("UPDATE users SET is_active = 0"))
+    db_session.commit()
+    assert client.get("/api/v1/auth/me", headers=headers).status_code == 200
+    asyncio.run(revocations.refresh())
+    assert client.get("/api/v1/auth/me", headers=headers).status_code == 401
+
+
 def test_upload_document_no_config(mocker):
-    # Ensure DIFY_API_URL and DIFY_API_KEY are None for this test
-    mocker.patch("app.api.DIFY_API_URL", None)
-    mocker.patch("app.api.DIFY_API_KEY", None)
+    # No Dify config loaded in this worker
+    mocker.patch.object(dify_config, "_snapshot", DifyConfigSnapshot())
 
     response = client.post(
         "/api/v1/documents", files={"file": ("test.txt", b"hello world", "text/plain")}
@@ -96,17 +339,23 @@ def test_upload_document(mocker, db_session):
         "/api/v1/dify-config",
         json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
     )
-    # Mock the requests.post call for document upload
-    mock_post = mocker.patch("requests.post")
-    mock_post.return_value.status_code = 200
-    mock_post.return_value.json.return_value = {
-        "id": "dify-file-id",
-        "name": "test.txt",
-        "size": 11,
-        "type": "text/plain",
-        "created_by": "gemini-user",
-        "created_at": "2025-07-15T12:00:00Z",
-    }
+    dify_requests = []
+
+    def handler(request):
+        dify_requests.append(request)
+        return httpx.Response(
+            200,
+            json={
+                "id": "dify-file-id",
+                "name": "test.txt",
+                "size": 11,
+                "type": "text/plain",
+                "created_by": "gemini-user",
+                "created_at": "2025-07-15T12:00:00Z",
+            },
+        )
+
+    mock_dify(mocker, handler)
 
     response = client.post(
         "/api/v1/documents", files={"file": ("test.txt", b"hello world", "text/plain")}
@@ -116,17 +365,18 @@ def test_upload_document(mocker, db_session):
     assert response.json()["name"] == "test.txt"
     assert response.json()["id"] == "dify-file-id"
 
-    # Assert that requests.post was called with the correct arguments
-    mock_post.assert_called_once()
-    args, kwargs = mock_post.call_args
-    assert args[0] == "http://test-dify.com/v1/files/upload"
-    assert kwargs["headers"]["Authorization"] == "Bearer test-api-key"
+    # Assert that Dify was called once with the correct arguments
+    assert len(dify_requests) == 1
+    assert str(dify_requests[0].url) == "http://test-dify.com/v1/files/upload"
+    assert dify_requests[0].headers["Authorization"] == "Bearer test-api-key"
+    body = dify_requests[0].read()
+    assert b"hello world" in body
+    assert int(dify_requests[0].headers["Content-Length"]) == len(body)
 
 
 def test_chat_streaming_no_config(mocker):
-    # Ensure DIFY_API_URL and DIFY_API_KEY are None for this test
-    mocker.patch("app.api.DIFY_API_URL", None)
-    mocker.patch("app.api.DIFY_API_KEY", None)
+    # No Dify config loaded in this worker
+    mocker.patch.object(dify_config, "_snapshot", DifyConfigSnapshot())
 
     response = client.post(
         "/api/v1/chat",
@@ -144,19 +394,24 @@ def test_chat_streaming(mocker, db_session):
         "/api/v1/dify-config",
         json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
     )
-    # Mock the requests.post call for chat streaming
-    mock_response_iter = mocker.MagicMock()
-    mock_response_iter.iter_content.return_value = [
-        b'data: {"event": "llm_start", "id": "123"}\n\n',
-        b'data: {"event": "text_chunk", "answer": "Hello"}\n\n',
-        b'data: {"event": "text_chunk", "answer": " world"}\n\n',
-        b'data: {"event": "llm_end", "id": "123"}\n\n',
-    ]
-    mock_response_iter.status_code = 200
-    mock_response_iter.__enter__.return_value = mock_response_iter
-    mock_response_iter.__exit__.return_value = None
+    dify_requests = []
+
+    def handler(request):
+        dify_requests.append(request)
+        return httpx.Response(
+            200,
+            headers={"content-type": "text/event-stream"},
+            content=b"".join(
+                [
+                    b'data: {"event": "llm_start", "id": "123"}\n\n',
+                    b'data: {"event": "text_chunk", "answer": "Hello"}\n\n',
+                    b'data: {"event": "text_chunk", "answer": " world"}\n\n',
+                    b'data: {"event": "llm_end", "id": "123"}\n\n',
+                ]
+            ),
+        )
 
-    mock_requests_post = mocker.patch("requests.post", return_value=mock_response_iter)
+    mock_dify(mocker, handler)
 
     response = client.post(
         "/api/v1/chat",
@@ -171,20 +426,1117 @@ def test_chat_streaming(mocker, db_session):
     for chunk in response.iter_lines():
         received_chunks.append(chunk)
 
+    # Events are re-serialized compactly with fields the UI never reads dropped
     expected_chunks = [
-        'data: {"event": "llm_start", "id": "123"}',
-        'data: {"event": "text_chunk", "answer": "Hello"}',
-        'data: {"event": "text_chunk", "answer": " world"}',
-        'data: {"event": "llm_end", "id": "123"}',
+        'data: {"event":"llm_start"}',
+        'data: {"event":"text_chunk","answer":"Hello"}',
+        'data: {"event":"text_chunk","answer":" world"}',
+        'data: {"event":"llm_end"}',
     ]
     # Filter out empty strings that iter_lines() might produce from double newlines
     received_chunks = [chunk for chunk in received_chunks if chunk]
     assert received_chunks == expected_chunks
 
     # Verify the Dify API call
-    args, kwargs = mock_requests_post.call_args
-    assert args[0] == "http://test-dify.com/v1/chat-messages"
-    assert kwargs["headers"]["Authorization"] == "Bearer test-api-key"
-    assert kwargs["json"]["query"] == "Hello Dify"
-    assert kwargs["json"]["response_mode"] == "streaming"
-    assert kwargs["json"]["conversation_id"] == "test-conversation-id"
+    assert len(dify_requests) == 1
+    dify_request = dify_requests[0]
+    body = json.loads(dify_request.content)
+    assert str(dify_request.url) == "http://test-dify.com/v1/chat-messages"
+    assert dify_request.headers["Authorization"] == "Bearer test-api-key"
+    assert body["query"] == "Hello Dify"
+    assert body["response_mode"] == "streaming"
+    # Browser-local ids are never sent to Dify as conversation ids
+    assert body["conversation_id"] == ""
+
+
+def test_chat_streaming_upstream_error(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    mock_dify(mocker, lambda request: httpx.Response(502))
+
+    response = client.post("/api/v1/chat", json={"query": "Hello Dify"})
+
+    assert response.status_code == 500
+    assert response.json() == {"detail": "Error calling Dify chat API: HTTP 502"}
+
+
+def test_chat_history_is_persisted_and_mapped(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    mocker.patch.object(history_writer, "session_factory", AsyncTestingSessionLocal)
+    conversation_cache.clear()
+    asyncio.run(history_writer.flush())  # drain turns queued by earlier tests
+    sent_conversation_ids = []
+
+    def handler(request):
+        sent_conversation_ids.append(json.loads(request.content)["conversation_id"])
+        return httpx.Response(
+            200,
+            content=(
+                b'data: {"event": "message", "answer": "Hi", '
+                b'"conversation_id": "dify-conv-1", "message_id": "m1"}\n\n'
+                b'data: {"event": "message", "answer": " there", '
+                b'"conversation_id": "dify-conv-1", "message_id": "m1"}\n\n'
+                b'data: {"event": "message_end", "conversation_id": "dify-conv-1"}\n\n'
+            ),
+        )
+
+    mock_dify(mocker, handler)
+
+    response = client.post(
+        "/api/v1/chat", json={"query": "Hello", "conversation_id": "1"}
+    )
+    assert response.status_code == 200
+    asyncio.run(history_writer.flush())
+
+    conversation = db_session.query(Conversation).filter_by(client_id="1").one()
+    assert conversation.dify_conversation_id == "dify-conv-1"
+    assert [(m.role, m.content) for m in conversation.messages] == [
+        ("user", "Hello"),
+        ("assistant", "Hi there"),
+    ]
+
+    # The follow-up question continues the Dify conversation
+    client.post("/api/v1/chat", json={"query": "More", "conversation_id": "1"})
+    assert sent_conversation_ids == ["", "dify-conv-1"]
+
+    response = client.get("/api/v1/conversations")
+    assert "1" in [c["id"] for c in response.json()]
+    response = client.get("/api/v1/conversations/1/messages")
+    assert [m["role"] for m in response.json()] == ["user", "assistant"]
+
+
+def test_follow_up_before_history_write_continues_conversation(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    mocker.patch.object(history_writer, "session_factory", AsyncTestingSessionLocal)
+    conversation_cache.clear()
+    asyncio.run(history_writer.flush())
+    sent_conversation_ids = []
+
+    def handler(request):
+        sent_conversation_ids.append(json.loads(request.content)["conversation_id"])
+        return httpx.Response(
+            200,
+            content=(
+                b'data: {"event": "message", "answer": "Hi", '
+                b'"conversation_id": "dify-conv-2", "message_id": "m1"}\n\n'
+            ),
+        )
+
+    mock_dify(mocker, handler)
+
+    # The first turn is still queued when the second question arrives
+    client.post("/api/v1/chat", json={"query": "Hello", "conversation_id": "2"})
+    client.post("/api/v1/chat", json={"query": "More", "conversation_id": "2"})
+    assert sent_conversation_ids == ["", "dify-conv-2"]
+
+    asyncio.run(history_writer.flush())
+    conversation = db_session.query(Conversation).filter_by(client_id="2").one()
+    assert conversation.dify_conversation_id == "dify-conv-2"
+    assert len(conversation.messages) == 4
+
+
+def test_failing_history_turn_does_not_lose_the_batch(mocker, db_session):
+    mocker.patch.object(history_writer, "session_factory", AsyncTestingSessionLocal)
+    asyncio.run(history_writer.flush())
+    conversation_for = history_writer._conversation_for
+
+    async def failing_for_bad(db, turn, seen):
+        if turn.client_conversation_id == "bad":
+            raise RuntimeError("boom")
+        return await conversation_for(db, turn, seen)
+
+    mocker.patch.object(history_writer, "_conversation_for", failing_for_bad)
+    before = history_writer.stats()
+    for client_id in ("good-1", "bad", "good-2"):
+        history_writer.submit(
+            ChatTurn(
+                user_id=1,
+                client_conversation_id=client_id,
+                dify_conversation_id=f"dify-{client_id}",
+                query="Q",
+                answer="A",
+                dify_message_id=None,
+                dify_backend_id=None,
+            )
+        )
+    asyncio.run(history_writer.flush())
+
+    stats = history_writer.stats()
+    assert stats["written"] - before["written"] == 2
+    assert stats["failed"] - before["failed"] == 1
+    saved = {c.client_id for c in db_session.query(Conversation).all()}
+    assert {"good-1", "good-2"} <= saved
+    assert "bad" not in saved
+
+
+def test_chat_answer_cache_replays_stateless_queries(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    mocker.patch.object(answer_cache, "enabled", True)
+    answer_cache.purge()
+    dify_requests = []
+
+    def handler(request):
+        dify_requests.append(request)
+        return httpx.Response(
+            200,
+            content=(
+                b'data: {"event": "text_chunk", "answer": "42"}\n\n'
+                b'data: {"event": "llm_end", "id": "1"}\n\n'
+            ),
+        )
+
+    mock_dify(mocker, handler)
+
+    first = client.post("/api/v1/chat", json={"query": "What is  the answer?"})
+    second = client.post("/api/v1/chat", json={"query": "what is the ANSWER?"})
+
+    assert first.headers["X-Cache"] == "MISS"
+    assert second.headers["X-Cache"] == "HIT"
+    assert second.headers["content-type"] == "text/event-stream; charset=utf-8"
+    assert second.content == first.content
+    assert len(dify_requests) == 1
+
+    # Queries inside a conversation always go upstream
+    client.post(
+        "/api/v1/chat",
+        json={"query": "What is the answer?", "conversation_id": "1"},
+    )
+    assert len(dify_requests) == 2
+
+    # The cache is shared by every user, so only admins may purge it
+    assert client.delete("/api/v1/chat/cache").status_code == 403
+    mocker.patch.object(settings, "ADMIN_USERNAMES", {"test-user"})
+    assert client.delete("/api/v1/chat/cache").json() == {"purged": 1}
+    client.post("/api/v1/chat", json={"query": "What is the answer?"})
+    assert len(dify_requests) == 3
+    assert client.get("/api/v1/chat/cache/stats").json()["hits"] == 1
+
+
+def test_chat_single_flight_shares_one_upstream_stream(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    dify_requests = []
+
+    async def handler(request):
+        dify_requests.append(request)
+
+        async def body():
+            yield b'data: {"event": "text_chunk", "answer": "Hel"}\n\n'
+            await asyncio.sleep(0.05)
+            yield b'data: {"event": "text_chunk", "answer": "lo"}\n\n'
+            yield b'data: {"event": "llm_end"}\n\n'
+
+        return httpx.Response(200, content=body())
+
+    mock_dify(mocker, handler)
+    # Five open streams from one user
+    mocker.patch.object(rate_limiter, "max_streams", 5)
+
+    async def ask_concurrently():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+            return await asyncio.gather(
+                *[c.post("/api/v1/chat", json={"query": "Same?"}) for _ in range(5)]
+            )
+
+    responses = asyncio.run(ask_concurrently())
+
+    assert len(dify_requests) == 1
+    roles = sorted(r.headers["X-Single-Flight"] for r in responses)
+    assert roles == ["follower"] * 4 + ["leader"]
+    assert {r.content for r in responses} == {responses[0].content}
+    assert b"Hel" in responses[0].content and b"lo" in responses[0].content
+
+
+def test_uploaded_text_documents_are_searchable(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    mock_dify(mocker, lambda request: httpx.Response(200, json={"id": "dify-doc"}))
+    handbook = b"Vacation requests must be approved by your manager.\n\n" * 3
+    client.post(
+        "/api/v1/documents", files={"file": ("handbook.md", handbook, "text/markdown")}
+    )
+    client.post(
+        "/api/v1/documents",
+        files={"file": ("menu.txt", b"Lunch is served at noon.", "text/plain")},
+    )
+
+    response = client.get("/api/v1/search", params={"q": "vacation approval", "k": 1})
+
+    assert response.status_code == 200
+    [hit] = response.json()["results"]
+    assert hit["filename"] == "handbook.md"
+    assert hit["dify_file_id"] == "dify-doc"
+    assert "Vacation requests" in hit["content"]
+
+
+def test_search_only_returns_the_users_own_documents(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    mock_dify(mocker, lambda request: httpx.Response(200, json={"id": "dify-doc"}))
+    client.post(
+        "/api/v1/documents",
+        files={"file": ("salaries.txt", b"Salary bands for 2025.", "text/plain")},
+    )
+    params = {"q": "salary bands", "k": 5}
+    assert len(client.get("/api/v1/search", params=params).json()["results"]) == 1
+    app.dependency_overrides[get_current_active_user] = lambda: User(
+        id=2, username="other-user", email="other@example.com", is_active=True
+    )
+
+    response = client.get("/api/v1/search", params=params)
+
+    assert response.status_code == 200
+    assert response.json()["results"] == []
+
+
+def test_upload_extracts_docx_and_reports_stage_timings(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    dify_requests = []
+
+    def handler(request):
+        dify_requests.append(request)
+        return httpx.Response(200, json={"id": "dify-docx"})
+
+    mock_dify(mocker, handler)
+    ns = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+    docx = io.BytesIO()
+    with zipfile.ZipFile(docx, "w") as archive:
+        archive.writestr(
+            "word/document.xml",
+            f'<w:document xmlns:w="{ns}"><w:body>'
+            "<w:p><w:r><w:t>Expense reports are due on Fridays.</w:t></w:r></w:p>"
+            "</w:body></w:document>",
+        )
+
+    response = client.post(
+        "/api/v1/documents",
+        files={"file": ("policy.docx", docx.getvalue(), "application/octet-stream")},
+    )
+
+    assert response.status_code == 200
+    timings = response.headers["X-Ingest-Timings"]
+    for stage in ("sniff", "upload", "extract", "normalize", "chunk", "embed"):
+        assert f"{stage}=" in timings
+    # Dify receives the sniffed content type
+    assert b"wordprocessingml" in dify_requests[0].read()
+    [hit] = client.get(
+        "/api/v1/search", params={"q": "expense reports", "k": 1}
+    ).json()["results"]
+    assert hit["dify_file_id"] == "dify-docx"
+    assert hit["content"] == "Expense reports are due on Fridays."
+
+
+def test_bulk_upload_streams_ndjson_results_with_bounded_concurrency(
+    mocker, db_session
+):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    mocker.patch.object(bulk_ingester, "concurrency", 2)
+    mocker.patch.object(bulk_ingester, "session_factory", AsyncTestingSessionLocal)
+    in_flight = 0
+    peak = 0
+
+    async def handler(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.02)
+        in_flight -= 1
+        if b"broken" in request.read():
+            return httpx.Response(502)
+        return httpx.Response(200, json={"id": "dify-bulk"})
+
+    mock_dify(mocker, handler)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as bundle:
+        bundle.writestr("docs/a.txt", "Alpha document about onboarding.")
+        bundle.writestr("docs/b.md", "# Beta\n\nBeta document.")
+        bundle.writestr("__MACOSX/docs/._a.txt", "resource fork")
+    tarball = io.BytesIO()
+    with tarfile.open(fileobj=tarball, mode="w:gz") as bundle:
+        data = b"Gamma document."
+        info = tarfile.TarInfo("c.txt")
+        info.size = len(data)
+        bundle.addfile(info, io.BytesIO(data))
+
+    response = client.post(
+        "/api/v1/documents/bulk",
+        files=[
+            ("files", ("one.txt", b"First loose file.", "text/plain")),
+            ("files", ("two.txt", b"broken upload", "text/plain")),
+            ("files", ("docs.zip", archive.getvalue(), "application/zip")),
+            ("files", ("more.tar.gz", tarball.getvalue(), "application/gzip")),
+            ("files", ("bad.zip", b"not a zip", "application/zip")),
+        ],
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    summary = lines.pop()["summary"]
+    results = {line["filename"]: line for line in lines}
+    assert set(results) == {
+        "one.txt",
+        "two.txt",
+        "docs/a.txt",
+        "docs/b.md",
+        "c.txt",
+        "bad.zip",
+    }
+    assert results["docs/a.txt"]["status"] == "ok"
+    assert results["docs/a.txt"]["dify_file"] == {"id": "dify-bulk"}
+    assert "upload" in results["c.txt"]["timings"]
+    assert results["two.txt"]["status"] == "error"
+    assert results["bad.zip"]["detail"].startswith("Bad archive")
+    assert summary["total"] == 6 and summary["succeeded"] == 4
+    assert summary["failed"] == 2
+    assert 1 < peak <= 2
+
+    search = client.get("/api/v1/search", params={"q": "gamma", "k": 1}).json()
+    assert search["results"][0]["filename"] == "c.txt"
+
+
+def test_upload_size_limits_cover_archive_members(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    mocker.patch.object(bulk_ingester, "session_factory", AsyncTestingSessionLocal)
+    mocker.patch.object(settings, "MAX_UPLOAD_SIZE", 100)
+    mocker.patch.object(settings, "BULK_INGEST_MAX_EXPANDED_SIZE", 150)
+    forwarded = []
+
+    def handler(request):
+        forwarded.append(request)
+        return httpx.Response(200, json={"id": "dify-sized"})
+
+    mock_dify(mocker, handler)
+
+    response = client.post(
+        "/api/v1/documents", files={"file": ("big.txt", b"x" * 101, "text/plain")}
+    )
+    assert response.status_code == 413
+
+    # Compresses to almost nothing, unpacks past the total limit
+    bomb = io.BytesIO()
+    with zipfile.ZipFile(bomb, "w", zipfile.ZIP_DEFLATED) as bundle:
+        for n in range(3):
+            bundle.writestr(f"zero-{n}.txt", b"0" * 60)
+    big_member = io.BytesIO()
+    with zipfile.ZipFile(big_member, "w", zipfile.ZIP_DEFLATED) as bundle:
+        bundle.writestr("small.txt", "Small enough.")
+        bundle.writestr("huge.txt", b"0" * 101)
+    tarball = io.BytesIO()
+    with tarfile.open(fileobj=tarball, mode="w:gz") as bundle:
+        for n in range(3):
+            info = tarfile.TarInfo(f"t-{n}.txt")
+            info.size = 60
+            bundle.addfile(info, io.BytesIO(b"t" * 60))
+
+    response = client.post(
+        "/api/v1/documents/bulk",
+        files=[
+            ("files", ("bomb.zip", bomb.getvalue(), "application/zip")),
+            ("files", ("mixed.zip", big_member.getvalue(), "application/zip")),
+            ("files", ("many.tar.gz", tarball.getvalue(), "application/gzip")),
+        ],
+    )
+
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    lines.pop()
+    results = {line["filename"]: line for line in lines}
+    assert "byte upload limit" in results["huge.txt"]["detail"]
+    assert results["small.txt"]["status"] == "ok"
+    assert "unpacks to more than 150 bytes" in results["bomb.zip"]["detail"]
+    assert "unpacks to more than 150 bytes" in results["many.tar.gz"]["detail"]
+    # Nothing of the zip bomb is forwarded; the tar stops at the limit
+    assert not any(name.startswith("zero-") for name in results)
+    assert {"t-0.txt", "t-1.txt"} <= set(results) and "t-2.txt" not in results
+    assert len(forwarded) == 3
+
+
+def test_bulk_upload_requires_files(db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    response = client.post("/api/v1/documents/bulk", data={"note": "nothing"})
+    assert response.status_code == 400
+
+
+@pytest.fixture(name="job_queue")
+def job_queue_fixture(mocker, tmp_path):
+    mocker.patch.object(ingest_jobs, "session_factory", AsyncTestingSessionLocal)
+    mocker.patch.object(ingest_jobs, "spool_dir", str(tmp_path))
+    mocker.patch.object(ingest_jobs, "_handler", api_module.ingest_file)
+    return ingest_jobs
+
+
+def test_async_upload_queues_job_and_reports_status(mocker, db_session, job_queue):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    dify_requests = []
+
+    def handler(request):
+        dify_requests.append(request)
+        return httpx.Response(200, json={"id": "dify-async"})
+
+    mock_dify(mocker, handler)
+
+    response = client.post(
+        "/api/v1/documents",
+        params={"mode": "async"},
+        files={"file": ("big.txt", b"Queued upload body.", "text/plain")},
+    )
+
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    status_url = f"/api/v1/documents/jobs/{job_id}"
+    assert response.json()["status_url"] == status_url
+    assert response.headers["Location"] == status_url
+    # Nothing is sent to Dify until a worker picks the job up
+    assert dify_requests == []
+    queued = client.get(status_url).json()
+    assert queued["state"] == "queued"
+    assert queued["bytes"] == len(b"Queued upload body.")
+
+    assert asyncio.run(job_queue.run_pending()) == 1
+
+    done = client.get(status_url).json()
+    assert done["state"] == "done"
+    assert done["attempts"] == 1
+    assert done["dify_file"] == {"id": "dify-async"}
+    assert {"spool", "queue_wait", "upload"} <= set(done["timings"])
+    assert b"Queued upload body." in dify_requests[0].read()
+    assert not os.listdir(job_queue.spool_dir)
+    assert client.get("/api/v1/documents/jobs/unknown").status_code == 404
+
+
+def test_ingest_jobs_retry_with_backoff_and_survive_restart(
+    mocker, db_session, job_queue
+):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    # Leave retrying to the job queue
+    mocker.patch.object(dify_backends, "max_attempts", 1)
+    responses = [httpx.Response(503), httpx.Response(200, json={"id": "dify-retry"})]
+    mock_dify(mocker, lambda request: responses.pop(0))
+    job_id = client.post(
+        "/api/v1/documents",
+        params={"mode": "async"},
+        files={"file": ("retry.txt", b"Retry me.", "text/plain")},
+    ).json()["job_id"]
+    status_url = f"/api/v1/documents/jobs/{job_id}"
+
+    asyncio.run(job_queue.run_pending())
+    retrying = client.get(status_url).json()
+    assert retrying["state"] == "queued"
+    assert retrying["attempts"] == 1
+    assert "Dify" in retrying["error"]
+    # Backoff: not ready again yet
+    assert asyncio.run(job_queue.run_pending()) == 0
+
+    # Simulate a crash mid-attempt, then a restart
+    db_session.query(IngestJob).filter_by(id=job_id).update({"state": "running"})
+    db_session.commit()
+    assert asyncio.run(job_queue.recover()) == 1
+
+    assert asyncio.run(job_queue.run_pending()) == 1
+    done = client.get(status_url).json()
+    assert done["state"] == "done"
+    assert done["attempts"] == 2
+    assert done["dify_file"] == {"id": "dify-retry"}
+
+
+def test_recover_only_requeues_jobs_with_an_expired_lease(
+    mocker, db_session, job_queue
+):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    job_ids = [
+        client.post(
+            "/api/v1/documents",
+            params={"mode": "async"},
+            files={"file": (f"{name}.txt", b"Leased.", "text/plain")},
+        ).json()["job_id"]
+        for name in ("live", "dead")
+    ]
+    now = datetime.now(timezone.utc)
+    # One job held by a worker that is still renewing its lease, one by a
+    # worker that died
+    leases = (now + timedelta(minutes=1), now - timedelta(seconds=1))
+    for job_id, expires in zip(job_ids, leases):
+        db_session.query(IngestJob).filter_by(id=job_id).update(
+            {
+                "state": "running",
+                "lease_owner": "other-process",
+                "lease_expires_at": expires,
+            }
+        )
+    db_session.commit()
+
+    assert asyncio.run(job_queue.recover()) == 1
+
+    live, dead = (client.get(f"/api/v1/documents/jobs/{i}").json() for i in job_ids)
+    assert live["state"] == "running"
+    assert dead["state"] == "queued"
+
+
+def test_repeat_upload_is_deduplicated_by_content_hash(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    dify_requests = []
+
+    def handler(request):
+        dify_requests.append(request)
+        return httpx.Response(200, json={"id": f"dify-{len(dify_requests)}"})
+
+    mock_dify(mocker, handler)
+    handbook = b"Employee handbook, version 7.\n" * 50
+
+    first = client.post(
+        "/api/v1/documents", files={"file": ("handbook.txt", handbook, "text/plain")}
+    )
+    again = client.post(
+        "/api/v1/documents",
+        files={"file": ("handbook-copy.txt", handbook, "text/plain")},
+    )
+    other = client.post(
+        "/api/v1/documents",
+        files={"file": ("handbook.txt", handbook + b"Addendum.", "text/plain")},
+    )
+
+    assert first.headers["X-Dedup"] == "MISS"
+    assert again.headers["X-Dedup"] == "HIT"
+    assert again.json() == first.json() == {"id": "dify-1"}
+    assert "hash=" in again.headers["X-Ingest-Timings"]
+    assert other.headers["X-Dedup"] == "MISS"
+    assert other.json() == {"id": "dify-2"}
+    assert len(dify_requests) == 2
+    assert db_session.query(DifyUpload).count() == 2
+    # The repeat was not indexed a second time
+    assert db_session.query(Document).count() == 2
+
+
+def test_same_content_from_another_user_is_uploaded_again(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    dify_requests = []
+
+    def handler(request):
+        dify_requests.append(request)
+        return httpx.Response(200, json={"id": f"dify-{len(dify_requests)}"})
+
+    mock_dify(mocker, handler)
+    upload = {"file": ("notes.txt", b"Shared meeting notes.", "text/plain")}
+
+    first = client.post("/api/v1/documents", files=upload)
+    app.dependency_overrides[get_current_active_user] = lambda: User(
+        id=2, username="other-user", email="other@example.com", is_active=True
+    )
+    second = client.post("/api/v1/documents", files=upload)
+
+    assert first.headers["X-Dedup"] == second.headers["X-Dedup"] == "MISS"
+    assert first.json() == {"id": "dify-1"}
+    # Uploaded as the second user, not handed the first user's file
+    assert second.json() == {"id": "dify-2"}
+    assert b"other-user" in dify_requests[1].read()
+    assert db_session.query(DifyUpload).count() == 2
+    # And searchable by the second user too
+    [hit] = client.get("/api/v1/search", params={"q": "meeting notes", "k": 1}).json()[
+        "results"
+    ]
+    assert hit["dify_file_id"] == "dify-2"
+
+
+def test_dify_config_snapshot_is_versioned_and_picked_up_by_other_workers(
+    mocker, db_session
+):
+    mocker.patch.object(dify_config, "_snapshot", DifyConfigSnapshot())
+    mocker.patch.object(dify_config, "session_factory", AsyncTestingSessionLocal)
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://dify-a/v1", "api_key": "key-a"},
+    )
+    first = dify_config.current()
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://dify-b/v1", "api_key": "key-b"},
+    )
+    second = dify_config.current()
+    assert (first.version, first.api_url) == (1, "http://dify-a/v1")
+    assert (second.version, second.api_url) == (2, "http://dify-b/v1")
+    assert db_session.query(DifyConfig).count() == 1
+
+    # Another worker saves a change; this one only learns about it by polling
+    db_session.query(DifyConfig).update(
+        {"api_url": "http://dify-c/v1", "api_key": "key-c", "version": 3}
+    )
+    db_session.commit()
+    assert dify_config.current() is second
+    assert asyncio.run(dify_config.refresh()).api_url == "http://dify-c/v1"
+    assert client.get("/api/v1/dify-config").json() == {
+        "api_url": "http://dify-c/v1",
+        "api_key": "key-c",
+    }
+
+    # Stale versions never replace a newer snapshot
+    db_session.query(DifyConfig).update({"api_url": "http://old/v1", "version": 1})
+    db_session.commit()
+    assert asyncio.run(dify_config.refresh()).api_url == "http://dify-c/v1"
+
+
+def test_chat_is_routed_to_least_loaded_backend_and_pinned(mocker, db_session):
+    mocker.patch.object(dify_config, "_snapshot", DifyConfigSnapshot())
+    mocker.patch.object(dify_config, "session_factory", AsyncTestingSessionLocal)
+    mocker.patch.object(history_writer, "session_factory", AsyncTestingSessionLocal)
+    conversation_cache.clear()
+    asyncio.run(history_writer.flush())
+    mocker.patch.object(settings, "ADMIN_USERNAMES", {"test-user"})
+    for name in ("a", "b"):
+        response = client.post(
+            "/api/v1/dify-backends",
+            json={"api_url": f"http://dify-{name}/v1", "api_key": f"key-{name}"},
+        )
+        assert response.status_code == 200
+    backend_a, backend_b = dify_config.current().backends
+    listed = client.get("/api/v1/dify-backends").json()
+    assert [b["api_url"] for b in listed["backends"]] == [
+        "http://dify-a/v1",
+        "http://dify-b/v1",
+    ]
+    assert "api_key" not in listed["backends"][0]
+
+    sent = []
+
+    def handler(request):
+        host = request.url.host
+        sent.append((host, json.loads(request.content)["conversation_id"]))
+        return httpx.Response(
+            200,
+            content=(
+                f'data: {{"event": "message", "answer": "Hi", '
+                f'"conversation_id": "conv-{host}"}}\n\n'
+            ).encode(),
+        )
+
+    mock_dify(mocker, handler)
+
+    # A is busy, so the new conversation starts on B
+    dify_backends.acquire(backend_a)
+    client.post("/api/v1/chat", json={"query": "Hello", "conversation_id": "routed"})
+    dify_backends.release(backend_a)
+    assert dify_backends.state(backend_b).in_flight == 0
+    asyncio.run(history_writer.flush())
+    conversation = db_session.query(Conversation).filter_by(client_id="routed").one()
+    assert conversation.dify_backend_id == backend_b.id
+
+    # Follow-ups stay on B even when it is the busier one
+    conversation_cache.clear()
+    dify_backends.acquire(backend_b)
+    client.post("/api/v1/chat", json={"query": "More", "conversation_id": "routed"})
+    dify_backends.release(backend_b)
+
+    # Once B is disabled the conversation starts over on A
+    response = client.delete(f"/api/v1/dify-backends/{backend_b.id}")
+    assert [b["id"] for b in response.json()["backends"]] == [backend_a.id]
+    client.post("/api/v1/chat", json={"query": "Again", "conversation_id": "routed"})
+    assert sent == [
+        ("dify-b", ""),
+        ("dify-b", "conv-dify-b"),
+        ("dify-a", ""),
+    ]
+    assert client.delete("/api/v1/dify-backends/999").status_code == 404
+
+
+def test_only_admins_manage_dify_backends(mocker, db_session):
+    mocker.patch.object(dify_config, "_snapshot", DifyConfigSnapshot())
+    mocker.patch.object(dify_config, "session_factory", AsyncTestingSessionLocal)
+    mocker.patch.object(settings, "ADMIN_USERNAMES", {"admin"})
+
+    response = client.post(
+        "/api/v1/dify-backends",
+        json={"api_url": "http://evil.example/v1", "api_key": "stolen"},
+    )
+    assert response.status_code == 403
+    assert client.delete("/api/v1/dify-backends/1").status_code == 403
+    assert dify_config.current().backends == ()
+
+
+def test_chat_fails_fast_with_503_while_circuit_is_open(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    mocker.patch.object(dify_backends, "breaker_failures", 2)
+    mocker.patch.object(dify_backends, "retry_backoff", 0)
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        raise httpx.ConnectError("connection refused", request=request)
+
+    mock_dify(mocker, handler)
+
+    response = client.post("/api/v1/chat", json={"query": "Hello Dify"})
+    assert response.status_code == 500
+    assert "connection refused" in response.json()["detail"]
+    # The first attempt and one retry opened the circuit
+    assert len(calls) == 2
+
+    response = client.post("/api/v1/chat", json={"query": "Hello again"})
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert len(calls) == 2
+
+    breakers = client.get("/api/v1/dify-backends/breakers").json()
+    assert breakers["breakers"][0]["state"] == "open"
+    # The first request's third attempt, then the second request
+    assert breakers["breakers"][0]["rejected"] == 2
+    assert breakers["retry_budget"]["retries"] >= 1
+
+
+def test_upload_is_retried_on_another_backend(mocker, db_session):
+    mocker.patch.object(dify_config, "_snapshot", DifyConfigSnapshot())
+    mocker.patch.object(dify_config, "session_factory", AsyncTestingSessionLocal)
+    mocker.patch.object(dify_backends, "retry_backoff", 0)
+    mocker.patch.object(settings, "ADMIN_USERNAMES", {"test-user"})
+    for name in ("a", "b"):
+        client.post(
+            "/api/v1/dify-backends",
+            json={"api_url": f"http://dify-{name}/v1", "api_key": f"key-{name}"},
+        )
+    uploads = []
+
+    def handler(request):
+        uploads.append((request.url.host, request.read()))
+        if len(uploads) == 1:
+            return httpx.Response(502)
+        return httpx.Response(200, json={"id": f"on-{request.url.host}"})
+
+    mock_dify(mocker, handler)
+
+    response = client.post(
+        "/api/v1/documents",
+        files={"file": ("retry.txt", b"Retried body.", "text/plain")},
+    )
+
+    assert response.status_code == 200
+    first, second = uploads
+    assert first[0] != second[0]
+    # The body is re-sent in full
+    assert b"Retried body." in first[1] and b"Retried body." in second[1]
+    assert response.json() == {"id": f"on-{second[0]}"}
+    upload = db_session.query(DifyUpload).one()
+    backend = next(
+        b
+        for b in dify_config.current().backends
+        if b.api_url.endswith(second[0] + "/v1")
+    )
+    assert upload.dify_app == backend.fingerprint
+
+
+def test_chat_is_rate_limited_per_user(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    mocker.patch.object(
+        rate_limiter, "limits", {**rate_limiter.limits, "chat": (0.5, 2)}
+    )
+    mock_dify(
+        mocker,
+        lambda request: httpx.Response(
+            200, content=b'data: {"event": "message", "answer": "Hi"}\n\n'
+        ),
+    )
+
+    statuses = [
+        client.post("/api/v1/chat", json={"query": f"Question {i}"}).status_code
+        for i in range(3)
+    ]
+    assert statuses == [200, 200, 429]
+    limited = client.post("/api/v1/chat", json={"query": "Once more"})
+    assert 1 <= int(limited.headers["Retry-After"]) <= 2
+    assert limited.json() == {"detail": "Too many requests, please slow down"}
+
+    # Another user has their own bucket
+    app.dependency_overrides[get_current_active_user] = lambda: User(
+        id=2, username="other-user", email="other@example.com", is_active=True
+    )
+    assert client.post("/api/v1/chat", json={"query": "Hi"}).status_code == 200
+
+
+def test_chat_streams_are_capped_per_user(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    mocker.patch.object(rate_limiter, "max_streams", 2)
+    release = asyncio.Event()
+
+    async def handler(request):
+        async def body():
+            yield b'data: {"event": "message", "answer": "Hi"}\n\n'
+            await release.wait()
+
+        return httpx.Response(200, content=body())
+
+    mock_dify(mocker, handler)
+
+    async def ask():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+
+            async def open_stream(i):
+                return await c.post(
+                    "/api/v1/chat", json={"query": f"Q{i}", "conversation_id": str(i)}
+                )
+
+            streams = [asyncio.create_task(open_stream(i)) for i in range(2)]
+            while len(rate_limiter.backend._leases.get("streams:test-user", {})) < 2:
+                await asyncio.sleep(0.01)
+            rejected = await open_stream(3)
+            release.set()
+            finished = await asyncio.gather(*streams)
+            # Slots are given back once the streams end
+            after = await open_stream(4)
+            return rejected, finished, after
+
+    rejected, finished, after = asyncio.run(ask())
+    assert rejected.status_code == 429
+    assert rejected.headers["Retry-After"] == "1"
+    assert [r.status_code for r in finished] == [200, 200]
+    assert after.status_code == 200
+    assert rate_limiter.backend._leases == {}
+
+
+def test_stream_lease_is_released_when_the_client_disconnects(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+
+    class AwaitingBackend(MemoryRateLimitBackend):
+        # Like the Postgres backend, releasing takes a round trip
+        async def release(self, key, lease):
+            await asyncio.sleep(0)
+            await super().release(key, lease)
+
+    mocker.patch.object(rate_limiter, "backend", AwaitingBackend())
+
+    async def handler(request):
+        async def body():
+            yield b'data: {"event": "message", "answer": "Hi"}\n\n'
+            await asyncio.Event().wait()
+
+        return httpx.Response(200, content=body())
+
+    mock_dify(mocker, handler)
+
+    async def disconnect_mid_stream():
+        first_chunk = asyncio.Event()
+        requested = False
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {
+                    "type": "http.request",
+                    "body": json.dumps({"query": "Hi"}).encode(),
+                    "more_body": False,
+                }
+            await first_chunk.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            if message["type"] == "http.response.body" and message.get("body"):
+                first_chunk.set()
+
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "POST",
+            "scheme": "http",
+            "path": "/api/v1/chat",
+            "raw_path": b"/api/v1/chat",
+            "root_path": "",
+            "query_string": b"",
+            "headers": [(b"content-type", b"application/json")],
+            "client": ("testclient", 50000),
+            "server": ("testserver", 80),
+        }
+        await asyncio.wait_for(app(scope, receive, send), 5)
+
+    asyncio.run(disconnect_mid_stream())
+    assert rate_limiter.backend._leases.get("streams:test-user", {}) == {}
+
+
+def test_metrics_endpoint_exposes_route_stream_and_pool_metrics(mocker, db_session):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+
+    def handler(request):
+        if request.url.path.endswith("/files/upload"):
+            return httpx.Response(200, json={"id": "measured"})
+        return httpx.Response(
+            200,
+            content=(
+                b'data: {"event": "message", "answer": "Hi"}\n\n'
+                b'data: {"event": "message_end"}\n\n'
+            ),
+        )
+
+    mock_dify(mocker, handler)
+    client.post("/api/v1/chat", json={"query": "Metrics?", "conversation_id": "m"})
+    client.post(
+        "/api/v1/documents", files={"file": ("m.txt", b"measured", "text/plain")}
+    )
+    client.get("/api/v1/documents/jobs/unknown")
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert (
+        'http_request_duration_seconds_count{method="POST",'
+        'route="/api/v1/chat",status="200"}'
+    ) in text
+    # Route templates, not raw paths
+    assert 'route="/api/v1/documents/jobs/{job_id}"' in text
+    assert "/jobs/unknown" not in text
+    assert 'chat_client_ttfb_seconds_count{source="dify"}' in text
+    assert "chat_dify_ttfb_seconds_count" in text
+    assert 'stream_events_count{route="chat"}' in text
+    assert 'active_streams{route="chat"} 0.0' in text
+    assert "dify_upload_throughput_bytes_per_second_count" in text
+    assert "db_pool_checkouts_total" in text
+    assert "threadpool_threads_limit" in text
+    assert 'chat_history_turns_total{outcome="written"}' in text
+    assert "chat_history_queued" in text
+    assert 'rate_limit_rejected_total{limit="streams"}' in text
+
+
+def _server_timing(response):
+    return dict(
+        (name, float(duration.split("=")[1]))
+        for name, duration in (
+            part.strip().split(";")
+            for part in response.headers["Server-Timing"].split(",")
+        )
+    )
+
+
+def test_server_timing_reports_auth_and_db_phases(db_session):
+    app.dependency_overrides.pop(get_current_active_user)
+    principal_cache.clear()
+    client.post(
+        "/api/v1/auth/register",
+        json={"username": "dave", "email": "dave@example.com", "password": "pw"},
+    )
+    token = client.post(
+        "/api/v1/auth/login", json={"username": "dave", "password": "pw"}
+    ).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    first = _server_timing(client.get("/api/v1/auth/me", headers=headers))
+    second = _server_timing(client.get("/api/v1/auth/me", headers=headers))
+
+    assert {"auth", "db", "app"} <= set(first)
+    assert first["app"] >= first["auth"] + first["db"]
+    # The cached principal skips the user lookup
+    assert "auth" in second and "db" not in second
+
+
+def test_chat_phases_go_to_server_timing_and_the_log(mocker, db_session, caplog):
+    client.post(
+        "/api/v1/dify-config",
+        json={"api_url": "http://test-dify.com/v1", "api_key": "test-api-key"},
+    )
+    mock_dify(
+        mocker,
+        lambda request: httpx.Response(
+            200,
+            content=(
+                b'data: {"event": "message", "answer": "Hi"}\n\n'
+                b'data: {"event": "message_end"}\n\n'
+            ),
+        ),
+    )
+
+    with caplog.at_level("INFO", logger="app.timing"):
+        response = client.post(
+            "/api/v1/chat", json={"query": "Timed?", "conversation_id": "t"}
+        )
+
+    assert "upstream_connect" in _server_timing(response)
+    line = next(
+        r.getMessage() for r in caplog.records if "request_timing" in r.getMessage()
+    )
+    entry = json.loads(line.split("request_timing ", 1)[1])
+    assert entry["path"] == "/api/v1/chat"
+    assert entry["status"] == 200
+    # Only known once the body has streamed
+    assert {"upstream_connect", "upstream_ttfb", "stream_total"} <= set(
+        entry["phases_ms"]
+    )
+
+
+def test_slow_requests_are_logged_with_their_breakdown(caplog):
+    async def slow_app(scope, receive, send):
+        with phase("db"):
+            await asyncio.sleep(0.02)
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    sampled = TimingMiddleware(slow_app, log_requests=False, slow_ms=10)
+    skipped = TimingMiddleware(
+        slow_app, log_requests=False, slow_ms=10, slow_sample_rate=0
+    )
+    slow_client = TestClient(sampled)
+    with caplog.at_level("INFO", logger="app.timing"):
+        response = slow_client.get("/slow")
+        TestClient(skipped).get("/slow")
+
+    assert "db" in _server_timing(response)
+    lines = [r.getMessage() for r in caplog.records if r.name == "app.timing"]
+    assert len(lines) == 1 and "slow_request" in lines[0]
+    assert '"db":' in lines[0]
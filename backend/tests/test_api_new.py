@@ -1,44 +1,62 @@
 from fastapi.testclient import TestClient
 from app.main import app
+from app.auth import get_current_active_user
 from app.database import Base, get_db
-from app.models import DifyConfig
+from app.dify_config import DifyConfigSnapshot, dify_config
+from app.models import DifyConfig, User
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import NullPool
 import pytest
 import os
+import tempfile
 
 # Override environment variables for testing
 os.environ["DB_HOST"] = "test"
 os.environ["DB_NAME"] = "test_db"
 os.environ["APP_DEBUG"] = "true"
 
-# Setup a test database
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+# Setup a test database file shared by the app (aiosqlite) and assertions
+_fd, TEST_DB_PATH = tempfile.mkstemp(suffix=".db")
+os.close(_fd)
 
 test_engine = create_engine(
-    SQLALCHEMY_DATABASE_URL,
-    connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
+    f"sqlite:///{TEST_DB_PATH}", connect_args={"check_same_thread": False}
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=test_engine)
 
+# NullPool: TestClient runs each request on a fresh event loop
+async_test_engine = create_async_engine(
+    f"sqlite+aiosqlite:///{TEST_DB_PATH}", poolclass=NullPool
+)
+AsyncTestingSessionLocal = async_sessionmaker(
+    bind=async_test_engine, autoflush=False, expire_on_commit=False
+)
+
 Base.metadata.create_all(bind=test_engine)
 
 
-def override_get_db():
-    db = TestingSessionLocal()
-    try:
+async def override_get_db():
+    async with AsyncTestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-app.dependency_overrides[get_db] = override_get_db
+def override_current_user():
+    return User(id=1, username="test-user", email="test@example.com", is_active=True)
+
 
 client = TestClient(app)
 
 
+@pytest.fixture(autouse=True)
+def dependency_overrides():
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_current_active_user] = override_current_user
+    yield
+    app.dependency_overrides.clear()
+
+
 @pytest.fixture(name="db_session")
 def db_session_fixture():
     Base.metadata.create_all(bind=test_engine)
@@ -82,16 +100,14 @@ def test_get_dify_config(db_session):
 
 
 def test_upload_document_no_config(mocker):
-    # Mock the global variables to be None (no config)
-    with mocker.patch("app.api.DIFY_API_URL", None):
-        with mocker.patch("app.api.DIFY_API_KEY", None):
-            response = client.post(
-                "/api/v1/documents",
-                files={"file": ("test.txt", b"test content", "text/plain")},
-            )
-            assert response.status_code == 400
-            error_detail = (
-                "Dify API configuration is missing. "
-                "Please set it via /api/v1/dify-config."
-            )
-            assert response.json() == {"detail": error_detail}
+    # No Dify config loaded in this worker
+    mocker.patch.object(dify_config, "_snapshot", DifyConfigSnapshot())
+    response = client.post(
+        "/api/v1/documents",
+        files={"file": ("test.txt", b"test content", "text/plain")},
+    )
+    assert response.status_code == 400
+    error_detail = (
+        "Dify API configuration is missing. Please set it via /api/v1/dify-config."
+    )
+    assert response.json() == {"detail": error_detail}
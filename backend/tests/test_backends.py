@@ -0,0 +1,68 @@
+import asyncio
+
+import httpx
+
+from app.backends import BackendRouter
+from app.dify_config import DifyBackend, DifyConfigSnapshot
+
+A = DifyBackend(1, "http://dify-a/v1", "key-a")
+B = DifyBackend(2, "http://dify-b/v1", "key-b", weight=2)
+CONFIG = DifyConfigSnapshot(version=1, backends=(A, B))
+
+
+def _router():
+    return BackendRouter(interval=0, timeout=1, path="/parameters", failure_threshold=2)
+
+
+def test_pick_prefers_least_loaded_relative_to_weight():
+    router = _router()
+    router.acquire(B)
+    # B has twice the weight, so one request in flight still ties with idle A
+    assert {router.pick(CONFIG) for _ in range(50)} == {A, B}
+    router.acquire(B)
+    assert router.pick(CONFIG) is A
+    router.acquire(A)
+    router.acquire(A)
+    assert router.pick(CONFIG) is B
+    router.release(A)
+    router.release(A)
+    router.release(A)
+    assert router.state(A).in_flight == 0
+    assert router.state(A).requests == 2
+
+
+def test_unhealthy_backends_are_skipped_unless_all_are_down():
+    router = _router()
+    router.state(A).healthy = False
+    router.acquire(B)
+    router.acquire(B)
+    assert router.pick(CONFIG) is B
+    router.state(B).healthy = False
+    assert router.pick(CONFIG) is A
+
+
+def test_probe_marks_unhealthy_after_threshold_and_recovers(mocker):
+    status = {"code": 503}
+    seen = []
+
+    def handler(request):
+        seen.append((str(request.url), request.headers["Authorization"]))
+        return httpx.Response(status["code"])
+
+    mocker.patch(
+        "app.backends.dify_clients.get",
+        return_value=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+    )
+    router = _router()
+
+    assert asyncio.run(router.probe(A)) is False
+    assert router.state(A).healthy
+    assert asyncio.run(router.probe(A)) is False
+    assert not router.state(A).healthy
+    assert router.state(A).last_error == "HTTP 503"
+
+    status["code"] = 200
+    assert asyncio.run(router.probe(A)) is True
+    assert router.state(A).healthy
+    assert router.state(A).probe_failures == 0
+    assert seen[0] == ("http://dify-a/v1/parameters", "Bearer key-a")
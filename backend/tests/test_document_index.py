@@ -0,0 +1,27 @@
+import math
+
+from app.document_index import chunk_text
+from app.embeddings import HashingEmbedder, load_embedder
+
+
+def test_hashing_embedder_is_deterministic_and_normalized():
+    embedder = HashingEmbedder(dim=64)
+    [a, b, c] = embedder.embed(
+        ["Reset your password", "reset your PASSWORD", "Quarterly revenue"]
+    )
+    assert a == b
+    assert math.isclose(sum(v * v for v in a), 1.0)
+    assert sum(x * y for x, y in zip(a, b)) > sum(x * y for x, y in zip(a, c))
+    assert isinstance(load_embedder("hashing", 8), HashingEmbedder)
+
+
+def test_chunk_text_streams_overlapping_chunks():
+    pieces = ("Sentence number %d. " % i for i in range(200))
+    chunks = list(chunk_text(pieces, chunk_size=200, overlap=40))
+
+    assert all(len(chunk) <= 200 for chunk in chunks)
+    assert chunks[0].startswith("Sentence number 0.")
+    assert chunks[-1].endswith("Sentence number 199.")
+    # Consecutive chunks share their boundary text
+    assert chunks[1][:10] in chunks[0]
+    assert list(chunk_text(["short text"], 200, 40)) == ["short text"]
@@ -0,0 +1,139 @@
+import io
+import zipfile
+
+import pytest
+
+from app.ingest import (
+    DOCX,
+    MARKDOWN,
+    PDF,
+    TEXT,
+    BINARY,
+    IngestPipeline,
+    Sniffed,
+    extract_docx,
+    extract_markdown,
+    extract_text,
+    extraction_pool,
+    normalize,
+    sniff,
+)
+
+
+def make_docx(*paragraphs):
+    ns = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+    body = "".join(f"<w:p><w:r><w:t>{text}</w:t></w:r></w:p>" for text in paragraphs)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        archive.writestr("[Content_Types].xml", "<Types/>")
+        archive.writestr(
+            "word/document.xml",
+            f'<w:document xmlns:w="{ns}"><w:body>{body}</w:body></w:document>',
+        )
+    return buffer.getvalue()
+
+
+def make_pdf(*pages):
+    """A minimal PDF with one line of Helvetica text per page."""
+    count = len(pages)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids ["
+        + b" ".join(b"%d 0 R" % (4 + 2 * i) for i in range(count))
+        + b"] /Count %d >>" % count,
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for i, text in enumerate(pages):
+        stream = b"BT /F1 12 Tf 72 720 Td (%s) Tj ET" % text.encode()
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (5 + 2 * i)
+        )
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream)
+        )
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+    return out
+
+
+def test_sniff_detects_type_from_content_before_name():
+    assert sniff(b"%PDF-1.7\n...", "report.bin", None).kind == PDF
+    assert sniff(make_docx("x")[:64], "notes.docx", None).kind == DOCX
+    assert sniff(b"# Title", "README.md", "application/octet-stream") == Sniffed(
+        MARKDOWN, "text/markdown"
+    )
+    assert sniff(b"plain words", "notes", None).kind == TEXT
+    assert sniff(b"\x89PNG\r\n\x1a\n\x00\x00", "image.png", "image/png").kind == BINARY
+
+
+def test_extract_text_decodes_across_block_boundaries():
+    data = ("héllo wörld " * 100).encode()
+    pieces = list(extract_text(io.BytesIO(data), block_size=7))
+    assert len(pieces) > 1
+    assert "".join(pieces) == data.decode()
+
+
+def test_extract_markdown_strips_markup():
+    source = (
+        b"# Title\n\nSome **bold** and [a link](http://x).\n```\ncode\n```\n- item\n"
+    )
+    text = "".join(extract_markdown(io.BytesIO(source)))
+    assert text == "Title\n\nSome bold and a link.\n\ncode\n\nitem\n"
+
+
+def test_extract_docx_yields_paragraphs():
+    pieces = list(extract_docx(io.BytesIO(make_docx("First paragraph", "Second"))))
+    assert pieces == ["First paragraph\n", "Second\n"]
+
+
+def test_normalize_collapses_whitespace_and_control_characters():
+    assert list(normalize(["ﬁne\t\t text\r\n\r\n\r\n\x00next", ""])) == [
+        "fine text\n\nnext"
+    ]
+
+
+def test_pipeline_streams_chunks_and_reports_stage_timings():
+    data = b"".join(b"Line %d of the handbook.\n" % i for i in range(500))
+    pipeline = IngestPipeline(
+        io.BytesIO(data), Sniffed(TEXT, "text/plain"), chunk_size=200, overlap=20
+    )
+    batches = list(pipeline.batches(8))
+
+    assert all(len(batch) <= 8 for batch in batches)
+    chunks = [chunk for batch in batches for chunk in batch]
+    assert chunks[0].startswith("Line 0 of")
+    assert chunks[-1].endswith("Line 499 of the handbook.")
+    assert set(pipeline.timings) == {"extract", "normalize", "chunk"}
+    assert all(seconds >= 0 for seconds in pipeline.timings.values())
+
+
+def test_pipeline_extracts_pdf_pages_in_worker_processes(tmp_path):
+    pytest.importorskip("pypdf")
+    path = tmp_path / "report.pdf"
+    path.write_bytes(
+        make_pdf(*(f"Page {n} mentions quarterly revenue" for n in range(5)))
+    )
+    pipeline = IngestPipeline(
+        open(path, "rb"),
+        sniff(path.read_bytes()[:16], "report.pdf", None),
+        path=str(path),
+    )
+    try:
+        text = "\n".join(pipeline.chunks())
+    finally:
+        pipeline.fileobj.close()
+        extraction_pool.shutdown()
+
+    assert [f"Page {n}" in text for n in range(5)] == [True] * 5
+    assert text.index("Page 0") < text.index("Page 4")
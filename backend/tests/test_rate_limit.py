@@ -0,0 +1,36 @@
+import asyncio
+
+from app.rate_limit import MemoryRateLimitBackend
+
+
+def test_token_bucket_refills_at_rate(mocker):
+    clock = mocker.patch("app.rate_limit.time.monotonic", return_value=1000.0)
+    backend = MemoryRateLimitBackend()
+
+    async def take():
+        return await backend.take("chat:alice", rate=2, burst=3)
+
+    assert [asyncio.run(take()) for _ in range(3)] == [0, 0, 0]
+    assert asyncio.run(take()) == 0.5
+    clock.return_value = 1000.5
+    assert asyncio.run(take()) == 0
+    assert asyncio.run(take()) == 0.5
+    assert asyncio.run(backend.take("chat:bob", rate=2, burst=3)) == 0
+
+
+def test_stream_leases_are_capped_and_expire(mocker):
+    clock = mocker.patch("app.rate_limit.time.monotonic", return_value=1000.0)
+    backend = MemoryRateLimitBackend()
+
+    async def acquire():
+        return await backend.acquire("streams:alice", limit=2, ttl=60)
+
+    first, second = asyncio.run(acquire()), asyncio.run(acquire())
+    assert first and second and first != second
+    assert asyncio.run(acquire()) is None
+    asyncio.run(backend.release("streams:alice", first))
+    assert asyncio.run(acquire()) is not None
+
+    # A lease that was never released stops counting once it expires
+    clock.return_value = 1061.0
+    assert asyncio.run(acquire()) is not None
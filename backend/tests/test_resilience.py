@@ -0,0 +1,148 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.backends import BackendRouter
+from app.dify_config import DifyBackend, DifyConfigSnapshot
+from app.resilience import CircuitBreaker, CircuitOpenError, RetryBudget
+
+A = DifyBackend(1, "http://dify-a/v1", "key-a")
+B = DifyBackend(2, "http://dify-b/v1", "key-b")
+CONFIG = DifyConfigSnapshot(version=1, backends=(A, B))
+
+
+def _router(**kwargs):
+    options = dict(
+        interval=0,
+        timeout=1,
+        path="/parameters",
+        failure_threshold=2,
+        breaker_failures=2,
+        breaker_reset=30,
+        retry_backoff=0,
+        retry_budget=RetryBudget(ratio=0.2, min_per_second=0, burst=10),
+    )
+    options.update(kwargs)
+    return BackendRouter(**options)
+
+
+def _unavailable(backend):
+    request = httpx.Request("POST", backend.api_url)
+    raise httpx.HTTPStatusError(
+        "HTTP 503", request=request, response=httpx.Response(503)
+    )
+
+
+def test_breaker_opens_after_consecutive_failures_and_half_opens(mocker):
+    clock = mocker.patch("app.resilience.time.monotonic", return_value=100.0)
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow() and breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    assert breaker.retry_after() == 10
+
+    clock.return_value = 110.0
+    # One trial call at a time while half-open
+    assert breaker.allow() and breaker.state == "half_open"
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.opens == 2
+
+    clock.return_value = 120.0
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.stats()["rejected"] == 2
+
+
+def test_retry_budget_caps_retries_to_a_fraction_of_requests():
+    budget = RetryBudget(ratio=0.5, min_per_second=0, burst=2)
+    budget.tokens = 0
+    budget.record_request()
+    assert not budget.try_acquire()
+    budget.record_request()
+    assert budget.try_acquire()
+    assert not budget.try_acquire()
+    assert budget.stats()["retries"] == 1
+    assert budget.stats()["exhausted"] == 2
+
+
+def test_call_retries_on_another_backend_and_stops_at_open_circuits():
+    router = _router()
+    tried = []
+
+    async def send(backend):
+        tried.append(backend.id)
+        if len(tried) == 1:
+            _unavailable(backend)
+        return f"ok-{backend.id}"
+
+    backend, result = asyncio.run(router.call(CONFIG, send))
+    assert tried[0] != tried[1]
+    assert result == f"ok-{backend.id}"
+    assert router.state(backend).in_flight == 1
+    router.release(backend)
+
+    # Pinned calls never move, and fail fast once the circuit opens
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(router.call(CONFIG, _async(_unavailable), backend=A))
+    assert router.state(A).breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(router.call(CONFIG, _async(_unavailable), backend=A))
+    assert all(router.state(b).in_flight == 0 for b in (A, B))
+
+
+def test_client_errors_are_not_retried():
+    router = _router()
+    calls = []
+
+    async def send(backend):
+        calls.append(backend)
+        request = httpx.Request("POST", backend.api_url)
+        response = httpx.Response(400)
+        raise httpx.HTTPStatusError("HTTP 400", request=request, response=response)
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(router.call(CONFIG, send))
+    assert len(calls) == 1
+    assert router.state(calls[0]).breaker.failures == 0
+
+
+def test_slow_connect_is_hedged_on_another_backend():
+    router = _router(hedge_delay=0.01)
+    discarded = []
+
+    async def send(backend):
+        if backend.id == A.id:
+            await asyncio.sleep(1)
+        return backend.id
+
+    async def run():
+        # A is picked first because B looks busy
+        router.acquire(B)
+        router.acquire(B)
+        call = router.call(CONFIG, send, hedge=True, discard=discarded.append)
+        result = await call
+        router.release(B)
+        router.release(B)
+        return result
+
+    backend, result = asyncio.run(run())
+    assert (backend, result) == (B, B.id)
+    assert router.hedges == 1
+    # The slow attempt was cancelled and released
+    assert router.state(A).in_flight == 0
+    assert router.state(A).breaker.state == "closed"
+    assert discarded == []
+
+
+def _async(function):
+    async def wrapper(backend):
+        return function(backend)
+
+    return wrapper
@@ -0,0 +1,49 @@
+import asyncio
+
+from app.singleflight import SingleFlight
+
+
+def test_late_subscriber_gets_emitted_frames_and_live_tail():
+    async def run():
+        group = SingleFlight()
+        release = asyncio.Event()
+
+        async def upstream():
+            yield b"a"
+            await release.wait()
+            yield b"b"
+
+        flight = group.begin("k")
+        group.run(flight, upstream())
+        first = flight.subscribe()
+        assert await first.__anext__() == b"a"
+
+        joined = group.join("k")
+        assert joined is flight
+        late = asyncio.create_task(_collect(joined.subscribe()))
+        await asyncio.sleep(0)
+        release.set()
+
+        assert await late == [b"a", b"b"]
+        assert [frame async for frame in first] == [b"b"]
+        assert group.join("k") is None
+        assert group.stats() == {"in_flight": 0, "leaders": 1, "followers": 1}
+
+    asyncio.run(run())
+
+
+def test_aborted_flight_ends_subscribers_with_error_frame():
+    async def run():
+        group = SingleFlight()
+        flight = group.begin("k")
+        follower = asyncio.create_task(_collect(group.join("k").subscribe()))
+        await asyncio.sleep(0)
+        group.abort(flight, b"error")
+        assert await follower == [b"error"]
+        assert group.join("k") is None
+
+    asyncio.run(run())
+
+
+async def _collect(frames):
+    return [frame async for frame in frames]
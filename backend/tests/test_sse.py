@@ -0,0 +1,80 @@
+import asyncio
+import json
+
+from app.sse import SSEParser, coalesce_text_events, format_sse
+
+
+def collect(events, window=0.05, max_bytes=1024):
+    async def source():
+        for item in events:
+            if isinstance(item, float):
+                await asyncio.sleep(item)
+            else:
+                yield item
+
+    async def run():
+        return [e async for e in coalesce_text_events(source(), window, max_bytes)]
+
+    return asyncio.run(run())
+
+
+def test_parser_handles_events_split_across_chunks():
+    parser = SSEParser()
+    assert parser.feed(b'data: {"event": "text_chunk", "ans') == []
+    assert parser.feed(b'wer": "Hi"}\r\n\r\nevent: ping\n\ndata: {"event"') == [
+        {"event": "text_chunk", "answer": "Hi"}
+    ]
+    assert parser.feed(b': "llm_end"}\n\n') == [{"event": "llm_end"}]
+    # A CRLF split between chunks
+    assert parser.feed(b'data: {"event":"a"}\r\n\r') == []
+    assert parser.feed(b'\ndata: {"event":"b"}\r\n\r\n') == [
+        {"event": "a"},
+        {"event": "b"},
+    ]
+    assert parser.flush() == []
+
+
+def test_format_sse_drops_unused_fields():
+    frame = format_sse({"event": "message", "answer": "你好", "task_id": "t1"})
+    assert frame == 'data: {"event":"message","answer":"你好"}\n\n'.encode()
+    assert json.loads(frame[6:]) == {"event": "message", "answer": "你好"}
+
+
+def test_coalesce_merges_deltas_and_keeps_first_token_immediate():
+    events = collect(
+        [{"event": "text_chunk", "answer": c} for c in ["A", "b", "c", "d"]]
+        + [{"event": "llm_end"}]
+    )
+    assert events == [
+        {"event": "text_chunk", "answer": "A"},
+        {"event": "text_chunk", "answer": "bcd"},
+        {"event": "llm_end"},
+    ]
+
+
+def test_coalesce_flushes_on_window_and_size():
+    chunk = {"event": "text_chunk", "answer": "xx"}
+    assert collect([chunk, chunk, 0.1, chunk], window=0.02) == [chunk, chunk, chunk]
+    assert collect([chunk, chunk, chunk, chunk], max_bytes=4) == [
+        chunk,
+        {"event": "text_chunk", "answer": "xxxx"},
+        chunk,
+    ]
+
+
+def test_coalesce_passes_retriever_results_through_immediately():
+    retriever = {"event": "retriever_result", "retriever_results": []}
+    events = collect(
+        [
+            {"event": "text_chunk", "answer": "a"},
+            {"event": "text_chunk", "answer": "b"},
+            retriever,
+            {"event": "text_chunk", "answer": "c"},
+        ]
+    )
+    assert events == [
+        {"event": "text_chunk", "answer": "a"},
+        {"event": "text_chunk", "answer": "b"},
+        retriever,
+        {"event": "text_chunk", "answer": "c"},
+    ]